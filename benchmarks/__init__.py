@@ -0,0 +1,63 @@
+"""Benchmarks, run them from the project root e.g. `python -m benchmarks.renderers`
+
+Models are imported within functions, they need `setup` to be called first.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from timeit import Timer
+from typing import Callable, List
+
+import django
+
+
+def setup() -> None:
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'kaffee_kasse.settings')
+    django.setup()
+
+
+def best_of(func: Callable[[], object], repeat: int = 5) -> float:
+    """Best time of `repeat` runs of `func` in seconds"""
+    timer = Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def make_users(size: int) -> List:
+    """Unsaved users with profiles"""
+    from django.contrib.auth.models import User
+
+    from users.models import Profile
+
+    users = []
+    for i in range(1, size + 1):
+        user = User(
+            id=i,
+            username=f'user{i}',
+            date_joined=datetime(2021, 5, 1, tzinfo=timezone.utc),
+        )
+        user.profile = Profile(id=i, user=user, balance=Decimal('-2.20'))
+        users.append(user)
+    return users
+
+
+def make_purchases(size: int) -> List:
+    """Unsaved purchases of 50 users and 10 beverage types"""
+    from purchases.models import BeverageType, Purchase
+
+    users = make_users(50)
+    beverage_types = [
+        BeverageType(id=i, name=f'beverage{i}', price=Decimal('1.20') + i)
+        for i in range(1, 11)
+    ]
+    start = datetime(2021, 5, 1, tzinfo=timezone.utc)
+    return [
+        Purchase(
+            id=i,
+            user=users[i % len(users)],
+            beverage_type=beverage_types[i % len(beverage_types)],
+            date=start + timedelta(minutes=i),
+            amount=beverage_types[i % len(beverage_types)].price,
+        )
+        for i in range(size)
+    ]
@@ -0,0 +1,102 @@
+"""Cold start latency of gunicorn with default settings and with
+`kaffee_kasse.gunicorn_conf`
+
+Starts one single worker server per profile and times its first requests. Needs
+gunicorn and the database.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+from http.client import HTTPConnection
+from typing import Dict, List, Optional
+
+PROFILES = {
+    'default': ['kaffee_kasse.wsgi'],
+    'gunicorn_conf': ['-c', 'python:kaffee_kasse.gunicorn_conf', 'kaffee_kasse.wsgi'],
+}
+
+
+def _wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 0.1).close()
+            return
+        except OSError:
+            time.sleep(0.01)
+    raise TimeoutError(f'Nothing listens on port {port}')
+
+
+def _get(port: int, path: str, token: Optional[str]) -> float:
+    headers = {'Host': 'localhost', 'Accept': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Token {token}'
+    connection = HTTPConnection('127.0.0.1', port, timeout=30)
+    start = time.perf_counter()
+    connection.request('GET', path, headers=headers)
+    response = connection.getresponse()
+    response.read()
+    duration = time.perf_counter() - start
+    connection.close()
+    if response.status >= 500:
+        raise RuntimeError(f'GET {path} failed with {response.status}')
+    return duration
+
+
+def measure(
+    profile: str, port: int, paths: List[str], token: Optional[str], settle: float
+) -> Dict[str, float]:
+    """Seconds from starting the server until its first response and latencies of
+    the first and second requests of each path, sent `settle` seconds after the
+    server started listening
+    """
+    env = {**os.environ, 'GUNICORN_WORKERS': '1', 'GUNICORN_THREADS': '1'}
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-b', f'127.0.0.1:{port}']
+        + PROFILES[profile],
+        env=env,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        _wait_for_port(port)
+        time.sleep(settle)
+        results = {'first response': 0.0}
+        for path in paths:
+            results[f'{path} first'] = _get(port, path, token)
+            if not results['first response']:
+                results['first response'] = time.perf_counter() - start
+            results[f'{path} second'] = _get(port, path, token)
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--paths', nargs='+', default=['/api/beverage-types/', '/api/users/me/']
+    )
+    parser.add_argument('--token', help='Authenticate requests with this token')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument(
+        '--settle',
+        type=float,
+        default=0,
+        help='Seconds to wait for workers to boot before the first request',
+    )
+    args = parser.parse_args()
+
+    for profile in PROFILES:
+        results = measure(profile, args.port, args.paths, args.token, args.settle)
+        print(profile)
+        for name, duration in results.items():
+            print(f'  {name:<40} {duration * 1000:9.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""Per request overhead of the browser only middleware skipped for the API"""
+from argparse import ArgumentParser
+
+from . import best_of, setup
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--path', default='/api/', help='API path to request')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    setup()
+    from django.test import Client, override_settings
+
+    times = {}
+    for fast_lane in (False, True):
+        with override_settings(API_FAST_LANE=fast_lane, ALLOWED_HOSTS=['*']):
+            # Middleware is loaded by the first request of a client
+            client = Client(HTTP_ACCEPT='application/json')
+            assert client.get(args.path).status_code == 200
+            times[fast_lane] = best_of(lambda: client.get(args.path), args.repeat)
+
+    saved = times[False] - times[True]
+    print(
+        f'GET {args.path}: all middleware {times[False] * 1e6:8.1f}us, '
+        f'API fast lane {times[True] * 1e6:8.1f}us, '
+        f'{saved * 1e6:.1f}us ({saved / times[False]:.0%}) saved per request'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""Compare `JSONRenderer` with `FastJSONRenderer` on the purchase list"""
+from argparse import ArgumentParser
+from typing import List
+
+from . import best_of, make_purchases, setup
+
+
+def purchase_list(size: int) -> List[dict]:
+    """Serialized purchase list like `GET /api/purchases/` returns it"""
+    from purchases.serializers import PurchaseSerializer
+
+    return PurchaseSerializer(
+        make_purchases(size), many=True, context={'request': None}
+    ).data
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 10_000])
+    args = parser.parse_args()
+
+    setup()
+    import gzip
+
+    from rest_framework.renderers import JSONRenderer
+
+    from kaffee_kasse.compat import brotli, orjson
+    from kaffee_kasse.renderers import FastJSONRenderer
+
+    if orjson is None:
+        print('orjson is not installed, FastJSONRenderer falls back to json')
+
+    for size in args.sizes:
+        data = purchase_list(size)
+        rendered = JSONRenderer().render(data)
+        json_time = best_of(lambda: JSONRenderer().render(data))
+        fast_time = best_of(lambda: FastJSONRenderer().render(data))
+        print(
+            f'{size:>7} purchases, {len(rendered):>9} bytes: '
+            f'JSONRenderer {json_time * 1000:8.3f}ms, '
+            f'FastJSONRenderer {fast_time * 1000:8.3f}ms '
+            f'({json_time / fast_time:.1f}x)'
+        )
+        print(f'{"":>7}   gzip {len(gzip.compress(rendered, 6)):>9} bytes', end='')
+        if brotli is not None:
+            print(f', br {len(brotli.compress(rendered, quality=4)):>9} bytes')
+        else:
+            print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+"""Time serializers and permission checks at different sizes
+
+Results are saved as JSON with `--output`. With `--compare` the results are
+compared with a saved baseline and the run fails if any case got slower by more
+than `--threshold`, e.g. 0.1 for 10%.
+"""
+import json
+import platform
+import sys
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from typing import Callable, Dict, List
+
+from . import best_of, make_purchases, make_users, setup
+
+
+def _request(user, data: dict):
+    from rest_framework.parsers import JSONParser
+    from rest_framework.request import Request
+    from rest_framework.test import APIRequestFactory, force_authenticate
+
+    django_request = APIRequestFactory().patch('/', data, format='json')
+    force_authenticate(django_request, user)
+    request = Request(django_request, parsers=[JSONParser()])
+    # Parse the body once, like the view would before checking permissions
+    request.data
+    return request
+
+
+def purchase_serializer(size: int) -> Callable[[], object]:
+    from purchases.serializers import PurchaseSerializer
+
+    purchases = make_purchases(size)
+    return lambda: PurchaseSerializer(
+        purchases, many=True, context={'request': None}
+    ).data
+
+
+def user_serializer(size: int) -> Callable[[], object]:
+    from users.serializers import UserSerializer
+
+    users = make_users(size)
+    return lambda: UserSerializer(users, many=True, context={'request': None}).data
+
+
+def purchase_counts(size: int) -> Callable[[], object]:
+    """Serialization of `GET /api/purchases/counts/` with `size` beverage types"""
+    from purchases.serializers import PurchaseCountSerializer
+
+    counts = [{'beverage_type': i, 'count': i % 100} for i in range(1, size + 1)]
+    return lambda: PurchaseCountSerializer(counts, many=True).data
+
+
+def _permission_check(permission, request, objects: List) -> Callable[[], object]:
+    return lambda: [
+        permission.has_object_permission(request, None, obj) for obj in objects
+    ]
+
+
+def user_permission(size: int) -> Callable[[], object]:
+    """`IsUserOwnerOrStaff` checked by a regular user on `size` users"""
+    from users.permissions import IsUserOwnerOrStaff
+
+    users = make_users(size)
+    return _permission_check(IsUserOwnerOrStaff(), _request(users[0], {}), users)
+
+
+def profile_permission(size: int) -> Callable[[], object]:
+    """`IsProfileOwnerOrStaff` checked by a regular user updating `size` profiles"""
+    from users.permissions import IsProfileOwnerOrStaff
+
+    users = make_users(size)
+    request = _request(users[0], {'is_freeloader': False})
+    return _permission_check(
+        IsProfileOwnerOrStaff(), request, [user.profile for user in users]
+    )
+
+
+CASES: Dict[str, Callable[[int], Callable[[], object]]] = {
+    'purchase_serializer': purchase_serializer,
+    'user_serializer': user_serializer,
+    'purchase_counts': purchase_counts,
+    'user_permission': user_permission,
+    'profile_permission': profile_permission,
+}
+
+
+def run(sizes: List[int], cases: List[str], repeat: int) -> Dict[str, float]:
+    """Best times in seconds keyed by `<case>[<size>]`"""
+    results = {}
+    for name in cases:
+        for size in sizes:
+            key = f'{name}[{size}]'
+            results[key] = best_of(CASES[name](size), repeat)
+            print(f'{key:<36} {results[key] * 1000:12.3f}ms')
+    return results
+
+
+def compare(
+    results: Dict[str, float], baseline: Dict[str, float], threshold: float
+) -> List[str]:
+    """Keys of the cases that got slower than `baseline` by more than `threshold`"""
+    regressions = []
+    for key, time in results.items():
+        if key not in baseline:
+            continue
+        change = time / baseline[key] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print(f'{key:<36} {change:+8.1%}{flag}')
+    return regressions
+
+
+def main() -> None:
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100_000])
+    parser.add_argument('--cases', nargs='+', choices=CASES, default=list(CASES))
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='Save the results to this JSON file')
+    parser.add_argument('--compare', help='Compare with this saved JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1)
+    args = parser.parse_args()
+
+    setup()
+    import django
+
+    results = run(args.sizes, args.cases, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(
+                {
+                    'meta': {
+                        'date': datetime.now(timezone.utc).isoformat(),
+                        'python': platform.python_version(),
+                        'django': django.get_version(),
+                        'machine': platform.machine(),
+                    },
+                    'results': results,
+                },
+                file,
+                indent=2,
+            )
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        print(f'\nCompared with {args.compare} from {baseline["meta"]["date"]}')
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print(f'{len(regressions)} regressions over {args.threshold:.0%}')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Two tier cache for hot reads
+
+`cached` keeps computed values in a bounded LRU cache in each process, in front
+of the shared `default` cache, which is file based if `CACHE_DIR` is set so all
+workers share it. Without it the cache is off unless `HOT_CACHE_TIMEOUT` is set,
+for a single process.
+
+Values belong to namespaces, e.g. `purchases`, each with a version kept in the
+shared cache. The versions are part of the keys, `invalidate` bumps them once the
+current transaction commits, so every worker stops using the old values. Model
+signals invalidate the namespaces their rows are part of, see the `models`
+modules.
+
+Each process keeps the versions it read for `HOT_CACHE_VERSION_INTERVAL` seconds,
+so a read hitting the local cache doesn't touch the shared one. Other workers may
+serve old values for that long after a write, the worker writing sees its own
+writes right away.
+
+Only one process computes a missing value at a time, the others wait for it for
+up to `LOCK_TIMEOUT` seconds before computing it themselves.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+LOCK_TIMEOUT = 5
+LOCK_POLL = 0.05
+
+_missing = object()
+
+
+class LocalCache:
+    """Thread safe LRU cache of at most `size` entries"""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.entries: 'OrderedDict[str, Tuple[float, Any]]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, value: Any, timeout: float) -> None:
+        with self.lock:
+            self.entries[key] = (time.monotonic() + timeout, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+
+
+local = LocalCache(settings.HOT_CACHE_LOCAL_SIZE)
+local_versions = LocalCache(settings.HOT_CACHE_LOCAL_SIZE)
+
+
+def _shared():
+    return caches['default']
+
+
+def _version_key(namespace: str) -> str:
+    return f'hot:version:{namespace}'
+
+
+def versions(namespaces: Sequence[str]) -> str:
+    """Versions of `namespaces` at most `HOT_CACHE_VERSION_INTERVAL` seconds old,
+    joined for use in keys
+    """
+    keys = [_version_key(namespace) for namespace in namespaces]
+    found = {key: local_versions.get(key) for key in keys}
+    missing = [key for key, version in found.items() if version is None]
+    if missing:
+        shared = _shared()
+        found.update(shared.get_many(missing))
+        for key in missing:
+            if found[key] is None:
+                # Versions start at the current time, a lost version isn't reused
+                shared.add(key, time.time_ns(), None)
+                found[key] = shared.get(key)
+            _remember_version(key, found[key])
+    return '.'.join(str(found[key]) for key in keys)
+
+
+def _remember_version(key: str, version: int) -> None:
+    if settings.HOT_CACHE_VERSION_INTERVAL:
+        local_versions.set(key, version, settings.HOT_CACHE_VERSION_INTERVAL)
+
+
+def _bump(namespace: str) -> None:
+    shared = _shared()
+    key = _version_key(namespace)
+    try:
+        version = shared.incr(key)
+    except ValueError:
+        version = time.time_ns()
+        shared.set(key, version, None)
+    _remember_version(key, version)
+
+
+def invalidate(*namespaces: str) -> None:
+    """Drop the cached values of `namespaces` in every process, after the current
+    transaction commits
+    """
+    for namespace in namespaces:
+        transaction.on_commit(lambda namespace=namespace: _bump(namespace))
+
+
+def cached(
+    namespaces: Sequence[str],
+    key: str,
+    compute: Callable[[], Any],
+    timeout: Optional[int] = None,
+) -> Any:
+    """Value of `key` in `namespaces` from the cache, computed if missing"""
+    timeout = settings.HOT_CACHE_TIMEOUT if timeout is None else timeout
+    if not timeout:
+        return compute()
+
+    # Keys can contain anything, e.g. query strings, hash them to be valid
+    digest = hashlib.sha1(f'{key}:{versions(namespaces)}'.encode()).hexdigest()
+    key = f'hot:{digest}'
+    value = local.get(key, _missing)
+    if value is not _missing:
+        return value
+
+    shared = _shared()
+    value = shared.get(key, _missing)
+    if value is _missing:
+        value = _compute_once(key, compute, timeout)
+    local.set(key, value, timeout)
+    return value
+
+
+def _compute_once(key: str, compute: Callable[[], Any], timeout: int) -> Any:
+    """Compute and share `key`, or wait for the process already computing it"""
+    shared = _shared()
+    lock_key = f'{key}:lock'
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    locked = shared.add(lock_key, True, LOCK_TIMEOUT)
+    # The lock expires, a stuck process doesn't keep the others waiting forever
+    while not locked and time.monotonic() < deadline:
+        time.sleep(LOCK_POLL)
+        value = shared.get(key, _missing)
+        if value is not _missing:
+            return value
+        locked = shared.add(lock_key, True, LOCK_TIMEOUT)
+
+    try:
+        value = compute()
+        shared.set(key, value, timeout)
+        return value
+    finally:
+        if locked:
+            shared.delete(lock_key)
@@ -0,0 +1,10 @@
+"""Optional third party packages, each one is `None` if it isn't installed"""
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
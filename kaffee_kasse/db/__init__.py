@@ -0,0 +1,16 @@
+"""Postgres backend with connection health checks and an optional pool
+
+Use it as `ENGINE` of a database, the extra settings of which are
+
+- `HEALTH_CHECKS`: check persistent connections, kept open for `CONN_MAX_AGE`
+  seconds, still work before the first query of each request reuses them
+- `POOL_SIZE`: connections shared by the threads of each process, 0 for no
+  pool. Requests take one from the pool when they first query the database and
+  return it when they finish, `CONN_MAX_AGE` doesn't apply. Requests wait up to
+  `POOL_TIMEOUT` seconds for a connection when all are in use.
+
+Pool metrics are listed at `/api/db-pools/` and in request profiles.
+
+Migrations of large tables build indexes without locking them with the
+operations in `kaffee_kasse.db.indexes`.
+"""
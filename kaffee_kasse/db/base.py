@@ -0,0 +1,67 @@
+from typing import Optional
+
+from django.db.backends.postgresql import base
+
+from .pool import ConnectionPool, get_pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """Postgres with connection health checks and pooling, see `kaffee_kasse.db`"""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.health_check_done = False
+
+    @property
+    def pool(self) -> Optional[ConnectionPool]:
+        size = self.settings_dict.get('POOL_SIZE')
+        if not size:
+            return None
+        return get_pool(self.alias, size, self.settings_dict.get('POOL_TIMEOUT', 5))
+
+    def get_new_connection(self, conn_params):
+        pool = self.pool
+        if pool is None:
+            return super().get_new_connection(conn_params)
+        connection = pool.checkout(
+            lambda: super(DatabaseWrapper, self).get_new_connection(conn_params)
+        )
+        # Set like for new connections, which keep it while pooled
+        self.isolation_level = self.settings_dict['OPTIONS'].get(
+            'isolation_level', connection.isolation_level
+        )
+        return connection
+
+    def connect(self) -> None:
+        # New connections need no check, connecting ensures the connection too
+        self.health_check_done = True
+        super().connect()
+
+    def _close(self) -> None:
+        pool = self.pool
+        if pool is None or self.connection is None:
+            return super()._close()
+        if self.in_atomic_block:
+            # The connection is kept until the transaction is rolled back
+            pool.discard(self.connection)
+        else:
+            pool.checkin(self.connection)
+
+    def close_if_unusable_or_obsolete(self) -> None:
+        super().close_if_unusable_or_obsolete()
+        if self.connection is not None and self.pool is not None:
+            # Pooled connections are only held while handling a request
+            self.close()
+        self.health_check_done = False
+
+    def ensure_connection(self) -> None:
+        if (
+            self.connection is not None
+            and self.settings_dict.get('HEALTH_CHECKS')
+            and not self.health_check_done
+            and not self.in_atomic_block
+        ):
+            self.health_check_done = True
+            if not self.is_usable():
+                self.close()
+        super().ensure_connection()
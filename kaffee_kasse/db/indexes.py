@@ -0,0 +1,236 @@
+"""Index builds that don't lock large tables
+
+`AddIndexConcurrently` and `RemoveIndexConcurrently` build and drop indexes with
+`CREATE/DROP INDEX CONCURRENTLY` on Postgres, which doesn't block writes to the
+table while the index is built. That can't run in a transaction, migrations using
+them need `atomic = False` and should contain nothing else. Other databases build
+and drop the index as usual.
+
+A failed concurrent build, e.g. if the migration was interrupted, leaves an invalid
+index behind, which slows down writes and is never used. Running the migration
+again drops it and builds it anew. An index that is already valid is kept, so a
+migration that failed after building it can be run again.
+
+While an index is built, its phase and progress are logged to the
+`kaffee_kasse.indexes` logger every `PROGRESS_INTERVAL` seconds. Running builds
+and invalid indexes are also listed at `/api/index-builds/`.
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional
+
+from django.contrib.postgres import operations
+from django.db import DatabaseError, NotSupportedError, connections
+from django.db.models import Index
+
+logger = logging.getLogger('kaffee_kasse.indexes')
+
+PROGRESS_INTERVAL = 10
+
+VALID, INVALID = 'valid', 'invalid'
+
+
+def index_state(connection, name: str) -> Optional[str]:
+    """Whether the index `name` is valid, invalid or `None` if it doesn't exist"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT i.indisvalid FROM pg_index i '
+            'JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE c.relname = %s AND pg_table_is_visible(c.oid)',
+            [name],
+        )
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    return VALID if row[0] else INVALID
+
+
+def invalid_indexes(connection) -> List[dict]:
+    """Indexes left invalid by failed concurrent builds"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT t.relname, c.relname, pg_get_indexdef(i.indexrelid) '
+            'FROM pg_index i '
+            'JOIN pg_class c ON c.oid = i.indexrelid '
+            'JOIN pg_class t ON t.oid = i.indrelid '
+            'WHERE NOT i.indisvalid AND pg_table_is_visible(c.oid) '
+            'ORDER BY t.relname, c.relname'
+        )
+        return [
+            {'table': table, 'index': index, 'definition': definition}
+            for table, index, definition in cursor.fetchall()
+        ]
+
+
+def build_progress(connection, pid: Optional[int] = None) -> List[dict]:
+    """Progress of running index builds, only of the backend `pid` if given"""
+    sql = (
+        'SELECT p.pid, t.relname, c.relname, p.command, p.phase, '
+        'p.blocks_done, p.blocks_total, p.tuples_done, p.tuples_total '
+        'FROM pg_stat_progress_create_index p '
+        'JOIN pg_class t ON t.oid = p.relid '
+        'LEFT JOIN pg_class c ON c.oid = p.index_relid'
+    )
+    params = []
+    if pid is not None:
+        sql += ' WHERE p.pid = %s'
+        params.append(pid)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+
+    builds = []
+    for row in rows:
+        pid, table, index, command, phase = row[:5]
+        blocks_done, blocks_total, tuples_done, tuples_total = row[5:]
+        # Phases either scan blocks of the table or sort and insert tuples
+        if blocks_total:
+            progress = blocks_done / blocks_total
+        elif tuples_total:
+            progress = tuples_done / tuples_total
+        else:
+            progress = None
+        builds.append(
+            {
+                'pid': pid,
+                'table': table,
+                'index': index,
+                'command': command,
+                'phase': phase,
+                'progress': progress,
+            }
+        )
+    return builds
+
+
+class ProgressReporter(threading.Thread):
+    """Log the progress of the index build of the backend `pid` periodically,
+    on a connection of its own
+    """
+
+    def __init__(self, alias: str, pid: int, name: str) -> None:
+        super().__init__(name=f'index-progress-{name}', daemon=True)
+        self.alias = alias
+        self.pid = pid
+        self.index_name = name
+        self.stopped = threading.Event()
+
+    def run(self) -> None:
+        connection = connections[self.alias]
+        try:
+            while not self.stopped.wait(PROGRESS_INTERVAL):
+                for build in build_progress(connection, self.pid):
+                    progress = build['progress']
+                    logger.info(
+                        'Building index %s: %s%s',
+                        self.index_name,
+                        build['phase'],
+                        '' if progress is None else f', {progress:.0%}',
+                    )
+        except DatabaseError:
+            logger.exception('Reporting progress of index %s failed', self.index_name)
+        finally:
+            connection.close()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.join()
+
+
+@contextmanager
+def report_progress(connection, name: str) -> Iterator[None]:
+    """Log the progress of building the index `name` on `connection`"""
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_backend_pid()')
+        pid = cursor.fetchone()[0]
+    reporter = ProgressReporter(connection.alias, pid, name)
+    logger.info('Building index %s', name)
+    start = time.monotonic()
+    reporter.start()
+    try:
+        yield
+    finally:
+        reporter.stop()
+    logger.info('Built index %s in %.1fs', name, time.monotonic() - start)
+
+
+def build_concurrently(schema_editor, model, index: Index) -> None:
+    """Build `index` concurrently, replacing an invalid one left by a failed
+    build, see module docs
+    """
+    if schema_editor.collect_sql:
+        schema_editor.add_index(model, index, concurrently=True)
+        return
+
+    connection = schema_editor.connection
+    state = index_state(connection, index.name)
+    if state == VALID:
+        logger.info('Index %s already exists', index.name)
+        return
+    if state == INVALID:
+        logger.warning('Dropping index %s left invalid by a failed build', index.name)
+        schema_editor.remove_index(model, index, concurrently=True)
+    with report_progress(connection, index.name):
+        schema_editor.add_index(model, index, concurrently=True)
+
+
+class ConcurrentIndexMixin:
+    def concurrently(self, schema_editor) -> bool:
+        """Whether to build indexes concurrently, only Postgres can"""
+        if schema_editor.connection.vendor != 'postgresql':
+            return False
+        if schema_editor.connection.in_atomic_block:
+            raise NotSupportedError(
+                f'{self.__class__.__name__} needs a migration with `atomic = False`'
+            )
+        return True
+
+
+class AddIndexConcurrently(ConcurrentIndexMixin, operations.AddIndexConcurrently):
+    """`AddIndex` building the index concurrently on Postgres"""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        if self.concurrently(schema_editor):
+            build_concurrently(schema_editor, model, self.index)
+        else:
+            schema_editor.add_index(model, self.index)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        if self.concurrently(schema_editor):
+            schema_editor.remove_index(model, self.index, concurrently=True)
+        else:
+            schema_editor.remove_index(model, self.index)
+
+
+class RemoveIndexConcurrently(ConcurrentIndexMixin, operations.RemoveIndexConcurrently):
+    """`RemoveIndex` dropping the index concurrently on Postgres"""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        model = from_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        from_model_state = from_state.models[app_label, self.model_name_lower]
+        index = from_model_state.get_index_by_name(self.name)
+        if self.concurrently(schema_editor):
+            schema_editor.remove_index(model, index, concurrently=True)
+        else:
+            schema_editor.remove_index(model, index)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if not self.allow_migrate_model(schema_editor.connection.alias, model):
+            return
+        to_model_state = to_state.models[app_label, self.model_name_lower]
+        index = to_model_state.get_index_by_name(self.name)
+        if self.concurrently(schema_editor):
+            build_concurrently(schema_editor, model, index)
+        else:
+            schema_editor.add_index(model, index)
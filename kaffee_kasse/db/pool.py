@@ -0,0 +1,161 @@
+"""In process connection pool, see `kaffee_kasse.db`"""
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Tuple
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_UNKNOWN
+
+# Idle connections are checked before they are handed out after that many seconds
+CHECK_AFTER = 10
+
+
+class ConnectionPool:
+    """At most `size` connections, handed out to one thread at a time"""
+
+    def __init__(self, size: int, timeout: float) -> None:
+        self.size = size
+        self.timeout = timeout
+        # Connections and when they were returned, most recently returned last
+        self.idle: List[Tuple[object, float]] = []
+        self.open = 0
+        self.condition = threading.Condition()
+
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.checkout_time = 0.0
+        self.max_checkout_time = 0.0
+
+    def checkout(self, connect: Callable):
+        """An idle connection or a new one made by `connect`, waiting up to
+        `timeout` seconds for one to be returned if all are in use
+        """
+        start = time.perf_counter()
+        try:
+            return self._checkout(connect, start + self.timeout)
+        finally:
+            duration = time.perf_counter() - start
+            with self.condition:
+                self.checkouts += 1
+                self.checkout_time += duration
+                self.max_checkout_time = max(self.max_checkout_time, duration)
+
+    def _checkout(self, connect: Callable, deadline: float):
+        with self.condition:
+            if not self.idle and self.open >= self.size:
+                self.waits += 1
+            while not self.idle and self.open >= self.size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0 or not self.condition.wait(remaining):
+                    self.timeouts += 1
+                    raise psycopg2.OperationalError(
+                        f'No pooled connection was returned within {self.timeout}s'
+                    )
+
+            if self.idle:
+                connection, returned_at = self.idle.pop()
+            else:
+                connection, returned_at = None, 0.0
+                self.open += 1
+
+        if connection is not None:
+            if time.monotonic() - returned_at < CHECK_AFTER or _is_usable(connection):
+                return connection
+            # Replaced by a new connection
+            _close(connection)
+
+        try:
+            return connect()
+        except Exception:
+            with self.condition:
+                self.open -= 1
+                self.condition.notify()
+            raise
+
+    def checkin(self, connection) -> None:
+        """Return a connection, rolling back what it left open"""
+        if connection.closed:
+            self.discard(connection)
+            return
+        status = connection.info.transaction_status
+        if status == TRANSACTION_STATUS_UNKNOWN:
+            self.discard(connection)
+            return
+        if status != TRANSACTION_STATUS_IDLE:
+            try:
+                connection.rollback()
+            except psycopg2.Error:
+                self.discard(connection)
+                return
+
+        with self.condition:
+            self.idle.append((connection, time.monotonic()))
+            self.condition.notify()
+
+    def discard(self, connection) -> None:
+        """Close a connection instead of returning it"""
+        _close(connection)
+        with self.condition:
+            self.open -= 1
+            self.condition.notify()
+
+    def close_idle(self) -> None:
+        with self.condition:
+            idle, self.idle = self.idle, []
+            self.open -= len(idle)
+        for connection, _ in idle:
+            _close(connection)
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                'size': self.size,
+                'open': self.open,
+                'in_use': self.open - len(self.idle),
+                'idle': len(self.idle),
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'timeouts': self.timeouts,
+                'checkout_time': self.checkout_time,
+                'max_checkout_time': self.max_checkout_time,
+            }
+
+
+def _close(connection) -> None:
+    try:
+        connection.close()
+    except psycopg2.Error:
+        pass
+
+
+def _is_usable(connection) -> bool:
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except psycopg2.Error:
+        return False
+    return True
+
+
+# Keyed by process id and database alias, forked processes don't share the
+# connections of their parent
+_pools: Dict[Tuple[int, str], ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias: str, size: int, timeout: float) -> ConnectionPool:
+    key = (os.getpid(), alias)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(size, timeout)
+        return _pools[key]
+
+
+def pool_stats() -> Dict[str, dict]:
+    """Metrics of the pools of this process by database alias"""
+    pid = os.getpid()
+    with _pools_lock:
+        pools = {alias: pool for (key, alias), pool in _pools.items() if key == pid}
+    return {alias: pool.stats() for alias, pool in pools.items()}
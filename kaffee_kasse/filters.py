@@ -0,0 +1,243 @@
+"""Declarative query parameter filters
+
+A `FilterSet` subclass declares one `Filter` per query parameter, named like the
+parameter:
+
+    class PurchaseFilterSet(FilterSet):
+        model = Purchase
+        user = IntegerFilter()
+        date__gte = DateTimeFilter('date', 'gte')
+        order = OrderingFilter(['date'])
+
+`PurchaseFilterSet(request.query_params).filter_queryset(queryset)` then applies
+every parameter present. Values that don't parse are ignored. Integer filters
+take comma separated lists, `?user=1,2,3`.
+
+Filter and order combinations that no index of the model supports are logged or
+rejected, depending on `settings.FILTER_INDEX_POLICY`.
+"""
+import logging
+from datetime import datetime, time
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.db.models import Expression, Model, QuerySet
+from django.http import QueryDict
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.exceptions import ValidationError
+
+logger = logging.getLogger(__name__)
+
+# Lookups an index can be searched by, any other lookup has to scan
+EQUALITY_LOOKUPS = frozenset({'exact', 'in'})
+RANGE_LOOKUPS = frozenset({'gt', 'gte', 'lt', 'lte', 'range'})
+
+
+class Filter:
+    """Filters `field` by `lookup` with the value of the query parameter named
+    like the attribute the filter is assigned to
+    """
+
+    def __init__(self, field: Optional[str] = None, lookup: str = 'exact') -> None:
+        self.field = field
+        self.lookup = lookup
+
+    def __set_name__(self, owner, name: str) -> None:
+        self.param = name
+        if self.field is None:
+            self.field = name
+
+    def parse(self, value: str) -> Any:
+        """Convert the query parameter value, raise `ValueError` if it is invalid"""
+        return value
+
+    def get_lookup(self, value: Any) -> str:
+        return self.lookup
+
+    def filter(self, queryset: QuerySet, value: Any) -> QuerySet:
+        return queryset.filter(**{f'{self.field}__{self.get_lookup(value)}': value})
+
+
+class IntegerFilter(Filter):
+    max_values = 1000
+
+    def parse(self, value: str) -> Any:
+        values = [int(v) for v in value.split(',')]
+        if len(values) > self.max_values:
+            raise ValueError(f'More than {self.max_values} values')
+        return values[0] if len(values) == 1 else values
+
+    def get_lookup(self, value: Any) -> str:
+        return 'in' if isinstance(value, list) else self.lookup
+
+
+class BooleanFilter(Filter):
+    def parse(self, value: str) -> bool:
+        if value.lower() in ('true', 'false'):
+            return value.lower() == 'true'
+        return bool(int(value))
+
+
+class TextFilter(Filter):
+    def __init__(self, field: Optional[str] = None, lookup: str = 'icontains'):
+        super().__init__(field, lookup)
+
+
+class DateTimeFilter(Filter):
+    """Takes ISO 8601 datetimes, or dates meaning midnight in the current timezone"""
+
+    def parse(self, value: str) -> datetime:
+        date = parse_datetime(value)
+        if date is None:
+            day = parse_date(value)
+            if day is None:
+                raise ValueError(f'Invalid date: {value}')
+            date = datetime.combine(day, time())
+        if timezone.is_naive(date):
+            date = timezone.make_aware(date)
+        return date
+
+
+class OrderingFilter(Filter):
+    """Orders by one of `fields` or `annotations`, prefixed with `-` for
+    descending order
+
+    Orders by annotations are computed per row, they never use an index.
+    """
+
+    def __init__(
+        self, fields: Iterable[str], annotations: Optional[Dict[str, Expression]] = None
+    ) -> None:
+        super().__init__()
+        self.fields = frozenset(fields)
+        self.annotations = annotations or {}
+
+    def parse(self, value: str) -> str:
+        if value.lstrip('-') not in self.fields | set(self.annotations):
+            raise ValueError(f'Invalid order: {value}')
+        return value
+
+    def filter(self, queryset: QuerySet, value: str) -> QuerySet:
+        name = value.lstrip('-')
+        if name in self.annotations:
+            # Keep the order of equal annotations stable
+            return queryset.annotate(**{name: self.annotations[name]}).order_by(
+                value, 'pk'
+            )
+        return queryset.order_by(value)
+
+
+class FilterSet:
+    """Applies the declared `Filter`s to querysets of `model`, see module docs"""
+
+    model = Model
+    # Whether to apply `settings.FILTER_INDEX_POLICY`, only worth it for big tables
+    check_indexes = True
+    filters: Dict[str, Filter] = {}
+
+    def __init_subclass__(cls, **kwargs) -> None:
+        super().__init_subclass__(**kwargs)
+        cls.filters = {
+            name: value
+            for klass in reversed(cls.__mro__)
+            for name, value in vars(klass).items()
+            if isinstance(value, Filter)
+        }
+
+    def __init__(self, params: QueryDict) -> None:
+        self.values: Dict[str, Any] = {}
+        for name, filter_ in self.filters.items():
+            value = params.get(name)
+            if value is None:
+                continue
+            try:
+                self.values[name] = filter_.parse(value)
+            except ValueError:
+                pass
+
+    def filter_queryset(self, queryset: QuerySet) -> QuerySet:
+        if self.check_indexes:
+            self.check_index_support()
+        for name, value in self.values.items():
+            queryset = self.filters[name].filter(queryset, value)
+        return queryset
+
+    def used_fields(self) -> Tuple[Set[str], Set[str], Set[str], Optional[str]]:
+        """Fields filtered by equality, by range, by anything else and ordered by"""
+        equality, ranges, other, order = set(), set(), set(), None
+        for name, value in self.values.items():
+            filter_ = self.filters[name]
+            if isinstance(filter_, OrderingFilter):
+                field = value.lstrip('-')
+                order = field if field in filter_.fields else f'{field} (annotation)'
+            elif filter_.get_lookup(value) in EQUALITY_LOOKUPS:
+                equality.add(filter_.field)
+            elif filter_.get_lookup(value) in RANGE_LOOKUPS:
+                ranges.add(filter_.field)
+            else:
+                other.add(filter_.field)
+        return equality, ranges, other, order
+
+    def check_index_support(self) -> None:
+        equality, ranges, other, order = self.used_fields()
+        if not (equality or ranges or other or order):
+            return
+        if is_supported(model_indexes(self.model), equality, ranges, order):
+            return
+
+        message = (
+            f'No index of {self.model.__name__} supports filtering by '
+            f'{", ".join(sorted(equality | ranges | other)) or "nothing"} '
+            f'ordered by {order or "nothing"}'
+        )
+        policy = settings.FILTER_INDEX_POLICY
+        if policy == 'reject':
+            raise ValidationError({'detail': message})
+        elif policy == 'warn':
+            logger.warning(message)
+
+
+def model_indexes(model) -> List[Tuple[str, ...]]:
+    """Field names of every index of `model`, in index column order"""
+    opts = model._meta
+    indexes = [(opts.pk.name,)]
+    for field in opts.concrete_fields:
+        if field.db_index or field.unique:
+            indexes.append((field.name,))
+    for index in opts.indexes:
+        indexes.append(tuple(name.lstrip('-') for name in index.fields))
+    for fields in opts.unique_together:
+        indexes.append(tuple(fields))
+    for constraint in opts.constraints:
+        if getattr(constraint, 'fields', None):
+            indexes.append(tuple(constraint.fields))
+    return indexes
+
+
+def is_supported(
+    indexes: List[Tuple[str, ...]],
+    equality: FrozenSet[str],
+    ranges: FrozenSet[str],
+    order: Optional[str],
+) -> bool:
+    """Whether an index can find the filtered rows without scanning the table and,
+    if ordered, return them in order without sorting all of them
+    """
+    if order in equality:
+        # Rows equal in the order column need no sorting
+        order = None
+    for index in indexes:
+        prefix = 0
+        while prefix < len(index) and index[prefix] in equality:
+            prefix += 1
+        next_column = index[prefix] if prefix < len(index) else None
+
+        if order is None:
+            if prefix or next_column in ranges:
+                return True
+        elif next_column == order and ranges <= {order}:
+            # An index only on the order column scans every row when filtered
+            if prefix or not equality:
+                return True
+    return False
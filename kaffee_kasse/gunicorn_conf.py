@@ -0,0 +1,52 @@
+"""Production gunicorn settings
+
+    gunicorn -c python:kaffee_kasse.gunicorn_conf kaffee_kasse.wsgi
+
+The app is loaded and warmed up once in the master before it forks the workers,
+see `kaffee_kasse.warmup`. Each worker thread connects to the database before
+the worker accepts requests.
+"""
+import multiprocessing
+import threading
+from os import environ
+
+bind = environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+
+# Requests mostly wait on Postgres, threads overlap that without the memory of
+# more processes. `settings.GUNICORN_THREADS` reads the same variable to size
+# the concurrency limit
+workers = int(environ.get('GUNICORN_WORKERS', multiprocessing.cpu_count() + 1))
+threads = int(environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+
+preload_app = True
+
+# Restart workers now and then so leaks can't build up, jittered so they don't
+# all restart at once
+max_requests = int(environ.get('GUNICORN_MAX_REQUESTS', 2000))
+max_requests_jitter = max_requests // 10
+
+timeout = int(environ.get('GUNICORN_TIMEOUT', 30))
+keepalive = 5
+
+
+def when_ready(server) -> None:
+    from kaffee_kasse.warmup import warm_up
+
+    warm_up()
+
+
+def post_worker_init(worker) -> None:
+    """Connect every thread of the worker's pool to the database"""
+    from kaffee_kasse.warmup import open_connections
+
+    # Threads are started on demand, one waiting task per thread starts them all
+    barrier = threading.Barrier(worker.cfg.threads)
+
+    def connect() -> None:
+        barrier.wait()
+        open_connections()
+
+    futures = [worker.tpool.submit(connect) for _ in range(worker.cfg.threads)]
+    for future in futures:
+        future.result()
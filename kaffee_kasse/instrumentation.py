@@ -0,0 +1,136 @@
+"""Slow query log
+
+`SlowQueryMiddleware` times every query run while handling a request. Queries
+slower than `settings.SLOW_QUERY_MS` are logged to the `kaffee_kasse.slow_queries`
+logger as JSON, with the view that ran them, their parameters and duration.
+
+With `settings.SLOW_QUERY_EXPLAIN` enabled, the first slow occurrence of each
+query shape is run again under `EXPLAIN (ANALYZE, BUFFERS)` on Postgres and the
+plan is logged with it. Queries have the same shape if they have the same
+`fingerprint`. Only `SELECT`s are explained, explaining runs them a second time.
+"""
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from contextlib import ExitStack
+from typing import Callable, Optional, Set
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import HttpRequest, HttpResponse
+
+logger = logging.getLogger('kaffee_kasse.slow_queries')
+
+# Longer parameters are cut, they are only there to reproduce the query
+MAX_PARAM_LENGTH = 200
+# Forget explained shapes beyond that many, they are explained again
+MAX_EXPLAINED = 10000
+
+_explained: Set[str] = set()
+_explained_lock = threading.Lock()
+
+_literals = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_lists = re.compile(r'\((?:\s*%s\s*,)+\s*%s\s*\)')
+_whitespace = re.compile(r'\s+')
+
+
+def fingerprint(sql: str) -> str:
+    """Hash of `sql` with literals, placeholder lists and whitespace normalized"""
+    normalized = _literals.sub('?', sql)
+    normalized = _lists.sub('(%s, ...)', normalized)
+    normalized = _whitespace.sub(' ', normalized).strip().lower()
+    return hashlib.sha1(normalized.encode()).hexdigest()[:16]
+
+
+def _first_occurrence(shape: str) -> bool:
+    with _explained_lock:
+        if shape in _explained:
+            return False
+        if len(_explained) >= MAX_EXPLAINED:
+            _explained.clear()
+        _explained.add(shape)
+        return True
+
+
+def explain(connection, sql: str, params) -> Optional[list]:
+    """`EXPLAIN (ANALYZE, BUFFERS)` plan of a query as JSON, `None` if it can't be
+    explained
+
+    Runs on a raw cursor, bypassing execute wrappers, in a savepoint so failing
+    doesn't abort the transaction of the request.
+    """
+    in_transaction = not connection.get_autocommit()
+    with connection.connection.cursor() as cursor:
+        try:
+            if in_transaction:
+                cursor.execute('SAVEPOINT slow_query_explain')
+            cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}', params)
+            plan = cursor.fetchone()[0]
+            if in_transaction:
+                cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+            return plan
+        except Exception:
+            if in_transaction:
+                cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            logger.exception('Explaining slow query failed')
+            return None
+
+
+class SlowQueryLogger:
+    """`execute_wrapper` logging slow queries run while handling `request`"""
+
+    def __init__(self, request: HttpRequest) -> None:
+        self.request = request
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        result = execute(sql, params, many, context)
+        duration = (time.perf_counter() - start) * 1000
+        if duration >= settings.SLOW_QUERY_MS:
+            self.log(sql, params, many, context['connection'], duration)
+        return result
+
+    def log(self, sql: str, params, many: bool, connection, duration: float) -> None:
+        match = self.request.resolver_match
+        shape = fingerprint(sql)
+        entry = {
+            'view': match.view_name if match is not None else None,
+            'method': self.request.method,
+            'path': self.request.path,
+            'database': connection.alias,
+            'duration_ms': round(duration, 3),
+            'fingerprint': shape,
+            'sql': sql,
+            'params': None
+            if many or params is None
+            else [repr(param)[:MAX_PARAM_LENGTH] for param in params],
+        }
+        if (
+            settings.SLOW_QUERY_EXPLAIN
+            and not many
+            and connection.vendor == 'postgresql'
+            and sql.lstrip()[:6].upper() == 'SELECT'
+            and _first_occurrence(shape)
+        ):
+            entry['plan'] = explain(connection, sql, params)
+        logger.warning(json.dumps(entry), extra={'slow_query': entry})
+
+
+class SlowQueryMiddleware:
+    """Log slow queries of requests, see module docs"""
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        if not settings.SLOW_QUERY_MS:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        query_logger = SlowQueryLogger(request)
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(query_logger))
+            return self.get_response(request)
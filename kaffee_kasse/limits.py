@@ -0,0 +1,125 @@
+"""Adaptive concurrency limit
+
+`ConcurrencyLimitMiddleware` caps the requests a worker process handles at once,
+requests over the cap fail fast with `503 Service Unavailable` and a
+`Retry-After` header instead of queueing up on a slow database.
+
+Requests are classified as purchase writes, admin or reads. Every class may only
+use its share of the limit, see `settings.CONCURRENCY_SHARES`, but at least one
+request, so no class is shut out when the limit is small. Reads get less than
+all of it, so some capacity is always left for purchases.
+
+The limit adapts to observed latency: it shrinks by `DECREASE` when requests
+take longer than `settings.CONCURRENCY_TARGET_MS`, at most once per target
+interval, and grows by about one per limit's worth of fast requests while more
+than half of it is in use. It stays between 1 and
+`settings.CONCURRENCY_LIMIT_MAX`.
+
+The limit is per process, so it only matters with threaded or async workers. It
+starts at the number of threads of a gunicorn worker, which never handles more
+requests at once, so reads over their share are shed right away.
+"""
+import threading
+import time
+from collections import Counter
+from typing import Callable, Dict
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpRequest, HttpResponse, JsonResponse
+
+READ, WRITE, ADMIN = 'read', 'write', 'admin'
+
+# Purchases are made through these, unsafe methods on them are writes
+PURCHASE_PREFIXES = ('/api/purchases/',)
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+DECREASE = 0.9
+
+
+def route_class(request: HttpRequest) -> str:
+    path = request.path_info
+    if path.startswith('/admin/'):
+        return ADMIN
+    if request.method not in SAFE_METHODS and path.startswith(PURCHASE_PREFIXES):
+        return WRITE
+    return READ
+
+
+class AdaptiveLimiter:
+    """Concurrency limit shared by route classes, adapted to latency"""
+
+    def __init__(
+        self,
+        initial: int,
+        maximum: int,
+        target: float,
+        shares: Dict[str, float],
+    ) -> None:
+        self.limit = float(initial)
+        self.maximum = maximum
+        self.target = target
+        self.shares = shares
+        self.in_flight: Counter = Counter()
+        self.total = 0
+        self.last_decrease = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, route: str) -> bool:
+        """Admit a request of `route` class if neither its share nor the limit is
+        used up
+        """
+        with self.lock:
+            if self.total >= self.limit or self.in_flight[route] >= max(
+                1.0, self.limit * self.shares[route]
+            ):
+                return False
+            self.in_flight[route] += 1
+            self.total += 1
+            return True
+
+    def release(self, route: str, duration: float) -> None:
+        """Finish a request of `route` class that took `duration` seconds"""
+        with self.lock:
+            busy = self.total >= self.limit / 2
+            self.in_flight[route] -= 1
+            self.total -= 1
+
+            now = time.monotonic()
+            if duration > self.target:
+                if now - self.last_decrease > self.target:
+                    self.limit = max(1.0, self.limit * DECREASE)
+                    self.last_decrease = now
+            elif busy:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+
+
+class ConcurrencyLimitMiddleware:
+    """Shed requests over the adaptive concurrency limit, see module docs"""
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        if not settings.CONCURRENCY_LIMIT:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+        self.limiter = AdaptiveLimiter(
+            settings.CONCURRENCY_LIMIT,
+            settings.CONCURRENCY_LIMIT_MAX,
+            settings.CONCURRENCY_TARGET_MS / 1000,
+            settings.CONCURRENCY_SHARES,
+        )
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        route = route_class(request)
+        if not self.limiter.acquire(route):
+            response = JsonResponse(
+                {'detail': 'Too many concurrent requests, try again later.'},
+                status=503,
+            )
+            response['Retry-After'] = str(settings.CONCURRENCY_RETRY_AFTER)
+            return response
+
+        start = time.perf_counter()
+        try:
+            return self.get_response(request)
+        finally:
+            self.limiter.release(route, time.perf_counter() - start)
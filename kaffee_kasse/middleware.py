@@ -0,0 +1,159 @@
+from typing import Callable, Dict, Iterable, Iterator, Optional
+
+from django.conf import settings
+from django.contrib.auth import middleware as auth_middleware
+from django.contrib.messages import middleware as messages_middleware
+from django.contrib.sessions import middleware as sessions_middleware
+from django.http import HttpRequest, HttpResponse
+from django.middleware import clickjacking, csrf
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_sequence, compress_string
+
+from .compat import brotli
+
+
+def _accepted_encodings(header: str) -> Dict[str, float]:
+    """Parse an `Accept-Encoding` header into a mapping of encoding to quality"""
+    encodings = {}
+    for item in header.split(','):
+        name, _, params = item.partition(';')
+        name, params = name.strip().lower(), params.strip()
+        if not name:
+            continue
+        quality = 1.0
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        encodings[name] = quality
+    return encodings
+
+
+def _brotli_sequence(sequence: Iterable[bytes], quality: int) -> Iterator[bytes]:
+    compressor = brotli.Compressor(quality=quality)
+    for item in sequence:
+        chunk = compressor.process(item)
+        if chunk:
+            yield chunk
+    yield compressor.finish()
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """Compress responses with brotli or gzip, whichever the client prefers
+
+    Responses shorter than `settings.COMPRESSION_MIN_LENGTH` bytes are sent
+    uncompressed. Brotli is only offered if the `brotli` package is installed.
+    """
+
+    def choose_encoding(self, request: HttpRequest) -> Optional[str]:
+        accepted = _accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        available = ('br', 'gzip') if brotli is not None else ('gzip',)
+        wildcard = accepted.get('*', 0.0)
+
+        best, best_quality = None, 0.0
+        for encoding in available:
+            quality = accepted.get(encoding, wildcard)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def process_response(
+        self, request: HttpRequest, response: HttpResponse
+    ) -> HttpResponse:
+        if (
+            not response.streaming
+            and len(response.content) < settings.COMPRESSION_MIN_LENGTH
+        ):
+            return response
+
+        # Avoid compressing if we've already got a content-encoding
+        if response.has_header('Content-Encoding'):
+            return response
+
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        encoding = self.choose_encoding(request)
+        if encoding is None:
+            return response
+
+        quality = settings.COMPRESSION_BROTLI_QUALITY
+        if response.streaming:
+            # Compressed size isn't known until the content has been streamed
+            response.streaming_content = (
+                _brotli_sequence(response.streaming_content, quality)
+                if encoding == 'br'
+                else compress_sequence(response.streaming_content)
+            )
+            del response.headers['Content-Length']
+        else:
+            compressed_content = (
+                brotli.compress(response.content, quality=quality)
+                if encoding == 'br'
+                else compress_string(response.content)
+            )
+            # Only use the compressed content if it's actually shorter
+            if len(compressed_content) >= len(response.content):
+                return response
+            response.content = compressed_content
+            response.headers['Content-Length'] = str(len(response.content))
+
+        # Make strong ETags weak, the representation changed
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response.headers['ETag'] = 'W/' + etag
+        response.headers['Content-Encoding'] = encoding
+
+        return response
+
+
+class BrowserOnlyMixin:
+    """Skip the middleware for requests to the API
+
+    The API is authenticated with tokens only, sessions, CSRF protection, messages
+    and frame options are only needed by browsers, e.g. for the admin. Requests to
+    paths starting with one of `settings.API_PREFIXES` go straight to the next
+    middleware, unless `settings.API_FAST_LANE` is disabled.
+    """
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        super().__init__(get_response)
+        self.api_prefixes = tuple(
+            settings.API_PREFIXES if settings.API_FAST_LANE else ()
+        )
+
+    def is_api(self, request: HttpRequest) -> bool:
+        return request.path_info.startswith(self.api_prefixes)
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        if self.is_api(request):
+            return self.get_response(request)
+        return super().__call__(request)
+
+
+class SessionMiddleware(BrowserOnlyMixin, sessions_middleware.SessionMiddleware):
+    pass
+
+
+class CsrfViewMiddleware(BrowserOnlyMixin, csrf.CsrfViewMiddleware):
+    def process_view(
+        self, request: HttpRequest, callback, callback_args, callback_kwargs
+    ):
+        if self.is_api(request):
+            return None
+        return super().process_view(request, callback, callback_args, callback_kwargs)
+
+
+class AuthenticationMiddleware(
+    BrowserOnlyMixin, auth_middleware.AuthenticationMiddleware
+):
+    pass
+
+
+class MessageMiddleware(BrowserOnlyMixin, messages_middleware.MessageMiddleware):
+    pass
+
+
+class XFrameOptionsMiddleware(BrowserOnlyMixin, clickjacking.XFrameOptionsMiddleware):
+    pass
@@ -0,0 +1,44 @@
+import msgpack
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, JSONParser
+
+from .compat import orjson
+from .renderers import MessagePackRenderer
+
+
+class FastJSONParser(JSONParser):
+    """`JSONParser` using orjson if it is installed
+
+    orjson reads numbers as floats. Their shortest representation, which
+    `DecimalField` parses, is exact for up to 15 significant digits, the
+    `max_digits` of every decimal field in this project.
+    """
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        if orjson is None or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+
+        try:
+            return orjson.loads(stream.read())
+        except orjson.JSONDecodeError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
+
+
+class MessagePackParser(BaseParser):
+    """Parses MessagePack-serialized data
+
+    Decimals should be sent as strings, MessagePack floats are parsed the same
+    way `FastJSONParser` parses JSON numbers.
+    """
+
+    media_type = 'application/msgpack'
+    renderer_class = MessagePackRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        try:
+            return msgpack.unpackb(stream.read(), raw=False)
+        except (msgpack.UnpackException, ValueError) as exc:
+            raise ParseError('MessagePack parse error - %s' % str(exc))
@@ -0,0 +1,177 @@
+"""Per request profiling
+
+`ProfilingMiddleware` profiles requests by staff users sending the
+`X-Profile: 1` header and a random `settings.PROFILING_SAMPLE_RATE` fraction of
+all requests. Profiled requests are run under `cProfile` with every SQL query
+and its duration recorded. Reports are saved as JSON to `settings.PROFILING_DIR`,
+next to the raw `cProfile` stats for tools like snakeviz, and are listed at
+`/api/request-profiles/`. The id of the report is sent back in the
+`X-Profile-Id` header.
+
+Requests that aren't profiled only pay for a header lookup.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import time
+import uuid
+from contextlib import ExitStack
+from pathlib import Path
+from typing import Callable, List, Optional
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import HttpRequest, HttpResponse
+from django.utils import timezone
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.exceptions import AuthenticationFailed
+
+from .db.pool import pool_stats
+
+HEADER = 'HTTP_X_PROFILE'
+
+
+class QueryRecorder:
+    """`execute_wrapper` recording every query and its duration"""
+
+    def __init__(self) -> None:
+        self.queries: List[dict] = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append(
+                {
+                    'database': context['connection'].alias,
+                    'sql': sql,
+                    'duration': time.perf_counter() - start,
+                }
+            )
+
+
+def _is_staff(request: HttpRequest) -> bool:
+    """Whether the request is authenticated as staff, before the view did"""
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_staff:
+        return True
+    try:
+        authenticated = TokenAuthentication().authenticate(request)
+    except AuthenticationFailed:
+        return False
+    return authenticated is not None and authenticated[0].is_staff
+
+
+def report_dir() -> Path:
+    return Path(settings.PROFILING_DIR)
+
+
+def _read_report(path: Path) -> Optional[dict]:
+    """The report saved at `path`, `None` if another process pruned it"""
+    try:
+        return json.loads(path.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def list_reports() -> List[dict]:
+    """Summaries of the saved reports, newest first"""
+    summaries = []
+    for path in sorted(report_dir().glob('*.json'), reverse=True):
+        report = _read_report(path)
+        if report is None:
+            continue
+        del report['queries'], report['stats']
+        summaries.append(report)
+    return summaries
+
+
+def get_report(report_id: str) -> Optional[dict]:
+    # Ids are generated, anything else could be a path
+    if not report_id.replace('-', '').isalnum():
+        return None
+    return _read_report(report_dir() / f'{report_id}.json')
+
+
+def _save_report(
+    request: HttpRequest,
+    response: HttpResponse,
+    profiler: cProfile.Profile,
+    recorder: QueryRecorder,
+    duration: float,
+) -> str:
+    now = timezone.now()
+    report_id = f'{now:%Y%m%d-%H%M%S-%f}-{uuid.uuid4().hex[:8]}'
+    directory = report_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+
+    stats_file = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stats_file)
+    stats.sort_stats('cumulative').print_stats(50)
+    stats.dump_stats(directory / f'{report_id}.prof')
+
+    user = getattr(request, 'user', None)
+    report = {
+        'id': report_id,
+        'date': now.isoformat(),
+        'method': request.method,
+        'path': request.get_full_path(),
+        'status': response.status_code,
+        'user': user.username if user is not None else None,
+        'duration': duration,
+        'query_count': len(recorder.queries),
+        'query_duration': sum(query['duration'] for query in recorder.queries),
+        'queries': recorder.queries,
+        'db_pools': pool_stats(),
+        'stats': stats_file.getvalue(),
+    }
+    # Written aside and renamed, so reports are never read half written
+    temporary = directory / f'{report_id}.json.tmp'
+    temporary.write_text(json.dumps(report))
+    os.replace(temporary, directory / f'{report_id}.json')
+
+    # Keep only the newest reports, other processes may be pruning them too
+    for path in sorted(directory.glob('*.json'), reverse=True)[
+        settings.PROFILING_KEEP :
+    ]:
+        path.unlink(missing_ok=True)
+        path.with_suffix('.prof').unlink(missing_ok=True)
+    return report_id
+
+
+class ProfilingMiddleware:
+    """Profile requests by staff sending `X-Profile: 1` and a sample of all
+    requests, see module docs
+    """
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        if not settings.PROFILING:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        requested = request.META.get(HEADER) == '1'
+        sampled = (
+            settings.PROFILING_SAMPLE_RATE
+            and random.random() < settings.PROFILING_SAMPLE_RATE
+        )
+        if not (sampled or requested and _is_staff(request)):
+            return self.get_response(request)
+
+        profiler, recorder = cProfile.Profile(), QueryRecorder()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            start = time.perf_counter()
+            response = profiler.runcall(self.get_response, request)
+            duration = time.perf_counter() - start
+
+        response['X-Profile-Id'] = _save_report(
+            request, response, profiler, recorder, duration
+        )
+        return response
@@ -9,6 +9,7 @@ https://docs.djangoproject.com/en/3.2/topics/settings/
 For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
+from decimal import Decimal
 from os import environ
 from pathlib import Path
 
@@ -45,18 +46,32 @@ INSTALLED_APPS = [
     'rest_framework.authtoken',
     'users',
     'purchases',
+    'sync',
+    'statements',
+    'tasks',
 ]
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    'kaffee_kasse.limits.ConcurrencyLimitMiddleware',
+    'kaffee_kasse.middleware.CompressionMiddleware',
+    'kaffee_kasse.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'kaffee_kasse.middleware.CsrfViewMiddleware',
+    'kaffee_kasse.middleware.AuthenticationMiddleware',
+    'kaffee_kasse.profiling.ProfilingMiddleware',
+    'kaffee_kasse.instrumentation.SlowQueryMiddleware',
+    'kaffee_kasse.middleware.MessageMiddleware',
+    'kaffee_kasse.middleware.XFrameOptionsMiddleware',
 ]
 
+# The token authenticated API, the browser only middleware in
+# `kaffee_kasse.middleware` is skipped for paths starting with these if
+# `API_FAST_LANE` is enabled
+API_PREFIXES = ['/api/', '/api-token-auth/']
+
+API_FAST_LANE = bool(int(environ.get('API_FAST_LANE', 1)))
+
 ROOT_URLCONF = 'kaffee_kasse.urls'
 
 TEMPLATES = [
@@ -88,14 +103,24 @@ WSGI_APPLICATION = 'kaffee_kasse.wsgi.application'
 #     }
 # }
 
+# Postgres with health checks and an optional connection pool, see
+# `kaffee_kasse.db`
+
 DATABASES = {
     'default': {
         'HOST': 'postgresdb',
-        'ENGINE': 'django.db.backends.postgresql',
+        'ENGINE': 'kaffee_kasse.db',
         'NAME': 'postgres',
         'USER': 'postgres',
         'PASSWORD': 'pw',
         'PORT': '5432',
+        # Seconds connections are kept open for later requests, 0 to close them
+        # after every request
+        'CONN_MAX_AGE': int(environ.get('DB_CONN_MAX_AGE', 60)),
+        'HEALTH_CHECKS': bool(int(environ.get('DB_HEALTH_CHECKS', 1))),
+        # Connections shared by the threads of a process, 0 for no pool
+        'POOL_SIZE': int(environ.get('DB_POOL_SIZE', 0)),
+        'POOL_TIMEOUT': float(environ.get('DB_POOL_TIMEOUT', 5)),
     }
 }
 
@@ -147,5 +172,146 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.TokenAuthentication',
-    ]
+    ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'kaffee_kasse.renderers.FastJSONRenderer',
+        'kaffee_kasse.renderers.MessagePackRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'kaffee_kasse.parsers.FastJSONParser',
+        'kaffee_kasse.parsers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+    # Requests per period, see `kaffee_kasse.throttling`
+    'DEFAULT_THROTTLE_RATES': {
+        'purchase_user': environ.get('THROTTLE_PURCHASE_USER', '60/min'),
+        'purchase_ip': environ.get('THROTTLE_PURCHASE_IP', '600/min'),
+        'auth_ip': environ.get('THROTTLE_AUTH_IP', '20/min'),
+    },
+    # Proxies in front of the backend, the client ip is the address the outermost
+    # of them added to `X-Forwarded-For`. 0 ignores the header, clients can spoof
+    # it. Behind the nginx frontend it's 1, nginx has to append the client with
+    # `proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for`
+    'NUM_PROXIES': int(environ.get('NUM_PROXIES', 0)),
+    'TEST_REQUEST_RENDERER_CLASSES': [
+        'rest_framework.renderers.MultiPartRenderer',
+        'rest_framework.renderers.JSONRenderer',
+        'kaffee_kasse.renderers.MessagePackRenderer',
+    ],
+}
+
+# How far purchases may take a balance below zero, unlimited if unset
+
+CREDIT_LIMIT = Decimal(environ['CREDIT_LIMIT']) if 'CREDIT_LIMIT' in environ else None
+
+# Queue purchases and apply them in batches, see `purchases.queue`
+
+PURCHASE_WRITE_BEHIND = bool(int(environ.get('PURCHASE_WRITE_BEHIND', 0)))
+
+PURCHASE_QUEUE_BATCH_SIZE = int(environ.get('PURCHASE_QUEUE_BATCH_SIZE', 500))
+
+# Apply queued purchases within the request, for tests
+PURCHASE_QUEUE_EAGER = False
+
+# Changes younger than this aren't synced yet, so transactions that commit out of
+# order can't be skipped, see `sync.views.SyncViewSet`
+
+SYNC_SETTLE_SECONDS = float(environ.get('SYNC_SETTLE_SECONDS', 2))
+
+# What to do about filter and order queries no index supports, `warn` to log them,
+# `reject` to answer them with 400 or `ignore`, see `kaffee_kasse.filters`
+
+FILTER_INDEX_POLICY = environ.get('FILTER_INDEX_POLICY', 'warn')
+
+# Response compression, see `kaffee_kasse.middleware.CompressionMiddleware`
+
+COMPRESSION_MIN_LENGTH = int(environ.get('COMPRESSION_MIN_LENGTH', 1024))
+
+# Brotli goes up to 11, which is too slow for compressing every response
+COMPRESSION_BROTLI_QUALITY = int(environ.get('COMPRESSION_BROTLI_QUALITY', 4))
+
+# Per request profiling, see `kaffee_kasse.profiling`
+
+PROFILING = bool(int(environ.get('PROFILING', 1)))
+
+PROFILING_DIR = environ.get('PROFILING_DIR', '/tmp/kaffee-kasse-profiles')
+
+# Fraction of all requests to profile, regardless of the user
+PROFILING_SAMPLE_RATE = float(environ.get('PROFILING_SAMPLE_RATE', 0))
+
+# Number of reports to keep, older ones are deleted
+PROFILING_KEEP = int(environ.get('PROFILING_KEEP', 100))
+
+# Log queries slower than this many milliseconds, 0 to disable, see
+# `kaffee_kasse.instrumentation`
+
+SLOW_QUERY_MS = float(environ.get('SLOW_QUERY_MS', 200))
+
+# Log plans of the first slow query of each shape, runs these queries twice
+SLOW_QUERY_EXPLAIN = bool(int(environ.get('SLOW_QUERY_EXPLAIN', 0)))
+
+# Threads of each gunicorn worker, see `kaffee_kasse.gunicorn_conf`. A worker never
+# handles more requests at once
+
+GUNICORN_THREADS = int(environ.get('GUNICORN_THREADS', 4))
+
+# Initial limit of concurrent requests per worker process, 0 to disable, see
+# `kaffee_kasse.limits`. Limits above `GUNICORN_THREADS` never shed anything
+
+CONCURRENCY_LIMIT = int(environ.get('CONCURRENCY_LIMIT', GUNICORN_THREADS))
+
+CONCURRENCY_LIMIT_MAX = int(environ.get('CONCURRENCY_LIMIT_MAX', GUNICORN_THREADS))
+
+# The limit shrinks while requests take longer than this many milliseconds
+CONCURRENCY_TARGET_MS = float(environ.get('CONCURRENCY_TARGET_MS', 500))
+
+# Seconds clients are told to wait before retrying shed requests
+CONCURRENCY_RETRY_AFTER = int(environ.get('CONCURRENCY_RETRY_AFTER', 1))
+
+# Fraction of the limit each route class may use, reads leave room for purchases
+CONCURRENCY_SHARES = {'write': 1.0, 'admin': 0.25, 'read': 0.75}
+
+# Memory mapped file of the throttling token buckets, shared by every process
+# using it. Unset, each process uses its own, shared only with processes it forks
+
+THROTTLE_FILE = environ.get('THROTTLE_FILE', '')
+
+# Shared by all processes if set, otherwise every process has its own cache
+CACHE_DIR = environ.get('CACHE_DIR')
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': CACHE_DIR,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    }
+    if CACHE_DIR
+    else {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+}
+
+# Seconds hot reads stay cached, 0 to disable, see `kaffee_kasse.caching`.
+# Disabled by default without `CACHE_DIR`, writes would only invalidate the cache
+# of the worker handling them. Disabled in tests by `TEST_RUNNER`
+HOT_CACHE_TIMEOUT = int(environ.get('HOT_CACHE_TIMEOUT', 300 if CACHE_DIR else 0))
+
+# Hot reads kept in the memory of each process
+HOT_CACHE_LOCAL_SIZE = int(environ.get('HOT_CACHE_LOCAL_SIZE', 1000))
+
+# Seconds each process reuses namespace versions before checking the shared cache
+# again, writes in other workers show up this late. 0 checks on every read
+HOT_CACHE_VERSION_INTERVAL = float(environ.get('HOT_CACHE_VERSION_INTERVAL', 1))
+
+TEST_RUNNER = 'kaffee_kasse.testing.TestRunner'
+
+# Show the progress of index builds in migrations, see `kaffee_kasse.db.indexes`
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {'console': {'class': 'logging.StreamHandler'}},
+    'loggers': {
+        'kaffee_kasse.indexes': {'handlers': ['console'], 'level': 'INFO'},
+    },
 }
@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    """Run tests with the hot read cache disabled
+
+    Test data is rolled back without the signals invalidating cached reads, tests
+    of the cache enable it themselves.
+    """
+
+    def setup_test_environment(self, **kwargs) -> None:
+        super().setup_test_environment(**kwargs)
+        settings.HOT_CACHE_TIMEOUT = 0
@@ -0,0 +1,972 @@
+import gzip
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from decimal import Decimal
+from io import BytesIO
+from multiprocessing import get_all_start_methods, get_context
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import sleep
+from unittest import skipIf, skipUnless
+from unittest.mock import patch
+
+import msgpack
+import psycopg2
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.db import IntegrityError, NotSupportedError, connection, transaction
+from django.db.migrations.loader import MigrationLoader
+from django.db.models import Index
+from django.http import HttpResponse, QueryDict
+from django.test import RequestFactory, SimpleTestCase, override_settings, tag
+from django.test.utils import CaptureQueriesContext
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import ParseError, ValidationError
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APITestCase, APITransactionTestCase
+
+from purchases.filters import PurchaseFilterSet
+from purchases.models import BeverageType, Purchase
+from statements.models import Statement
+from users.models import BalanceChange, Profile
+from users.tests import token_auth
+
+from . import caching, warmup
+from .admin import EstimatedCountPaginator, estimate_count
+from .compat import brotli
+from .db import indexes
+from .db.indexes import (
+    INVALID,
+    VALID,
+    AddIndexConcurrently,
+    build_progress,
+    index_state,
+    invalid_indexes,
+    report_progress,
+)
+from .db.pool import ConnectionPool
+from .filters import is_supported, model_indexes
+from .instrumentation import fingerprint
+from .limits import AdaptiveLimiter, ConcurrencyLimitMiddleware, route_class
+from .middleware import CompressionMiddleware
+from .parsers import FastJSONParser, MessagePackParser
+from .profiling import get_report, list_reports
+from .renderers import FastJSONRenderer, MessagePackRenderer
+from .throttling import TokenBucketStore
+from .warmup import open_connections, warm_up
+
+
+class FastJSONRendererTest(SimpleTestCase):
+    def test_renders_like_json_renderer(self) -> None:
+        data = [{'id': 1, 'name': 'coffee', 'price': '2.20', 'tags': ['hot', 'ä']}]
+
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+
+    def test_decimals_are_exact(self) -> None:
+        rendered = FastJSONRenderer().render({'balance': Decimal('0.10')})
+
+        self.assertEqual(rendered, b'{"balance":"0.10"}')
+
+    def test_escapes_line_separators(self) -> None:
+        rendered = FastJSONRenderer().render({'bio': 'a\u2028b'})
+
+        self.assertEqual(rendered, b'{"bio":"a\\u2028b"}')
+
+    def test_indent(self) -> None:
+        rendered = FastJSONRenderer().render(
+            {'id': 1}, 'application/json; indent=4', {}
+        )
+
+        self.assertEqual(rendered, b'{\n    "id": 1\n}')
+
+
+class FastJSONParserTest(SimpleTestCase):
+    def test_parses_json(self) -> None:
+        data = FastJSONParser().parse(BytesIO(b'{"balance": 12.34, "bio": "hi"}'))
+
+        self.assertEqual(data, {'balance': 12.34, 'bio': 'hi'})
+        # `DecimalField` parses the string representation
+        self.assertEqual(Decimal(str(data['balance'])), Decimal('12.34'))
+
+    def test_invalid_json(self) -> None:
+        with self.assertRaises(ParseError):
+            FastJSONParser().parse(BytesIO(b'{"balance": '))
+
+
+class MessagePackTest(SimpleTestCase):
+    def test_round_trip(self) -> None:
+        data = {'id': 1, 'bio': 'hi', 'tags': ['hot'], 'is_freeloader': False}
+
+        rendered = MessagePackRenderer().render(data)
+
+        self.assertEqual(MessagePackParser().parse(BytesIO(rendered)), data)
+
+    def test_decimals_are_exact(self) -> None:
+        rendered = MessagePackRenderer().render({'balance': Decimal('0.10')})
+
+        self.assertEqual(msgpack.unpackb(rendered), {'balance': '0.10'})
+
+    def test_invalid_msgpack(self) -> None:
+        with self.assertRaises(ParseError):
+            MessagePackParser().parse(BytesIO(b'\x92\x01'))
+
+
+@override_settings(COMPRESSION_MIN_LENGTH=100)
+class CompressionMiddlewareTest(SimpleTestCase):
+    content = b'{"beverage_type":"/api/beverage-types/1/","count":3}' * 20
+
+    def get_response(self, accept_encoding: str, content: bytes = content):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=accept_encoding)
+        middleware = CompressionMiddleware(lambda request: HttpResponse(content))
+        return middleware(request)
+
+    def test_gzip(self) -> None:
+        response = self.get_response('gzip, deflate')
+
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), self.content)
+        self.assertIn('Accept-Encoding', response['Vary'])
+
+    @skipIf(brotli is None, 'brotli is not installed')
+    def test_prefers_brotli(self) -> None:
+        response = self.get_response('gzip, deflate, br')
+
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.content), self.content)
+
+    def test_respects_quality(self) -> None:
+        response = self.get_response('br;q=0, gzip;q=0.5')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+
+        response = self.get_response('gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_short_responses_arent_compressed(self) -> None:
+        response = self.get_response('gzip', b'[]')
+
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(response.content, b'[]')
+
+
+class BrowserOnlyMiddlewareTest(APITestCase):
+    def test_api_skips_browser_middleware(self) -> None:
+        user = User.objects.create_user(username='erni', password='1234')
+        with token_auth(self, Token.objects.get(user=user).key):
+            response = self.client.get('/api/purchases/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.has_header('X-Frame-Options'))
+        self.assertNotIn('Cookie', response.get('Vary', ''))
+        self.assertFalse(hasattr(response.wsgi_request, 'session'))
+
+    def test_admin_keeps_browser_middleware(self) -> None:
+        response = self.client.get('/admin/login/')
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+        self.assertIn('csrftoken', response.cookies)
+
+        self.client.handler.enforce_csrf_checks = True
+        response = self.client.post(
+            '/admin/login/', {'username': 'erni', 'password': '1234'}
+        )
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(API_FAST_LANE=False)
+    def test_disabled(self) -> None:
+        response = self.client.get('/api/')
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+
+
+class ConcurrencyLimitTest(SimpleTestCase):
+    shares = {'write': 1.0, 'admin': 0.25, 'read': 0.5}
+
+    def test_reads_leave_room_for_writes(self) -> None:
+        limiter = AdaptiveLimiter(4, 8, 0.5, self.shares)
+        self.assertTrue(limiter.acquire('read'))
+        self.assertTrue(limiter.acquire('read'))
+        self.assertFalse(limiter.acquire('read'))
+        self.assertTrue(limiter.acquire('admin'))
+        self.assertFalse(limiter.acquire('admin'))
+        self.assertTrue(limiter.acquire('write'))
+        self.assertFalse(limiter.acquire('write'))
+
+        limiter.release('read', 0.01)
+        self.assertTrue(limiter.acquire('write'))
+
+    def test_route_classes(self) -> None:
+        factory = RequestFactory()
+        for request, route in [
+            (factory.post('/api/purchases/'), 'write'),
+            (factory.get('/api/purchases/'), 'read'),
+            (factory.post('/api/sync/'), 'read'),
+            (factory.get('/admin/'), 'admin'),
+        ]:
+            with self.subTest(request.method, path=request.path):
+                self.assertEqual(route_class(request), route)
+
+    def test_small_limits_admit_every_class(self) -> None:
+        limiter = AdaptiveLimiter(1, 4, 0.5, self.shares)
+        self.assertTrue(limiter.acquire('admin'))
+
+    def test_adapts_to_latency(self) -> None:
+        limiter = AdaptiveLimiter(4, 5, 0.5, self.shares)
+        for _ in range(20):
+            for _ in range(3):
+                limiter.acquire('write')
+            for _ in range(3):
+                limiter.release('write', 0.01)
+        self.assertEqual(limiter.limit, 5)
+
+        limiter.acquire('write')
+        limiter.release('write', 1)
+        self.assertEqual(limiter.limit, 4.5)
+        # At most one decrease per target interval
+        limiter.acquire('write')
+        limiter.release('write', 1)
+        self.assertEqual(limiter.limit, 4.5)
+
+    @override_settings(CONCURRENCY_LIMIT=2, CONCURRENCY_SHARES=shares)
+    def test_sheds_requests_over_limit(self) -> None:
+        factory = RequestFactory()
+        responses = []
+
+        def get_response(request):
+            if len(responses) < 2:
+                responses.append(middleware(factory.post('/api/purchases/')))
+            return HttpResponse()
+
+        middleware = ConcurrencyLimitMiddleware(get_response)
+        self.assertEqual(middleware(factory.get('/api/users/')).status_code, 200)
+
+        # The innermost request returns first
+        shed, accepted = responses
+        self.assertEqual(accepted.status_code, 200)
+        self.assertEqual(shed.status_code, 503)
+        self.assertEqual(shed['Retry-After'], '1')
+        self.assertEqual(middleware.limiter.total, 0)
+
+    @override_settings(GUNICORN_THREADS=4, CONCURRENCY_LIMIT=4, CONCURRENCY_LIMIT_MAX=4)
+    def test_sheds_reads_at_thread_count(self) -> None:
+        factory = RequestFactory()
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def get_response(request):
+            if request.method == 'GET':
+                release.wait(5)
+            return HttpResponse()
+
+        middleware = ConcurrencyLimitMiddleware(get_response)
+        # As many requests as a worker has threads
+        with ThreadPoolExecutor(settings.GUNICORN_THREADS) as pool:
+            reads = [
+                pool.submit(middleware, factory.get('/api/users/'))
+                for _ in range(settings.GUNICORN_THREADS)
+            ]
+            shed = next(as_completed(reads)).result()
+            self.assertEqual(shed.status_code, 503)
+
+            # The thread left over takes purchases while reads are still running
+            write = pool.submit(middleware, factory.post('/api/purchases/'))
+            self.assertEqual(write.result(5).status_code, 200)
+            self.assertEqual(middleware.limiter.in_flight['read'], 3)
+
+            release.set()
+            statuses = sorted(read.result().status_code for read in reads)
+        self.assertEqual(statuses, [200, 200, 200, 503])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'the backend extends Postgres')
+class DatabaseConnectionTest(APITestCase):
+    def connect(self):
+        return psycopg2.connect(**connection.get_connection_params())
+
+    def test_pool(self) -> None:
+        pool = ConnectionPool(1, 0.01)
+        self.addCleanup(pool.close_idle)
+
+        first = pool.checkout(self.connect)
+        with self.assertRaises(psycopg2.OperationalError):
+            pool.checkout(self.connect)
+        first.cursor().execute('SELECT 1')
+        pool.checkin(first)
+
+        second = pool.checkout(self.connect)
+        self.assertIs(second, first)
+        # Left open transactions are rolled back
+        self.assertEqual(second.info.transaction_status, TRANSACTION_STATUS_IDLE)
+        pool.checkin(second)
+
+        stats = pool.stats()
+        self.assertEqual(
+            (stats['open'], stats['in_use'], stats['checkouts'], stats['timeouts']),
+            (1, 0, 3, 1),
+        )
+
+    def test_broken_connections_are_replaced(self) -> None:
+        persistent = connection.copy()
+        self.addCleanup(persistent.close)
+        persistent.ensure_connection()
+        pid = persistent.connection.get_backend_pid()
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_terminate_backend(%s)', [pid])
+        # Done at the start of every request
+        persistent.close_if_unusable_or_obsolete()
+
+        with persistent.cursor() as cursor:
+            cursor.execute('SELECT pg_backend_pid()')
+            self.assertNotEqual(cursor.fetchone()[0], pid)
+
+    def test_pool_stats(self) -> None:
+        staff = User.objects.create_superuser(username='staff', password='1234')
+        with token_auth(self, Token.objects.get(user=staff).key):
+            response = self.client.get('/api/db-pools/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'builds concurrently on Postgres')
+class ConcurrentIndexTest(APITransactionTestCase):
+    index = Index(fields=['amount'], name='purchase_amount_test_idx')
+
+    def setUp(self) -> None:
+        self.addCleanup(self.drop_index)
+        user = User.objects.create_user(username='erni', password='1234')
+        beverage_type = BeverageType.objects.create(name='Mate', price=1)
+        Purchase.objects.bulk_create(
+            Purchase(user=user, beverage_type=beverage_type, amount=1) for _ in range(2)
+        )
+
+    def drop_index(self) -> None:
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP INDEX IF EXISTS {self.index.name}')
+
+    def add_index(self) -> None:
+        operation = AddIndexConcurrently('purchase', self.index)
+        from_state = MigrationLoader(connection).project_state()
+        to_state = from_state.clone()
+        operation.state_forwards('purchases', to_state)
+        with connection.schema_editor(atomic=False) as schema_editor:
+            operation.database_forwards(
+                'purchases', schema_editor, from_state, to_state
+            )
+
+    def test_invalid_index_is_rebuilt(self) -> None:
+        # A failed concurrent build, unique with duplicate amounts
+        with self.assertRaises(IntegrityError), connection.cursor() as cursor:
+            cursor.execute(
+                f'CREATE UNIQUE INDEX CONCURRENTLY {self.index.name} '
+                'ON purchases_purchase (amount)'
+            )
+        self.assertEqual(index_state(connection, self.index.name), INVALID)
+        self.assertIn(
+            self.index.name, [index['index'] for index in invalid_indexes(connection)]
+        )
+
+        with self.assertLogs('kaffee_kasse.indexes') as logs:
+            self.add_index()
+        self.assertIn('left invalid', logs.output[0])
+        self.assertEqual(index_state(connection, self.index.name), VALID)
+        self.assertEqual(invalid_indexes(connection), [])
+
+        # Valid indexes are kept
+        with CaptureQueriesContext(connection) as queries:
+            self.add_index()
+        self.assertFalse(
+            [query for query in queries if 'INDEX CONCURRENTLY' in query['sql']]
+        )
+
+    def test_needs_non_atomic_migration(self) -> None:
+        with self.assertRaises(NotSupportedError), transaction.atomic():
+            self.add_index()
+        self.assertIsNone(index_state(connection, self.index.name))
+
+    def test_progress_is_logged(self) -> None:
+        with patch.object(indexes, 'PROGRESS_INTERVAL', 0.01):
+            with self.assertLogs('kaffee_kasse.indexes') as logs:
+                with report_progress(connection, self.index.name):
+                    # Let the reporter poll a few times, nothing is being built
+                    sleep(0.05)
+        self.assertIn('Built index', logs.output[-1])
+        self.assertEqual(build_progress(connection), [])
+
+    def test_list_builds(self) -> None:
+        staff = User.objects.create_superuser(username='staff', password='1234')
+        with token_auth(self, staff.auth_token.key):
+            response = self.client.get('/api/index-builds/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'builds': [], 'invalid': []})
+
+        user = User.objects.get(username='erni')
+        with token_auth(self, user.auth_token.key):
+            response = self.client.get('/api/index-builds/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class EstimatedCountPaginatorTest(APITestCase):
+    @classmethod
+    def setUpTestData(cls) -> None:
+        user = User.objects.create_user(username='erni', password='1234')
+        beverage_type = BeverageType.objects.create(name='Mate', price=1)
+        Purchase.objects.bulk_create(
+            Purchase(user=user, beverage_type=beverage_type, amount=1)
+            for _ in range(30)
+        )
+
+    def test_small_counts_are_exact(self) -> None:
+        paginator = EstimatedCountPaginator(Purchase.objects.order_by('pk'), 10)
+        self.assertEqual(paginator.count, 30)
+
+    @skipUnless(connection.vendor == 'postgresql', 'estimates come from Postgres')
+    def test_large_counts_are_estimated(self) -> None:
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE purchases_purchase')
+        paginator = EstimatedCountPaginator(Purchase.objects.order_by('pk'), 10)
+        paginator.exact_below = 0
+        estimate = estimate_count(Purchase.objects.all())
+        # Only the estimate, no `COUNT(*)`
+        with self.assertNumQueries(1):
+            self.assertEqual(paginator.count, estimate)
+
+    @skipUnless(connection.vendor == 'postgresql', 'estimates come from Postgres')
+    def test_filtered_counts_are_exact(self) -> None:
+        # Statistics claiming far more rows than there are
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "UPDATE pg_class SET reltuples = 1000000 "
+                "WHERE relname = 'purchases_purchase'"
+            )
+        paginator = EstimatedCountPaginator(
+            Purchase.objects.filter(amount=1).order_by('pk'), 10
+        )
+        paginator.exact_below = 0
+        self.assertEqual(paginator.count, 30)
+        self.assertEqual(paginator.num_pages, 3)
+
+
+class WarmupTest(SimpleTestCase):
+    def test_warm_up(self) -> None:
+        with self.assertLogs('kaffee_kasse.warmup'):
+            warm_up()
+
+    def test_unreachable_database_doesnt_fail_boot(self) -> None:
+        unreachable = connection.copy()
+        unreachable.settings_dict['PORT'] = '1'
+        self.addCleanup(unreachable.close)
+
+        with patch.object(warmup.connections, 'all', return_value=[unreachable]):
+            with self.assertLogs('kaffee_kasse.warmup', 'WARNING'):
+                open_connections()
+        self.assertIsNone(unreachable.connection)
+
+    @skipUnless(connection.vendor == 'postgresql', 'pooling extends Postgres')
+    def test_threads_return_pooled_connections(self) -> None:
+        threads = 4
+        pooled = []
+        # Every thread of a worker connects at once, see `gunicorn_conf`
+        barrier = threading.Barrier(threads)
+
+        def connections() -> list:
+            barrier.wait()
+            wrapper = connection.copy(alias='warmup')
+            wrapper.settings_dict.update(POOL_SIZE=2, POOL_TIMEOUT=1)
+            pooled.append(wrapper)
+            return [wrapper]
+
+        with patch.object(warmup.connections, 'all', side_effect=connections):
+            with ThreadPoolExecutor(threads) as executor:
+                for future in [
+                    executor.submit(open_connections) for _ in range(threads)
+                ]:
+                    future.result()
+        pool = pooled[0].pool
+        self.addCleanup(pool.close_idle)
+
+        stats = pool.stats()
+        self.assertEqual((stats['in_use'], stats['timeouts']), (0, 0))
+        self.assertEqual(stats['checkouts'], threads)
+
+
+class FilterSetTest(SimpleTestCase):
+    indexes = [('id',), ('user',), ('user', 'date')]
+
+    def test_equality_prefix_is_supported(self) -> None:
+        self.assertTrue(is_supported(self.indexes, {'user'}, set(), None))
+        self.assertTrue(is_supported(self.indexes, {'user'}, {'date'}, 'date'))
+        self.assertFalse(is_supported(self.indexes, {'date'}, set(), None))
+
+    def test_order_needs_index(self) -> None:
+        self.assertTrue(is_supported(self.indexes, set(), set(), 'user'))
+        self.assertFalse(is_supported(self.indexes, set(), set(), 'date'))
+        self.assertFalse(is_supported(self.indexes, set(), {'date'}, 'user'))
+
+    def test_model_indexes(self) -> None:
+        indexes = model_indexes(Purchase)
+
+        self.assertIn(('id',), indexes)
+        self.assertIn(('user',), indexes)
+
+    def test_invalid_values_are_ignored(self) -> None:
+        filter_set = PurchaseFilterSet(QueryDict('user=erni&date__gte=2021-06-01'))
+
+        self.assertEqual(list(filter_set.values), ['date__gte'])
+
+    @override_settings(FILTER_INDEX_POLICY='reject')
+    def test_reject_unsupported(self) -> None:
+        PurchaseFilterSet(QueryDict('user=1&order=-user')).check_index_support()
+        with self.assertRaises(ValidationError):
+            PurchaseFilterSet(
+                QueryDict('beverage_type=1&order=-date')
+            ).check_index_support()
+
+
+class ProfilingTest(APITestCase):
+    user: User
+    staff: User
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.user = User.objects.create_user(username='erni', password='1234')
+        cls.staff = User.objects.create_superuser(username='staff', password='1234')
+
+    def setUp(self) -> None:
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(PROFILING_DIR=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_staff_can_profile_requests(self) -> None:
+        with token_auth(self, Token.objects.get(user=self.staff).key):
+            response = self.client.get('/api/purchases/', HTTP_X_PROFILE='1')
+            report_id = response['X-Profile-Id']
+
+            response = self.client.get(f'/api/request-profiles/{report_id}/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['path'], '/api/purchases/')
+            self.assertEqual(response.data['user'], 'staff')
+            self.assertEqual(
+                response.data['query_count'], len(response.data['queries'])
+            )
+            self.assertIn('cumulative', response.data['stats'])
+
+            response = self.client.get('/api/request-profiles/')
+            self.assertEqual([report['id'] for report in response.data], [report_id])
+
+    def test_users_cant_profile_requests(self) -> None:
+        with token_auth(self, Token.objects.get(user=self.user).key):
+            response = self.client.get('/api/purchases/', HTTP_X_PROFILE='1')
+            self.assertFalse(response.has_header('X-Profile-Id'))
+
+            response = self.client.get('/api/request-profiles/')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    @override_settings(PROFILING_SAMPLE_RATE=1, PROFILING_KEEP=2)
+    def test_sampling(self) -> None:
+        with token_auth(self, Token.objects.get(user=self.user).key):
+            for _ in range(3):
+                response = self.client.get('/api/purchases/')
+                self.assertTrue(response.has_header('X-Profile-Id'))
+
+        self.assertEqual(len(list_reports()), 2)
+
+    def test_unreadable_reports_are_skipped(self) -> None:
+        with token_auth(self, Token.objects.get(user=self.staff).key):
+            report_id = self.client.get('/api/purchases/', HTTP_X_PROFILE='1')[
+                'X-Profile-Id'
+            ]
+        # Left by a process that crashed while writing it
+        (Path(settings.PROFILING_DIR) / '99999999-broken.json').write_text('{"id"')
+
+        self.assertEqual([report['id'] for report in list_reports()], [report_id])
+        self.assertIsNone(get_report('99999999-broken'))
+
+
+@override_settings(HOT_CACHE_TIMEOUT=300)
+class CachingTest(APITestCase):
+    user: User
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.user = User.objects.create_user(username='erni', password='1234')
+        cls.beverage_type = BeverageType.objects.create(name='Mate', price=1)
+
+    def setUp(self) -> None:
+        caching.local.clear()
+        caching.local_versions.clear()
+        caches['default'].clear()
+
+    def test_local_cache_is_bounded(self) -> None:
+        cache = caching.LocalCache(2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        cache.get('a')
+        cache.set('c', 3, 60)
+        self.assertEqual([cache.get(key) for key in 'abc'], [1, None, 3])
+
+    def test_counts_are_cached_until_purchases_change(self) -> None:
+        with token_auth(self, Token.objects.get(user=self.user).key):
+            self.assertEqual(self.client.get('/api/purchases/counts/').data, [])
+
+            # Bulk creation sends no signals, the cached counts are kept
+            Purchase.objects.bulk_create(
+                [Purchase(user=self.user, beverage_type=self.beverage_type, amount=1)]
+            )
+            self.assertEqual(self.client.get('/api/purchases/counts/').data, [])
+
+            with self.captureOnCommitCallbacks(execute=True):
+                Purchase.objects.create(
+                    user=self.user, beverage_type=self.beverage_type
+                )
+            response = self.client.get('/api/purchases/counts/')
+            self.assertEqual(response.data[0]['count'], 2)
+
+    def test_counts_are_invalidated_by_admin_deletes(self) -> None:
+        purchase = Purchase.objects.create(
+            user=self.user, beverage_type=self.beverage_type
+        )
+        with token_auth(self, Token.objects.get(user=self.user).key):
+            self.assertEqual(len(self.client.get('/api/purchases/counts/').data), 1)
+
+        staff = User.objects.create_superuser(username='staff', password='1234')
+        self.client.force_login(staff)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                f'/admin/purchases/purchase/{purchase.id}/delete/', {'post': 'yes'}
+            )
+        self.client.logout()
+
+        with token_auth(self, Token.objects.get(user=self.user).key):
+            self.assertEqual(self.client.get('/api/purchases/counts/').data, [])
+
+    def test_me_is_cached_until_the_user_changes(self) -> None:
+        with token_auth(self, Token.objects.get(user=self.user).key):
+            self.client.get('/api/users/me/')
+            with self.assertNumQueries(1):
+                # Only the token is looked up
+                self.client.get('/api/users/me/')
+
+            with self.captureOnCommitCallbacks(execute=True):
+                self.user.username = 'bert'
+                self.user.save()
+            response = self.client.get('/api/users/me/')
+            self.assertEqual(response.data['username'], 'bert')
+
+    def test_versions_are_checked_once_per_interval(self) -> None:
+        version = caching.versions(['purchases'])
+        # Another worker invalidates, this one notices after the interval
+        caches['default'].incr(caching._version_key('purchases'))
+        with patch.object(caches['default'], 'get_many') as get_many:
+            self.assertEqual(caching.versions(['purchases']), version)
+        get_many.assert_not_called()
+
+        with override_settings(HOT_CACHE_VERSION_INTERVAL=0):
+            caching.local_versions.clear()
+            self.assertNotEqual(caching.versions(['purchases']), version)
+
+    def test_own_invalidations_are_seen_right_away(self) -> None:
+        version = caching.versions(['purchases'])
+        caching._bump('purchases')
+        self.assertNotEqual(caching.versions(['purchases']), version)
+
+    def test_waits_for_the_process_computing_a_value(self) -> None:
+        shared = caches['default']
+        shared.add('key:lock', True)
+        threading.Timer(0.1, lambda: shared.set('key', 'computed')).start()
+
+        def compute():
+            raise AssertionError('Computed twice')
+
+        self.assertEqual(caching._compute_once('key', compute, 60), 'computed')
+
+
+class ThrottlingTest(APITestCase):
+    user: User
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.user = User.objects.create_user(username='erni', password='1234')
+        cls.beverage_type = BeverageType.objects.create(name='Mate', price=1)
+
+    def setUp(self) -> None:
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(
+            THROTTLE_FILE=f'{directory.name}/throttle',
+            REST_FRAMEWORK={
+                **settings.REST_FRAMEWORK,
+                'DEFAULT_THROTTLE_RATES': {
+                    'purchase_user': '2/min',
+                    'purchase_ip': '10/min',
+                    'auth_ip': '1/min',
+                },
+            },
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_token_bucket(self) -> None:
+        store = TokenBucketStore()
+        self.assertEqual(store.take('a', 1, 2), 0)
+        self.assertEqual(store.take('a', 1, 2), 0)
+        self.assertAlmostEqual(store.take('a', 1, 2), 1, places=2)
+        self.assertEqual(store.take('b', 1, 2), 0)
+
+    @skipUnless('fork' in get_all_start_methods(), 'processes are forked')
+    def test_shared_between_processes(self) -> None:
+        store = TokenBucketStore()
+        process = get_context('fork').Process(target=store.take, args=('a', 1, 1))
+        process.start()
+        process.join()
+        self.assertGreater(store.take('a', 1, 1), 0)
+
+    def test_purchases_are_throttled(self) -> None:
+        data = {
+            'user': f'/api/users/{self.user.id}/',
+            'beverage_type': f'/api/beverage-types/{self.beverage_type.id}/',
+        }
+        with token_auth(self, Token.objects.get(user=self.user).key):
+            for _ in range(2):
+                response = self.client.post('/api/purchases/', data)
+                self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+            response = self.client.post('/api/purchases/', data)
+            self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+            self.assertIn('Retry-After', response)
+
+            response = self.client.get('/api/purchases/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_token_auth_is_throttled(self) -> None:
+        data = {'username': 'erni', 'password': 'wrong'}
+        response = self.client.post('/api-token-auth/', data)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.post('/api-token-auth/', data)
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_forwarded_for_cant_be_spoofed(self) -> None:
+        data = {'username': 'erni', 'password': 'wrong'}
+        response = self.client.post('/api-token-auth/', data, HTTP_X_FORWARDED_FOR='a')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        # Without proxies the header is ignored
+        response = self.client.post('/api-token-auth/', data, HTTP_X_FORWARDED_FOR='b')
+        self.assertEqual(response.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+
+    def test_client_behind_proxy(self) -> None:
+        data = {'username': 'erni', 'password': 'wrong'}
+        with override_settings(
+            REST_FRAMEWORK={**settings.REST_FRAMEWORK, 'NUM_PROXIES': 1}
+        ):
+            # The proxy appends the address of the client to whatever it sent
+            for forwarded_for, expected in [
+                ('a, 10.0.0.1', status.HTTP_400_BAD_REQUEST),
+                ('b, 10.0.0.1', status.HTTP_429_TOO_MANY_REQUESTS),
+                ('10.0.0.1', status.HTTP_429_TOO_MANY_REQUESTS),
+                ('a, 10.0.0.2', status.HTTP_400_BAD_REQUEST),
+            ]:
+                response = self.client.post(
+                    '/api-token-auth/', data, HTTP_X_FORWARDED_FOR=forwarded_for
+                )
+                self.assertEqual(response.status_code, expected, forwarded_for)
+
+
+class SlowQueryLogTest(APITestCase):
+    user: User
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.user = User.objects.create_user(username='erni', password='1234')
+
+    def test_fingerprint(self) -> None:
+        self.assertEqual(
+            fingerprint('SELECT * FROM a WHERE id IN (%s, %s) AND x = 1'),
+            fingerprint('select *  from a where id in (%s, %s, %s) and x = 2'),
+        )
+        self.assertNotEqual(
+            fingerprint('SELECT * FROM a'), fingerprint('SELECT * FROM b')
+        )
+
+    @override_settings(SLOW_QUERY_MS=1e-9)
+    def test_slow_queries_are_logged(self) -> None:
+        with token_auth(self, Token.objects.get(user=self.user).key):
+            with self.assertLogs('kaffee_kasse.slow_queries') as logs:
+                self.client.get('/api/purchases/counts/')
+
+        entries = [json.loads(record.getMessage()) for record in logs.records]
+        self.assertEqual(
+            {entry['view'] for entry in entries},
+            {'purchase-counts'},
+        )
+        self.assertTrue(all(entry['duration_ms'] > 0 for entry in entries))
+        self.assertNotIn('plan', entries[0])
+
+    @override_settings(SLOW_QUERY_MS=1e-9, SLOW_QUERY_EXPLAIN=True)
+    def test_first_occurrence_is_explained(self) -> None:
+        with token_auth(self, Token.objects.get(user=self.user).key):
+            with self.assertLogs('kaffee_kasse.slow_queries') as logs:
+                self.client.get(f'/api/purchases/?user={self.user.id}&since=2021-01-01')
+                self.client.get(f'/api/purchases/?user={self.user.id}&since=2021-02-01')
+
+        entries = [
+            json.loads(record.getMessage())
+            for record in logs.records
+            if 'purchases_purchase' in record.getMessage()
+        ]
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0]['fingerprint'], entries[1]['fingerprint'])
+        self.assertIn('Plan', entries[0]['plan'][0])
+        self.assertNotIn('plan', entries[1])
+
+
+@tag('plans')
+@skipUnless(connection.vendor == 'postgresql', 'query plans are Postgres specific')
+class QueryPlanTest(APITestCase):
+    """Plans of the queries of API requests on a large dataset
+
+    Every `SELECT` a request runs is explained. It fails if it reads one of
+    `large_tables` with a sequential scan, unless the case allows it, or if its
+    estimated cost exceeds the case's budget.
+    """
+
+    users = 10000
+    purchases = 300000
+    large_tables = {
+        Purchase._meta.db_table,
+        BalanceChange._meta.db_table,
+        Statement._meta.db_table,
+    }
+    default_budget = 1000
+    staff: User
+    user: User
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.staff = User.objects.create_superuser(username='staff', password='1234')
+        with connection.cursor() as cursor:
+            # Check foreign keys while seeding, not again after every test
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+            cursor.execute(
+                f'''
+                INSERT INTO {User._meta.db_table} (password, is_superuser, username,
+                    first_name, last_name, email, is_staff, is_active, date_joined)
+                SELECT '', false, 'user' || g, '', '', '', false, true, '2020-01-01'
+                FROM generate_series(1, %s) g
+                ''',
+                [cls.users],
+            )
+            cursor.execute(
+                f'''
+                INSERT INTO {Profile._meta.db_table} (user_id, is_freeloader,
+                    balance, bio, updated_at, balance_shards)
+                SELECT id, false, 0, '', now(), 0 FROM {User._meta.db_table}
+                WHERE username LIKE 'user%%'
+                '''
+            )
+            cursor.execute(
+                f'''
+                INSERT INTO {BeverageType._meta.db_table} (name, price, updated_at)
+                SELECT 'beverage' || g, 1, now() FROM generate_series(1, 10) g
+                '''
+            )
+            cursor.execute(
+                f'''
+                INSERT INTO {Purchase._meta.db_table} (beverage_type_id, user_id,
+                    date, updated_at, amount)
+                SELECT types.first + g %% 10, users.first + g %% %s,
+                    now() - g * interval '1 minute', now() - g * interval '1 second', 1
+                FROM generate_series(1, %s) g,
+                    (SELECT min(id) AS first FROM {BeverageType._meta.db_table}) types,
+                    (SELECT min(id) AS first FROM {User._meta.db_table}
+                        WHERE username LIKE 'user%%') users
+                ''',
+                [cls.users, cls.purchases],
+            )
+            cursor.execute(
+                f'''
+                INSERT INTO {BalanceChange._meta.db_table} (profile_id, amount,
+                    kind, date)
+                SELECT id, 10, 'top_up', now() - month * interval '1 month'
+                FROM {Profile._meta.db_table}, generate_series(1, 6) month
+                '''
+            )
+            cursor.execute(
+                f'''
+                INSERT INTO {Statement._meta.db_table} (profile_id, month,
+                    opening_balance, purchase_count, purchase_amount, top_ups,
+                    adjustments, closing_balance, created_at)
+                SELECT id, date_trunc('month', now()) - month * interval '1 month',
+                    0, 0, 0, 0, 0, 0, now()
+                FROM {Profile._meta.db_table}, generate_series(1, 6) month
+                '''
+            )
+            cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+            cursor.execute('ANALYZE')
+        cls.user = User.objects.get(username='user1')
+
+    def scans(self, plan: dict):
+        yield plan
+        for child in plan.get('Plans', []):
+            yield from self.scans(child)
+
+    def assertGoodPlans(
+        self, path: str, allow_seq_scan: bool = False, budget: float = None
+    ) -> None:
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        for query in queries:
+            if not query['sql'].startswith('SELECT'):
+                continue
+            with connection.cursor() as cursor:
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {query["sql"]}')
+                plan = cursor.fetchone()[0][0]['Plan']
+
+            self.assertLessEqual(
+                plan['Total Cost'], budget or self.default_budget, query['sql']
+            )
+            if not allow_seq_scan:
+                seq_scans = [
+                    node['Relation Name']
+                    for node in self.scans(plan)
+                    if node['Node Type'] == 'Seq Scan'
+                ]
+                self.assertFalse(self.large_tables & set(seq_scans), query['sql'])
+
+    def test_purchases(self) -> None:
+        with token_auth(self, Token.objects.get(user=self.staff).key):
+            user_id = self.user.id
+            purchase_id = Purchase.objects.filter(user=self.user).first().id
+            for path in [
+                f'/api/purchases/?user={user_id}',
+                f'/api/purchases/?user={user_id}&order=-date',
+                f'/api/purchases/?user={user_id},{user_id + 1}&order=date',
+                f'/api/purchases/?user={user_id}&since=2021-01-01&until=2021-02-01',
+                f'/api/purchases/counts/?user={user_id}&since=2021-01-01',
+                f'/api/purchases/spend/?user={user_id}&since=2021-01-01',
+                f'/api/purchases/{purchase_id}/',
+            ]:
+                with self.subTest(path):
+                    self.assertGoodPlans(path)
+
+    def test_users_and_profiles(self) -> None:
+        with token_auth(self, Token.objects.get(user=self.staff).key):
+            profile_id = self.user.profile.id
+            for path in [
+                f'/api/users/?id={self.user.id}',
+                f'/api/profiles/?user={self.user.id}',
+                f'/api/profiles/{profile_id}/',
+                f'/api/profiles/{profile_id}/statements/',
+                '/api/sync/?limit=100',
+            ]:
+                with self.subTest(path):
+                    self.assertGoodPlans(path)
+
+    def test_purchase_count_order(self) -> None:
+        # Counting the purchases of every user has to read all of them
+        with token_auth(self, Token.objects.get(user=self.staff).key):
+            self.assertGoodPlans(
+                '/api/users/?order=-purchases', allow_seq_scan=True, budget=100000
+            )
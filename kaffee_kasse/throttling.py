@@ -0,0 +1,188 @@
+"""Token bucket throttling in shared memory
+
+Buckets live in a memory mapped file shared by all worker processes, so a
+throttle decision costs a hash, a file lock and a few bytes of memory access
+instead of a cache or database round trip. The file is `settings.THROTTLE_FILE`
+or, if unset, an anonymous temporary file shared with processes forked after it
+was created, e.g. by gunicorn with `preload_app`.
+
+The table has a fixed number of slots, a key is looked up in `PROBES` slots from
+its hash. If none of them is free, the least recently used one is taken over,
+its owner starts again with a full bucket.
+
+Rates are set like for DRF's throttles, in `DEFAULT_THROTTLE_RATES` by scope,
+e.g. `'purchase_user': '60/min'`. A bucket holds as many tokens as requests are
+allowed per period and is refilled continuously.
+"""
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # Windows locks byte ranges of files instead
+    fcntl = None
+    import msvcrt
+
+from django.conf import settings
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+SLOTS = 8192
+PROBES = 8
+# Key hash, tokens and time of the last update, a hash of 0 is a free slot
+SLOT = struct.Struct('=Qdd')
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def _lock(file) -> None:
+    """Lock `file` against other processes, waiting for them"""
+    if fcntl is not None:
+        fcntl.lockf(file, fcntl.LOCK_EX)
+        return
+    file.seek(0)
+    # Retries for about 10 seconds before giving up
+    msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def _unlock(file) -> None:
+    if fcntl is not None:
+        fcntl.lockf(file, fcntl.LOCK_UN)
+        return
+    file.seek(0)
+    msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class TokenBucketStore:
+    """Table of token buckets in a memory mapped file, see module docs"""
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.file = open(path, 'a+b') if path else tempfile.TemporaryFile()
+        size = SLOTS * SLOT.size
+        if os.fstat(self.file.fileno()).st_size < size:
+            os.ftruncate(self.file.fileno(), size)
+        self.memory = mmap.mmap(self.file.fileno(), size)
+        # File locks are held per process, threads need their own lock
+        self.thread_lock = threading.Lock()
+
+    def take(self, key: str, rate: float, capacity: float) -> float:
+        """Take a token from the bucket of `key`, refilled with `rate` tokens per
+        second up to `capacity`. Return 0 if there was one, otherwise the seconds
+        until there is.
+        """
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        key_hash = int.from_bytes(digest, 'little') or 1
+        first = key_hash % SLOTS
+
+        with self.thread_lock:
+            _lock(self.file)
+            try:
+                now = time.time()
+                offset, found = self._find(key_hash, first)
+                if found:
+                    _, tokens, updated = SLOT.unpack_from(self.memory, offset)
+                    tokens = min(capacity, tokens + (now - updated) * rate)
+                else:
+                    tokens = capacity
+
+                wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+                if not wait:
+                    tokens -= 1
+                SLOT.pack_into(self.memory, offset, key_hash, tokens, now)
+                return wait
+            finally:
+                _unlock(self.file)
+
+    def _find(self, key_hash: int, first: int) -> Tuple[int, bool]:
+        """Offset of the slot of `key_hash` and whether it already had one"""
+        oldest_offset, oldest = 0, float('inf')
+        for probe in range(PROBES):
+            offset = (first + probe) % SLOTS * SLOT.size
+            slot_hash, _, updated = SLOT.unpack_from(self.memory, offset)
+            if slot_hash == key_hash:
+                return offset, True
+            if slot_hash == 0:
+                return offset, False
+            if updated < oldest:
+                oldest_offset, oldest = offset, updated
+        return oldest_offset, False
+
+
+_stores: Dict[str, TokenBucketStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store() -> TokenBucketStore:
+    """The store of `settings.THROTTLE_FILE`, created on first use"""
+    path = settings.THROTTLE_FILE
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = TokenBucketStore(path)
+        return _stores[path]
+
+
+def parse_rate(rate: str) -> Tuple[float, float]:
+    """Tokens per second and capacity of a rate like `60/min`"""
+    count, period = rate.split('/')
+    return int(count) / PERIODS[period[0]], int(count)
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """Throttle requests of each key with a token bucket, rated by `scope`"""
+
+    scope: str
+
+    def __init__(self) -> None:
+        rate = api_settings.DEFAULT_THROTTLE_RATES.get(self.scope)
+        self.rate = parse_rate(rate) if rate else None
+        self.wait_time = 0.0
+
+    def get_key(self, request: Request) -> str:
+        raise NotImplementedError()
+
+    def allow_request(self, request: Request, view) -> bool:
+        if self.rate is None:
+            return True
+        self.wait_time = get_store().take(
+            f'{self.scope}:{self.get_key(request)}', *self.rate
+        )
+        return not self.wait_time
+
+    def wait(self) -> Optional[float]:
+        return self.wait_time
+
+
+class UserThrottle(TokenBucketThrottle):
+    """Throttle by user, anonymous requests by client ip"""
+
+    def get_key(self, request: Request) -> str:
+        if request.user and request.user.is_authenticated:
+            return f'user:{request.user.pk}'
+        return f'ip:{self.get_ident(request)}'
+
+
+class IPThrottle(TokenBucketThrottle):
+    """Throttle by client ip"""
+
+    def get_key(self, request: Request) -> str:
+        return f'ip:{self.get_ident(request)}'
+
+
+class PurchaseUserThrottle(UserThrottle):
+    scope = 'purchase_user'
+
+
+class PurchaseIPThrottle(IPThrottle):
+    scope = 'purchase_ip'
+
+
+class AuthIPThrottle(IPThrottle):
+    scope = 'auth_ip'
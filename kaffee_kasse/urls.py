@@ -1,10 +1,12 @@
 from django.contrib import admin
 from django.urls import include, path
-from rest_framework.authtoken.views import obtain_auth_token
 from rest_framework.routers import DefaultRouter
 
 from purchases.views import BeverageTypeViewSet, PurchaseViewSet
-from users.views import ProfileViewSet, UserViewSet
+from sync.views import SyncViewSet
+from users.views import ObtainAuthTokenView, ProfileViewSet, UserViewSet
+
+from .views import DatabasePoolViewSet, IndexBuildViewSet, RequestProfileViewSet
 
 router = DefaultRouter()
 router.register('users', UserViewSet)
@@ -14,9 +16,13 @@ router.register(
     BeverageTypeViewSet,
 )
 router.register('purchases', PurchaseViewSet)
+router.register('sync', SyncViewSet, basename='sync')
+router.register('request-profiles', RequestProfileViewSet, basename='request-profile')
+router.register('db-pools', DatabasePoolViewSet, basename='db-pool')
+router.register('index-builds', IndexBuildViewSet, basename='index-build')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include(router.urls)),
-    path('api-token-auth/', obtain_auth_token),
+    path('api-token-auth/', ObtainAuthTokenView.as_view()),
 ]
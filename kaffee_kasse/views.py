@@ -0,0 +1,54 @@
+from django.db import connection
+from rest_framework.exceptions import NotFound
+from rest_framework.permissions import IsAdminUser
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.viewsets import ViewSet
+
+from .db.indexes import build_progress, invalid_indexes
+from .db.pool import pool_stats
+from .profiling import get_report, list_reports
+
+
+class RequestProfileViewSet(ViewSet):
+    """Reports of profiled requests, see `kaffee_kasse.profiling`"""
+
+    permission_classes = [IsAdminUser]
+
+    def list(self, request: Request) -> Response:
+        return Response(list_reports())
+
+    def retrieve(self, request: Request, pk: str = None) -> Response:
+        report = get_report(pk)
+        if report is None:
+            raise NotFound()
+        return Response(report)
+
+
+class DatabasePoolViewSet(ViewSet):
+    """Metrics of the connection pools of the process handling the request, see
+    `kaffee_kasse.db`
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def list(self, request: Request) -> Response:
+        return Response(pool_stats())
+
+
+class IndexBuildViewSet(ViewSet):
+    """Running index builds and invalid indexes left by failed ones, see
+    `kaffee_kasse.db.indexes`
+    """
+
+    permission_classes = [IsAdminUser]
+
+    def list(self, request: Request) -> Response:
+        if connection.vendor != 'postgresql':
+            return Response({'builds': [], 'invalid': []})
+        return Response(
+            {
+                'builds': build_progress(connection),
+                'invalid': invalid_indexes(connection),
+            }
+        )
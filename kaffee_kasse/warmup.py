@@ -0,0 +1,82 @@
+"""Work the first requests of a process would otherwise do
+
+`warm_up` is run by the gunicorn master before it forks workers, see
+`kaffee_kasse.gunicorn_conf`, so they start with it done. `open_connections` is
+run by every worker thread before it accepts requests, as far as the databases
+are up. With pooling, that fills the pool instead.
+"""
+import logging
+import time
+from importlib import import_module
+
+from django.apps import apps
+from django.db import DatabaseError, connections
+from django.urls import get_resolver
+from django.utils import translation
+from rest_framework.serializers import Serializer
+
+from .throttling import get_store
+
+logger = logging.getLogger(__name__)
+
+# Modules of apps imported lazily, on their first use
+APP_MODULES = ('admin', 'serializers', 'views', 'filters', 'permissions')
+
+
+def _import_app_modules() -> None:
+    for app_config in apps.get_app_configs():
+        for name in APP_MODULES:
+            try:
+                import_module(f'{app_config.name}.{name}')
+            except ModuleNotFoundError as e:
+                if e.name != f'{app_config.name}.{name}':
+                    raise
+
+
+def _build_serializer_fields() -> None:
+    """Bind the fields of every serializer of a routed view, which introspects
+    their models
+    """
+    for pattern in get_resolver().url_patterns:
+        for view in getattr(pattern, 'url_patterns', [pattern]):
+            view_class = getattr(view.callback, 'cls', None)
+            serializer_class = getattr(view_class, 'serializer_class', None)
+            if serializer_class is None or not issubclass(serializer_class, Serializer):
+                continue
+            serializer_class(context={'request': None}).fields
+
+
+def warm_up() -> None:
+    """Import every app, build the URL resolver, serializer fields and the
+    throttling store, and load translations
+    """
+    start = time.perf_counter()
+    _import_app_modules()
+    get_resolver().url_patterns
+    # Populating the resolver imports every view
+    get_resolver()._populate()
+    _build_serializer_fields()
+    translation.activate(translation.get_language() or 'en-us')
+    translation.gettext('This field is required.')
+    # Created before forking, the anonymous store is shared by every worker
+    get_store()
+    logger.info('Warmed up in %.3fs', time.perf_counter() - start)
+
+
+def open_connections() -> None:
+    """Connect to every database, connections are per thread
+
+    Databases that can't be reached are left to connect on first use. Failing here
+    would stop gunicorn, not only the worker. Pooled connections are returned to
+    the pool right away, threads only hold them while handling a request.
+    """
+    for connection in connections.all():
+        try:
+            connection.ensure_connection()
+        except DatabaseError:
+            logger.warning(
+                'Connecting to database %s failed', connection.alias, exc_info=True
+            )
+            continue
+        if connection.settings_dict.get('POOL_SIZE'):
+            connection.close()
@@ -1 +1,33 @@
-# Register your models here.
+from django.contrib import admin
+
+from kaffee_kasse.admin import LargeTableAdmin
+
+from .deletion import delete_purchase
+from .models import BeverageType, Purchase
+
+
+@admin.register(BeverageType)
+class BeverageTypeAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'price', 'updated_at')
+    search_fields = ('name',)
+
+
+@admin.register(Purchase)
+class PurchaseAdmin(LargeTableAdmin):
+    list_display = ('id', 'date', 'user', 'beverage_type', 'amount')
+    list_select_related = ('user', 'beverage_type')
+    # Filtering uses the foreign key indexes, `?user__exact=1` works as well
+    list_filter = ('beverage_type',)
+    # Exact matches use the unique index on usernames
+    search_fields = ('user__username__exact',)
+
+    # Purchases are charged to balances, only the API does that
+    def has_add_permission(self, request) -> bool:
+        return False
+
+    def has_change_permission(self, request, obj=None) -> bool:
+        return False
+
+    # Purchases have no delete signal, see `purchases.deletion`
+    def delete_model(self, request, obj: Purchase) -> None:
+        delete_purchase(obj)
@@ -0,0 +1,26 @@
+"""Deleting purchases
+
+Purchases have no delete signals, they would stop cascades from users and
+beverage types from deleting them in bulk. Purchases are deleted one by one
+through `delete_purchase` instead, which does what the signals would. Cascades
+from users are handled by their signals, beverage types with purchases can't be
+deleted.
+"""
+from django.db import transaction
+
+from kaffee_kasse.caching import invalidate
+from sync.models import bury
+from users.balance import refund
+
+from .models import Purchase
+
+
+def delete_purchase(purchase: Purchase) -> None:
+    """Delete `purchase`, refund its amount, create its sync tombstone and
+    invalidate cached purchases
+    """
+    with transaction.atomic():
+        refund(purchase.user_id, purchase.amount, purchase.date)
+        bury(Purchase, [purchase.pk])
+        purchase.delete()
+        invalidate('purchases')
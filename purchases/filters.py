@@ -0,0 +1,32 @@
+from kaffee_kasse.filters import (
+    DateTimeFilter,
+    FilterSet,
+    IntegerFilter,
+    OrderingFilter,
+    TextFilter,
+)
+
+from .models import BeverageType, Purchase
+
+
+class BeverageTypeFilterSet(FilterSet):
+    model = BeverageType
+    # The catalog is a handful of rows, scanning it is cheaper than an index
+    check_indexes = False
+
+    name = TextFilter()
+
+
+class PurchaseFilterSet(FilterSet):
+    model = Purchase
+
+    user = IntegerFilter()
+    beverage_type = IntegerFilter()
+    date__gte = DateTimeFilter('date', 'gte')
+    date__gt = DateTimeFilter('date', 'gt')
+    date__lte = DateTimeFilter('date', 'lte')
+    date__lt = DateTimeFilter('date', 'lt')
+    # Half open `[since, until)` windows, so consecutive windows don't overlap
+    since = DateTimeFilter('date', 'gte')
+    until = DateTimeFilter('date', 'lt')
+    order = OrderingFilter(['user', 'date', 'beverage_type'])
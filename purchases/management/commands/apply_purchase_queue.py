@@ -0,0 +1,34 @@
+from time import sleep
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from purchases.queue import apply_batch, apply_queue
+
+
+class Command(BaseCommand):
+    help = 'Apply purchases queued in write-behind mode'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=settings.PURCHASE_QUEUE_BATCH_SIZE
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=0.5,
+            help='Seconds to wait for new purchases once the queue is empty',
+        )
+        parser.add_argument(
+            '--once', action='store_true', help='Exit once the queue is empty'
+        )
+
+    def handle(self, *args, batch_size: int, interval: float, once: bool, **options):
+        if once:
+            applied = apply_queue(batch_size)
+            self.stdout.write(f'Applied {applied} purchases')
+            return
+
+        while True:
+            if not apply_batch(batch_size):
+                sleep(interval)
@@ -0,0 +1,17 @@
+# Generated by Django 3.2 on 2026-10-19 03:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('purchases', '0003_queuedpurchase'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='purchase',
+            index=models.Index(fields=['user', 'date'], name='purchase_user_date_idx'),
+        ),
+    ]
@@ -0,0 +1,61 @@
+from django.db import migrations, models, transaction
+from django.db.models import Case, Exists, OuterRef, Subquery, Value, When
+
+BATCH_SIZE = 10000
+
+
+def backfill_amount(apps, schema_editor):
+    """Set the amount of existing purchases in batches of `BATCH_SIZE` rows, each
+    in its own transaction, so the table is never locked for long
+
+    Past prices aren't known, the current price of the beverage type is used.
+    """
+    Purchase = apps.get_model('purchases', 'Purchase')
+    BeverageType = apps.get_model('purchases', 'BeverageType')
+    Profile = apps.get_model('users', 'Profile')
+    db = schema_editor.connection.alias
+
+    amount = Case(
+        When(
+            Exists(
+                Profile.objects.filter(user_id=OuterRef('user_id'), is_freeloader=True)
+            ),
+            then=Value(0),
+        ),
+        default=Subquery(
+            BeverageType.objects.filter(id=OuterRef('beverage_type_id')).values('price')
+        ),
+        output_field=models.DecimalField(max_digits=15, decimal_places=2),
+    )
+    purchases = Purchase.objects.using(db).filter(amount__isnull=True)
+    last_id = 0
+    while True:
+        batch = list(
+            purchases.filter(id__gt=last_id)
+            .order_by('id')
+            .values_list('id', flat=True)[:BATCH_SIZE]
+        )
+        if not batch:
+            return
+        with transaction.atomic(using=db):
+            purchases.filter(id__gte=batch[0], id__lte=batch[-1]).update(amount=amount)
+        last_id = batch[-1]
+
+
+class Migration(migrations.Migration):
+    # Every batch commits on its own
+    atomic = False
+
+    dependencies = [
+        ('purchases', '0004_purchase_user_date_idx'),
+        ('users', '0003_balance_shards'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='purchase',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, max_digits=15, null=True),
+        ),
+        migrations.RunPython(backfill_amount, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('purchases', '0005_purchase_amount'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='purchase',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, max_digits=15),
+        ),
+    ]
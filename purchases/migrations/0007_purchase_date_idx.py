@@ -0,0 +1,19 @@
+from django.db import migrations, models
+
+from kaffee_kasse.db.indexes import AddIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # Builds the index without locking the table, see `kaffee_kasse.db.indexes`
+    atomic = False
+
+    dependencies = [
+        ('purchases', '0006_purchase_amount_not_null'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='purchase',
+            index=models.Index(fields=['date'], name='purchase_date_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import migrations, models
+
+from kaffee_kasse.db.indexes import AddIndexConcurrently, RemoveIndexConcurrently
+
+
+class Migration(migrations.Migration):
+    # Swaps the index without locking the table, see `kaffee_kasse.db.indexes`
+    atomic = False
+
+    dependencies = [
+        ('purchases', '0007_purchase_date_idx'),
+    ]
+
+    operations = [
+        # Built before the old one is dropped, so queries always have an index
+        AddIndexConcurrently(
+            model_name='purchase',
+            index=models.Index(
+                fields=['user', 'date'],
+                include=('beverage_type', 'amount'),
+                name='purchase_user_date_cover_idx',
+            ),
+        ),
+        RemoveIndexConcurrently(
+            model_name='purchase',
+            name='purchase_user_date_idx',
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2 on 2026-10-19 05:09
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('purchases', '0008_purchase_user_date_cover_idx'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='purchase',
+            name='beverage_type',
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.PROTECT, to='purchases.beveragetype'
+            ),
+        ),
+    ]
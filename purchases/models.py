@@ -1,20 +1,82 @@
 from django.contrib.auth.models import User
 from django.db.models import (
     CASCADE,
+    PROTECT,
     CharField,
     DateTimeField,
     DecimalField,
     ForeignKey,
+    Index,
     Model,
 )
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from kaffee_kasse.caching import invalidate
 
 
 class BeverageType(Model):
     name = CharField(max_length=150)
     price = DecimalField(max_digits=15, decimal_places=2)
+    updated_at = DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self) -> str:
+        return self.name
 
 
 class Purchase(Model):
+    # Deleting purchases refunds them, see `purchases.deletion`
+    beverage_type = ForeignKey(BeverageType, PROTECT)
+    user = ForeignKey(User, CASCADE)
+    # Not `auto_now_add`, queued purchases keep the date they were accepted at
+    date = DateTimeField(default=timezone.now)
+    # Charged to the balance, the price at the time of purchase, 0 for freeloaders
+    amount = DecimalField(max_digits=15, decimal_places=2)
+    updated_at = DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # Purchases of a user in a time window, `?user=1&since=2021-06-01`.
+            # Covers spend aggregation, it's answered by an index only scan
+            Index(
+                fields=['user', 'date'],
+                include=['beverage_type', 'amount'],
+                name='purchase_user_date_cover_idx',
+            ),
+            # Purchases of everyone in a time window or ordered by date
+            Index(fields=['date'], name='purchase_date_idx'),
+        ]
+
+    def save(self, *args, **kwargs) -> None:
+        """Snapshot the current price if no amount was charged"""
+        if self.amount is None:
+            self.amount = self.beverage_type.price
+        super().save(*args, **kwargs)
+
+
+class QueuedPurchase(Model):
+    """Purchase accepted in write-behind mode, see `purchases.queue`"""
+
     beverage_type = ForeignKey(BeverageType, CASCADE)
     user = ForeignKey(User, CASCADE)
-    date = DateTimeField(auto_now_add=True)
+    price = DecimalField(max_digits=15, decimal_places=2)
+    date = DateTimeField(default=timezone.now)
+
+
+@receiver(post_save, sender=BeverageType)
+def invalidate_beverage_types(sender, **kwargs) -> None:
+    invalidate('beverage_types')
+
+
+# Deleting users cascades to their purchases. Purchases have no delete signal,
+# direct deletes invalidate in `purchases.deletion`
+@receiver(post_delete, sender=BeverageType)
+@receiver(post_delete, sender=User)
+def invalidate_deleted(sender, **kwargs) -> None:
+    invalidate('beverage_types', 'purchases')
+
+
+@receiver(post_save, sender=Purchase)
+def invalidate_purchases(sender, **kwargs) -> None:
+    invalidate('purchases')
@@ -0,0 +1,110 @@
+"""Write-behind purchases
+
+With `settings.PURCHASE_WRITE_BEHIND` enabled, `PurchaseViewSet.create` only
+validates purchases and appends them to the `QueuedPurchase` table. `apply_queue`
+then commits them in batches, run it in the background with the
+`apply_purchase_queue` command. `settings.PURCHASE_QUEUE_EAGER` applies the queue
+within the request instead, for tests.
+"""
+from collections import defaultdict
+from decimal import Decimal
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Min, Sum
+from django.utils import timezone
+
+from kaffee_kasse.caching import invalidate
+from users.balance import CreditLimitExceeded, debit_totals, has_credit
+from users.models import Profile
+
+from .models import BeverageType, Purchase, QueuedPurchase
+
+
+def enqueue(user: User, beverage_type: BeverageType) -> QueuedPurchase:
+    """Queue a purchase, raise `CreditLimitExceeded` if the purchase and the
+    purchases queued before it would exceed the credit limit
+
+    Unlike `charge` the credit check isn't atomic, concurrently queued purchases
+    can overdraw by a few purchases.
+    """
+    if settings.CREDIT_LIMIT is not None:
+        pending = QueuedPurchase.objects.filter(user=user).aggregate(
+            total=Sum('price')
+        )['total']
+        if not has_credit(user.id, beverage_type.price, pending or Decimal(0)):
+            raise CreditLimitExceeded()
+
+    queued = QueuedPurchase.objects.create(
+        user=user, beverage_type=beverage_type, price=beverage_type.price
+    )
+    if settings.PURCHASE_QUEUE_EAGER:
+        apply_queue()
+    return queued
+
+
+def apply_batch(batch_size: Optional[int] = None) -> int:
+    """Commit up to `batch_size` queued purchases in one transaction, return how
+    many were applied
+
+    Batches are claimed with `SKIP LOCKED`, so several appliers can run at once.
+    """
+    batch_size = batch_size or settings.PURCHASE_QUEUE_BATCH_SIZE
+    with transaction.atomic():
+        queued = list(
+            QueuedPurchase.objects.select_for_update(skip_locked=True).order_by('pk')[
+                :batch_size
+            ]
+        )
+        if not queued:
+            return 0
+
+        freeloaders = set(
+            Profile.objects.filter(
+                user_id__in={purchase.user_id for purchase in queued},
+                is_freeloader=True,
+            ).values_list('user_id', flat=True)
+        )
+        Purchase.objects.bulk_create(
+            Purchase(
+                user_id=purchase.user_id,
+                beverage_type_id=purchase.beverage_type_id,
+                date=purchase.date,
+                amount=0 if purchase.user_id in freeloaders else purchase.price,
+            )
+            for purchase in queued
+        )
+
+        totals: Dict[int, Decimal] = defaultdict(Decimal)
+        for purchase in queued:
+            if purchase.user_id not in freeloaders:
+                totals[purchase.user_id] += purchase.price
+        debit_totals(totals)
+
+        QueuedPurchase.objects.filter(pk__in=[p.pk for p in queued]).delete()
+        # Bulk creation sends no signals
+        invalidate('purchases')
+    return len(queued)
+
+
+def apply_queue(batch_size: Optional[int] = None) -> int:
+    """Apply batches until the queue is empty, return how many were applied"""
+    applied = 0
+    while True:
+        count = apply_batch(batch_size)
+        if not count:
+            return applied
+        applied += count
+
+
+def queue_stats() -> dict:
+    stats = QueuedPurchase.objects.aggregate(oldest=Min('date'))
+    stats['depth'] = QueuedPurchase.objects.count()
+    stats['oldest_age'] = (
+        (timezone.now() - stats['oldest']).total_seconds()
+        if stats['oldest'] is not None
+        else None
+    )
+    return stats
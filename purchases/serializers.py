@@ -1,12 +1,30 @@
-from rest_framework.fields import IntegerField
+from django.urls import reverse
+from rest_framework.fields import (
+    DateTimeField,
+    DecimalField,
+    Field,
+    FloatField,
+    IntegerField,
+)
 from rest_framework.serializers import (
     HyperlinkedModelSerializer,
     ModelSerializer,
     Serializer,
-    URLField,
 )
 
-from .models import BeverageType, Purchase
+from .models import BeverageType, Purchase, QueuedPurchase
+
+
+class DetailURLField(Field):
+    """Relative url of the `view_name` detail view of a primary key"""
+
+    def __init__(self, view_name: str, **kwargs) -> None:
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+        self.view_name = view_name
+
+    def to_representation(self, value) -> str:
+        return reverse(self.view_name, args=[value])
 
 
 class BeverageTypeSerializer(ModelSerializer):
@@ -19,13 +37,36 @@ class BeverageTypeSerializer(ModelSerializer):
 class PurchaseSerializer(HyperlinkedModelSerializer):
     class Meta:
         model = Purchase
-        fields = ['id', 'user', 'beverage_type', 'date']
-        read_only_fields = ['id', 'date']
+        fields = ['id', 'user', 'beverage_type', 'date', 'amount']
+        read_only_fields = ['id', 'date', 'amount']
+
+
+class QueuedPurchaseSerializer(HyperlinkedModelSerializer):
+    class Meta:
+        model = QueuedPurchase
+        fields = ['user', 'beverage_type', 'date']
+        read_only_fields = fields
+
+
+class PurchaseQueueStatsSerializer(Serializer):
+    depth = IntegerField()
+    oldest = DateTimeField(allow_null=True)
+    oldest_age = FloatField(allow_null=True)
 
 
 class PurchaseCountSerializer(Serializer):
     class Meta:
         read_only_fields = ['beverage_type', 'count']
 
-    beverage_type = URLField()
+    beverage_type = DetailURLField('beveragetype-detail')
+    count = IntegerField()
+
+
+class PurchaseSpendSerializer(Serializer):
+    class Meta:
+        read_only_fields = ['user', 'beverage_type', 'count', 'amount']
+
+    user = DetailURLField('user-detail')
+    beverage_type = DetailURLField('beveragetype-detail')
     count = IntegerField()
+    amount = DecimalField(max_digits=15, decimal_places=2)
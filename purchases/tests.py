@@ -1,11 +1,19 @@
+from decimal import Decimal
+
+import msgpack
 from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from rest_framework.authtoken.models import Token
+from rest_framework.response import Response
 from rest_framework.test import APITestCase
 
 from users.tests import token_auth
 
 from .models import BeverageType, Purchase
+from .queue import apply_batch, apply_queue, queue_stats
 
 
 class PurchasesTest(APITestCase):
@@ -154,6 +162,105 @@ class PurchasesTest(APITestCase):
             new_balance = self.user1.profile.balance
             self.assertEqual(new_balance, previous_balance - self.beverage_type.price)
 
+    def test_purchases_record_charged_amount(self) -> None:
+        self.user2.profile.is_freeloader = True
+        self.user2.profile.save()
+        with token_auth(self, self.staff_token):
+            for user_uri in (self.user1_uri, self.user2_uri):
+                response = self.client.post(
+                    f'{self.api_uri}/',
+                    {'beverage_type': self.beverage_type_uri, 'user': user_uri},
+                    format='json',
+                )
+                self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+            self.assertEqual(response.data['amount'], '0.00')
+            purchase = Purchase.objects.filter(user=self.user1).latest('id')
+            self.assertEqual(purchase.amount, self.beverage_type.price)
+
+    def test_spend(self) -> None:
+        BeverageType.objects.filter(id=self.beverage_type.id).update(price='9.99')
+        Purchase.objects.create(
+            beverage_type=self.beverage_type, user=self.user1, amount='1.00'
+        )
+        with token_auth(self, self.user1_token):
+            response = self.client.get(f'{self.api_uri}/spend/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                [
+                    (spent['user'], spent['count'], spent['amount'])
+                    for spent in response.data
+                ],
+                [(self.user1_uri, 2, '3.22'), (self.user2_uri, 1, '2.22')],
+            )
+
+            response = self.client.get(
+                f'{self.api_uri}/spend/?user={self.user2.id}&since=2000-01-01'
+            )
+            self.assertEqual(
+                response.data,
+                [
+                    {
+                        'user': self.user2_uri,
+                        'beverage_type': self.beverage_type_uri,
+                        'count': 1,
+                        'amount': '2.22',
+                    }
+                ],
+            )
+
+    def test_staff_purchases_for_others_charge_their_balance(self) -> None:
+        with token_auth(self, self.staff_token):
+            self.user2.profile.refresh_from_db()
+            previous_balance = self.user2.profile.balance
+
+            response = self.client.post(
+                f'{self.api_uri}/',
+                {'beverage_type': self.beverage_type_uri, 'user': self.user2_uri},
+                format='json',
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+            self.user2.profile.refresh_from_db()
+            self.assertEqual(
+                self.user2.profile.balance,
+                previous_balance - self.beverage_type.price,
+            )
+
+    def test_credit_limit(self) -> None:
+        with token_auth(self, self.user1_token), override_settings(
+            CREDIT_LIMIT=Decimal('1.00')
+        ):
+            purchase_count = Purchase.objects.count()
+
+            response = self.client.post(
+                f'{self.api_uri}/',
+                {'beverage_type': self.beverage_type_uri, 'user': self.user1_uri},
+                format='json',
+            )
+            self.assertEqual(response.status_code, status.HTTP_402_PAYMENT_REQUIRED)
+            self.assertEqual(Purchase.objects.count(), purchase_count)
+
+    def test_msgpack(self) -> None:
+        with token_auth(self, self.user1_token):
+            response = self.client.post(
+                f'{self.api_uri}/',
+                {'beverage_type': self.beverage_type_uri, 'user': self.user1_uri},
+                format='msgpack',
+                HTTP_ACCEPT='application/msgpack',
+            )
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+            self.assertEqual(msgpack.unpackb(response.content)['user'], self.user1_uri)
+
+            response = self.client.get(
+                f'{self.api_uri}/counts/', HTTP_ACCEPT='application/msgpack'
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                msgpack.unpackb(response.content),
+                [{'beverage_type': self.beverage_type_uri, 'count': 3}],
+            )
+
     def test_user_query(self) -> None:
         with token_auth(self, self.user1_token):
             response = self.client.get(f'{self.api_uri}/?user=1')
@@ -167,6 +274,55 @@ class PurchasesTest(APITestCase):
             response = self.client.get(f'{self.api_uri}/?user=has-to-be-0-or-1')
             self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_user_list_query(self) -> None:
+        with token_auth(self, self.user1_token):
+            response = self.client.get(
+                f'{self.api_uri}/?user={self.user1.id},{self.user2.id}'
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            self.assertEqual(
+                {purchase['id'] for purchase in response.data},
+                {self.purchase1.id, self.purchase2.id},
+            )
+
+    def test_date_query(self) -> None:
+        Purchase.objects.filter(id=self.purchase1.id).update(
+            date='2021-01-01T12:00:00Z'
+        )
+        with token_auth(self, self.user1_token):
+            response = self.client.get(f'{self.api_uri}/?date__gte=2021-06-01')
+            self.assertEqual(
+                [purchase['id'] for purchase in response.data], [self.purchase2.id]
+            )
+
+            response = self.client.get(f'{self.api_uri}/?date__lt=2021-06-01')
+            self.assertEqual(
+                [purchase['id'] for purchase in response.data], [self.purchase1.id]
+            )
+
+            response = self.client.get(f'{self.api_uri}/counts/?date__lt=2021-06-01')
+            self.assertEqual(response.data[0]['count'], 1)
+
+    def test_since_until_query(self) -> None:
+        Purchase.objects.filter(id=self.purchase1.id).update(
+            date='2021-06-01T00:00:00Z'
+        )
+        Purchase.objects.create(
+            beverage_type=self.beverage_type, user=self.user1, date='2021-07-01T00:00Z'
+        )
+        window = f'user={self.user1.id}&since=2021-06-01T00:00Z&until=2021-07-01T00:00Z'
+        with token_auth(self, self.user1_token):
+            response = self.client.get(f'{self.api_uri}/?{window}')
+            self.assertEqual(
+                [purchase['id'] for purchase in response.data], [self.purchase1.id]
+            )
+
+            response = self.client.get(f'{self.api_uri}/counts/?{window}')
+            self.assertEqual(
+                response.data, [{'beverage_type': self.beverage_type_uri, 'count': 1}]
+            )
+
     def test_beverage_type_query(self) -> None:
         with token_auth(self, self.user1_token):
             response = self.client.get(f'{self.api_uri}/?beverage_type=1')
@@ -265,6 +421,13 @@ class BeverageTypesTest(APITestCase):
             # Restore beverage type
             self.beverage_type1.save()
 
+    def test_beverage_types_with_purchases_cant_be_deleted(self) -> None:
+        Purchase.objects.create(user=self.user1, beverage_type=self.beverage_type1)
+        with token_auth(self, self.staff_token):
+            response = self.client.delete(self.beverage_type_uri)
+            self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertTrue(BeverageType.objects.filter(id=self.beverage_type1.id).exists())
+
     def test_name_query(self) -> None:
         with token_auth(self, self.user1_token):
             response = self.client.get(f'{self.api_uri}/?name=coff')
@@ -272,3 +435,130 @@ class BeverageTypesTest(APITestCase):
 
             for user in response.data:
                 self.assertIn('coff', user['name'].lower())
+
+
+@override_settings(PURCHASE_WRITE_BEHIND=True)
+class PurchaseQueueTest(APITestCase):
+    api_uri = '/api/purchases'
+    user: User
+    freeloader: User
+    staff: User
+    user_token: str
+    staff_token: str
+    beverage_type: BeverageType
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.user = User.objects.create_user(username='erni', password='1234')
+        cls.freeloader = User.objects.create_user(username='ducky', password='1234')
+        cls.freeloader.profile.is_freeloader = True
+        cls.freeloader.profile.save()
+        cls.staff = User.objects.create_superuser(username='staff', password='1234')
+        cls.user_token = Token.objects.get(user=cls.user).key
+        cls.staff_token = Token.objects.get(user=cls.staff).key
+        cls.beverage_type = BeverageType.objects.create(name='coffee', price='2.20')
+
+    def post_purchase(self, user: User) -> Response:
+        return self.client.post(
+            f'{self.api_uri}/',
+            {
+                'beverage_type': f'/api/beverage-types/{self.beverage_type.id}/',
+                'user': f'/api/users/{user.id}/',
+            },
+            format='json',
+        )
+
+    def test_purchases_are_queued(self) -> None:
+        with token_auth(self, self.user_token):
+            response = self.post_purchase(self.user)
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        self.assertFalse(Purchase.objects.exists())
+        self.assertEqual(queue_stats()['depth'], 1)
+
+    def test_queue_is_applied_in_batches(self) -> None:
+        with token_auth(self, self.staff_token):
+            for user in (self.user, self.user, self.freeloader):
+                response = self.post_purchase(user)
+                self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        self.assertEqual(apply_batch(2), 2)
+        self.assertEqual(apply_queue(), 1)
+
+        self.assertEqual(Purchase.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(Purchase.objects.filter(user=self.freeloader).count(), 1)
+        self.user.profile.refresh_from_db()
+        self.assertEqual(self.user.profile.balance, Decimal('-4.40'))
+        self.freeloader.profile.refresh_from_db()
+        self.assertEqual(self.freeloader.profile.balance, 0)
+        self.assertEqual(queue_stats()['depth'], 0)
+        self.assertEqual(
+            set(Purchase.objects.values_list('user', 'amount')),
+            {(self.user.id, Decimal('2.20')), (self.freeloader.id, 0)},
+        )
+
+    @override_settings(CREDIT_LIMIT=Decimal('3.00'))
+    def test_queue_checks_credit_limit(self) -> None:
+        with token_auth(self, self.user_token):
+            response = self.post_purchase(self.user)
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+            response = self.post_purchase(self.user)
+            self.assertEqual(response.status_code, status.HTTP_402_PAYMENT_REQUIRED)
+
+        self.assertEqual(queue_stats()['depth'], 1)
+
+    @override_settings(PURCHASE_QUEUE_EAGER=True)
+    def test_eager_queue(self) -> None:
+        with token_auth(self, self.user_token):
+            response = self.post_purchase(self.user)
+            self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+
+        self.assertEqual(Purchase.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(queue_stats()['depth'], 0)
+
+    def test_only_staff_can_see_queue_stats(self) -> None:
+        with token_auth(self, self.user_token):
+            response = self.client.get(f'{self.api_uri}/queue/')
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        with token_auth(self, self.staff_token):
+            self.post_purchase(self.user)
+            response = self.client.get(f'{self.api_uri}/queue/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['depth'], 1)
+
+
+class PurchaseAdminTest(TestCase):
+    def setUp(self) -> None:
+        self.user = User.objects.create_superuser(username='staff', password='1234')
+        self.client.force_login(self.user)
+        self.beverage_type = BeverageType.objects.create(name='Mate', price=1)
+
+    def create_purchases(self, count: int) -> None:
+        Purchase.objects.bulk_create(
+            Purchase(user=self.user, beverage_type=self.beverage_type, amount=1)
+            for _ in range(count)
+        )
+
+    def get_queries(self, path: str) -> int:
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(queries)
+
+    def test_changelist_queries_dont_grow_with_rows(self) -> None:
+        path = '/admin/purchases/purchase/'
+        self.create_purchases(2)
+        queries = self.get_queries(path)
+        self.create_purchases(20)
+        self.assertEqual(self.get_queries(path), queries)
+
+    def test_filter_by_user(self) -> None:
+        self.create_purchases(2)
+        other = User.objects.create_user(username='erni', password='1234')
+        response = self.client.get(f'/admin/purchases/purchase/?user__exact={other.id}')
+        self.assertEqual(response.context['cl'].result_count, 0)
+
+        response = self.client.get('/admin/purchases/purchase/?q=staff')
+        self.assertEqual(response.context['cl'].result_count, 2)
@@ -1,23 +1,41 @@
 from typing import List
 
-from django.db.models import Count, F, QuerySet
-from django.urls import reverse
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, ProtectedError, QuerySet, Sum
 from rest_framework import status
 from rest_framework.decorators import action
+from rest_framework.exceptions import APIException
 from rest_framework.permissions import BasePermission, IsAdminUser, IsAuthenticated
 from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.throttling import BaseThrottle
 from rest_framework.viewsets import ModelViewSet
 
-from users.models import Profile
+from kaffee_kasse.caching import cached
+from kaffee_kasse.throttling import PurchaseIPThrottle, PurchaseUserThrottle
+from users.balance import charge
+
+from .deletion import delete_purchase
+from .filters import BeverageTypeFilterSet, PurchaseFilterSet
 from .models import BeverageType, Purchase
+from .queue import enqueue, queue_stats
 from .serializers import (
     BeverageTypeSerializer,
     PurchaseCountSerializer,
+    PurchaseQueueStatsSerializer,
     PurchaseSerializer,
+    PurchaseSpendSerializer,
+    QueuedPurchaseSerializer,
 )
 
 
+class BeverageTypeInUse(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'Beverage types with purchases cannot be deleted.'
+    default_code = 'beverage_type_in_use'
+
+
 class BeverageTypeViewSet(ModelViewSet):
     queryset = BeverageType.objects.all()
     serializer_class = BeverageTypeSerializer
@@ -31,72 +49,72 @@ class BeverageTypeViewSet(ModelViewSet):
             permission_classes += [IsAdminUser]
         return [permission() for permission in permission_classes]
 
+    def perform_destroy(self, instance: BeverageType) -> None:
+        try:
+            instance.delete()
+        except ProtectedError:
+            raise BeverageTypeInUse()
+
     def get_queryset(self) -> QuerySet:
         """Support `BeverageType.name` queries"""
-        queryset = super().get_queryset()
-        qp = self.request.query_params
-        name = qp.get('name', None)
+        return BeverageTypeFilterSet(self.request.query_params).filter_queryset(
+            super().get_queryset()
+        )
 
-        if name is not None:
-            queryset = queryset.filter(name__icontains=name)
-        return queryset
+    def list(self, request: Request) -> Response:
+        """Cache the catalog, see `kaffee_kasse.caching`"""
+        return Response(
+            cached(
+                ['beverage_types'],
+                f'beverage_types:{request.query_params.urlencode()}',
+                lambda: self.get_serializer(self.get_queryset(), many=True).data,
+            )
+        )
 
 
 class PurchaseViewSet(ModelViewSet):
     queryset = Purchase.objects.all()
     serializer_class = PurchaseSerializer
 
-    _orders = ('user', '-user', 'date', '-date', 'beverage_type', '-beverage_type')
-
     def get_permissions(self) -> List[BasePermission]:
-        """Allow viewing and creating to authenticated users, deletion and
-        updating only to staff
+        """Allow viewing and creating to authenticated users, deletion, updating
+        and queue stats only to staff
         """
         permission_classes = [IsAuthenticated]
-        if self.action in ('update', 'partial_update', 'destroy'):
+        if self.action in ('update', 'partial_update', 'destroy', 'queue'):
             permission_classes += [IsAdminUser]
         return [permission() for permission in permission_classes]
 
+    def get_throttles(self) -> List[BaseThrottle]:
+        """Throttle creating purchases per user and per client ip"""
+        if self.action == 'create':
+            return [PurchaseUserThrottle(), PurchaseIPThrottle()]
+        return super().get_throttles()
+
     def perform_create(self, serializer: PurchaseSerializer) -> None:
-        """Update `Profile.balance` corresponding to `Purchase.price`"""
+        """Charge `BeverageType.price` to the purchasing user's `Profile.balance` and
+        record it as `Purchase.amount`
+        """
         user, beverage_type = (
             serializer.validated_data['user'],
             serializer.validated_data['beverage_type'],
         )
-        if not user.profile.is_freeloader:
-            Profile.objects.filter(id=self.request.user.id).update(
-                balance=F('balance') - beverage_type.price
-            )
+        with transaction.atomic():
+            balance = charge(user.id, beverage_type.price)
+            serializer.save(amount=beverage_type.price if balance is not None else 0)
 
-        return super().perform_create(serializer)
+    def perform_destroy(self, instance: Purchase) -> None:
+        # Tombstones and cache invalidation, see `purchases.deletion`
+        delete_purchase(instance)
 
     def get_queryset(self) -> QuerySet:
-        """Support `Purchase.user`, `Purchase.beverage_type` and non default order queries"""
-        queryset = super().get_queryset()
-        qp = self.request.query_params
-        user_id, beverage_type_id, order = (
-            qp.get('user', None),
-            qp.get('beverage_type', None),
-            qp.get('order', None),
+        """Support `Purchase.user`, `Purchase.beverage_type`, `Purchase.date` range
+        and non default order queries, see `PurchaseFilterSet`
+        """
+        return PurchaseFilterSet(self.request.query_params).filter_queryset(
+            super().get_queryset()
         )
 
-        if user_id is not None:
-            try:
-                user_id = int(user_id)
-                queryset = queryset.filter(user=user_id)
-            except ValueError:
-                pass
-        if beverage_type_id is not None:
-            try:
-                beverage_type_id = int(beverage_type_id)
-                queryset = queryset.filter(beverage_type=beverage_type_id)
-            except ValueError:
-                pass
-        if order in self._orders:
-            queryset = queryset.order_by(order)
-
-        return queryset
-
     def get_serializer_context(self):
         """Set request to none to return relative urls for relationships"""
         return {'request': None, 'format': self.format_kwarg, 'view': self}
@@ -116,6 +134,18 @@ class PurchaseViewSet(ModelViewSet):
                 status=status.HTTP_403_FORBIDDEN,
             )
 
+        if settings.PURCHASE_WRITE_BEHIND:
+            queued = enqueue(
+                serializer.validated_data['user'],
+                serializer.validated_data['beverage_type'],
+            )
+            return Response(
+                QueuedPurchaseSerializer(
+                    queued, context=self.get_serializer_context()
+                ).data,
+                status=status.HTTP_202_ACCEPTED,
+            )
+
         self.perform_create(serializer)
         headers = self.get_success_headers(serializer.data)
         return Response(
@@ -124,37 +154,56 @@ class PurchaseViewSet(ModelViewSet):
 
     @action(detail=False, methods=['get'])
     def counts(self, request: Request) -> Response:
-        """Action for counts of each beverage type"""
-        order, user_id = request.query_params.get('order'), request.query_params.get(
-            'user'
-        )
-
+        """Action for counts of each beverage type, filtered like the purchase list"""
+        order = request.query_params.get('order')
         if order not in ('count', '-count'):
             order = 'count'
 
-        if user_id is not None:
-            try:
-                user_id = int(user_id)
-            except ValueError:
-                user_id = None
+        def count():
+            purchase_counts = (
+                self.get_queryset()
+                .values('beverage_type')
+                .annotate(count=Count('beverage_type'))
+                .order_by(order)
+            )
+            return PurchaseCountSerializer(
+                purchase_counts, many=True, context=self.get_serializer_context()
+            ).data
 
-        purchases = (
-            self.get_queryset().filter(user=user_id)
-            if user_id is not None
-            else self.get_queryset()
-        )
-        purchase_counts = list(
-            purchases.values('beverage_type')
-            .annotate(count=Count('beverage_type'))
-            .order_by(order)
+        return Response(
+            cached(
+                ['purchases'],
+                f'purchase_counts:{request.query_params.urlencode()}',
+                count,
+            )
         )
-        for purchase_count in purchase_counts:
-            purchase_count['beverage_type'] = reverse(
-                'beveragetype-detail', args=[purchase_count['beverage_type']]
+
+    @action(detail=False, methods=['get'])
+    def spend(self, request: Request) -> Response:
+        """Action for the amount spent per user and beverage type, filtered like the
+        purchase list
+        """
+
+        def spend():
+            spending = (
+                self.get_queryset()
+                .values('user', 'beverage_type')
+                .annotate(count=Count('*'), amount=Sum('amount'))
+                .order_by('user', 'beverage_type')
             )
+            return PurchaseSpendSerializer(
+                spending, many=True, context=self.get_serializer_context()
+            ).data
 
-        serializer = PurchaseCountSerializer(
-            purchase_counts, many=True, context=self.get_serializer_context()
+        return Response(
+            cached(
+                ['purchases'],
+                f'purchase_spend:{request.query_params.urlencode()}',
+                spend,
+            )
         )
 
-        return Response(serializer.data)
+    @action(detail=False, methods=['get'])
+    def queue(self, request: Request) -> Response:
+        """Action for the depth and age of the write-behind purchase queue"""
+        return Response(PurchaseQueueStatsSerializer(queue_stats()).data)
@@ -0,0 +1,160 @@
+"""Monthly statement generation
+
+`generate_month` computes the statements of every profile for one month in a few
+set based queries per range of user ids, the ranges are spread over a process
+pool. Profiles that already have a statement for the month are skipped, so it is
+safe to run repeatedly, e.g. daily with `manage.py generate_statements --interval`.
+"""
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from functools import partial
+from typing import Dict, Optional, Tuple
+
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from purchases.models import Purchase
+from users.models import BalanceChange, Profile
+from users.parallel import map_user_ranges
+
+from .models import Statement
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def next_month(month: date) -> date:
+    return (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def previous_month(month: date) -> date:
+    return (month - timedelta(days=1)).replace(day=1)
+
+
+def last_closed_month() -> date:
+    return previous_month(month_start(timezone.localdate()))
+
+
+def month_bounds(month: date) -> Tuple[datetime, datetime]:
+    """First and last moment, exclusive, of `month` in the current timezone"""
+    return tuple(
+        timezone.make_aware(datetime.combine(day, datetime.min.time()))
+        for day in (month, next_month(month))
+    )
+
+
+def _opening_balances(
+    month: date, start: datetime, profiles: Dict[int, int]
+) -> Dict[int, Decimal]:
+    """Opening balances keyed by profile id, from the statements of the previous
+    month or, where missing, the ledger and purchases before `start`
+    """
+    opening = dict(
+        Statement.objects.filter(
+            profile_id__in=profiles.values(), month=previous_month(month)
+        ).values_list('profile_id', 'closing_balance')
+    )
+    missing = {
+        user_id: profile_id
+        for user_id, profile_id in profiles.items()
+        if profile_id not in opening
+    }
+    if not missing:
+        return opening
+
+    changes = (
+        BalanceChange.objects.filter(profile_id__in=missing.values(), date__lt=start)
+        .values('profile_id')
+        .annotate(total=Sum('amount'))
+        .values_list('profile_id', 'total')
+    )
+    spent = (
+        Purchase.objects.filter(user_id__in=missing, date__lt=start)
+        .values('user_id')
+        .annotate(total=Sum('amount'))
+        .values_list('user_id', 'total')
+    )
+    for profile_id in missing.values():
+        opening[profile_id] = Decimal(0)
+    for profile_id, total in changes:
+        opening[profile_id] += total
+    for user_id, total in spent:
+        opening[missing[user_id]] -= total
+    return opening
+
+
+def generate_range(month: date, first_user: int, last_user: int) -> int:
+    """Generate the missing statements of `month` for profiles of users with ids
+    from `first_user` to `last_user`, return how many were generated
+    """
+    start, end = month_bounds(month)
+    # Keyed by user id
+    profiles = dict(
+        Profile.objects.filter(
+            user_id__gte=first_user,
+            user_id__lte=last_user,
+            user__date_joined__lt=end,
+        )
+        .exclude(statements__month=month)
+        .values_list('user_id', 'id')
+    )
+    if not profiles:
+        return 0
+
+    opening = _opening_balances(month, start, profiles)
+    purchases = {
+        user_id: (count, amount)
+        for user_id, count, amount in Purchase.objects.filter(
+            user_id__in=profiles, date__gte=start, date__lt=end
+        )
+        .values('user_id')
+        .annotate(count=Count('*'), amount=Sum('amount'))
+        .values_list('user_id', 'count', 'amount')
+    }
+    # Keyed by profile id and kind
+    changes: Dict[int, Dict[str, Decimal]] = defaultdict(dict)
+    for profile_id, kind, total in (
+        BalanceChange.objects.filter(
+            profile_id__in=profiles.values(), date__gte=start, date__lt=end
+        )
+        .values('profile_id', 'kind')
+        .annotate(total=Sum('amount'))
+        .values_list('profile_id', 'kind', 'total')
+    ):
+        changes[profile_id][kind] = total
+
+    statements = []
+    for user_id, profile_id in profiles.items():
+        count, amount = purchases.get(user_id, (0, Decimal(0)))
+        kinds = changes.get(profile_id, {})
+        top_ups = kinds.pop(BalanceChange.TOP_UP, Decimal(0))
+        adjustments = sum(kinds.values(), Decimal(0))
+        statements.append(
+            Statement(
+                profile_id=profile_id,
+                month=month,
+                opening_balance=opening[profile_id],
+                purchase_count=count,
+                purchase_amount=amount,
+                top_ups=top_ups,
+                adjustments=adjustments,
+                closing_balance=opening[profile_id] + top_ups + adjustments - amount,
+            )
+        )
+    # Statements generated concurrently for the same profiles are kept
+    Statement.objects.bulk_create(statements, ignore_conflicts=True)
+    return len(statements)
+
+
+def generate_month(month: date, workers: Optional[int] = None) -> int:
+    """Generate the missing statements of `month` for every profile in `workers`
+    processes, return how many were generated
+
+    Raises `ValueError` for months that aren't over yet.
+    """
+    month = month_start(month)
+    if month > last_closed_month():
+        raise ValueError(f'{month:%Y-%m} is not over yet')
+    return sum(map_user_ranges(partial(generate_range, month), workers))
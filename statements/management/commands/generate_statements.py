@@ -0,0 +1,42 @@
+from datetime import datetime
+from time import sleep
+
+from django.core.management.base import BaseCommand, CommandError
+
+from statements.generate import generate_month, last_closed_month
+
+
+def parse_month(value: str):
+    return datetime.strptime(value, '%Y-%m').date()
+
+
+class Command(BaseCommand):
+    help = 'Generate the monthly statements of every profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--month',
+            type=parse_month,
+            help='Month to generate, as YYYY-MM, defaults to the last finished month',
+        )
+        parser.add_argument(
+            '--workers', type=int, help='Processes to use, defaults to the CPU count'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            help='Keep running, generating the last finished month every interval '
+            'seconds',
+        )
+
+    def handle(self, *args, month, workers: int, interval: float, **options):
+        while True:
+            try:
+                generated = generate_month(month or last_closed_month(), workers)
+            except ValueError as e:
+                raise CommandError(e)
+            self.stdout.write(f'Generated {generated} statements')
+
+            if interval is None:
+                return
+            sleep(interval)
@@ -0,0 +1,61 @@
+# Generated by Django 3.2 on 2026-10-19 04:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('users', '0004_balancechange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Statement',
+            fields=[
+                (
+                    'id',
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('month', models.DateField()),
+                (
+                    'opening_balance',
+                    models.DecimalField(decimal_places=2, max_digits=15),
+                ),
+                ('purchase_count', models.PositiveIntegerField()),
+                (
+                    'purchase_amount',
+                    models.DecimalField(decimal_places=2, max_digits=15),
+                ),
+                ('top_ups', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('adjustments', models.DecimalField(decimal_places=2, max_digits=15)),
+                (
+                    'closing_balance',
+                    models.DecimalField(decimal_places=2, max_digits=15),
+                ),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                (
+                    'profile',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='statements',
+                        to='users.profile',
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='statement',
+            constraint=models.UniqueConstraint(
+                fields=('profile', 'month'), name='unique_statement'
+            ),
+        ),
+    ]
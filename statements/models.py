@@ -0,0 +1,42 @@
+from django.db.models import (
+    CASCADE,
+    DateField,
+    DateTimeField,
+    DecimalField,
+    ForeignKey,
+    Model,
+    PositiveIntegerField,
+    UniqueConstraint,
+)
+
+from users.models import Profile
+
+
+class Statement(Model):
+    """Monthly statement of a profile, generated once the month is over, see
+    `statements.generate`
+
+    Statements are never changed after they were generated. Corrections show up
+    as adjustments in the statement of the month they were made in.
+    """
+
+    profile = ForeignKey(Profile, CASCADE, related_name='statements')
+    # First day of the month
+    month = DateField()
+    opening_balance = DecimalField(max_digits=15, decimal_places=2)
+    purchase_count = PositiveIntegerField()
+    purchase_amount = DecimalField(max_digits=15, decimal_places=2)
+    top_ups = DecimalField(max_digits=15, decimal_places=2)
+    adjustments = DecimalField(max_digits=15, decimal_places=2)
+    closing_balance = DecimalField(max_digits=15, decimal_places=2)
+    created_at = DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['profile', 'month'], name='unique_statement')
+        ]
+
+    def save(self, *args, **kwargs) -> None:
+        if not self._state.adding:
+            raise ValueError('Statements are immutable')
+        super().save(*args, **kwargs)
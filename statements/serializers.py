@@ -0,0 +1,18 @@
+from rest_framework.serializers import ModelSerializer
+
+from .models import Statement
+
+
+class StatementSerializer(ModelSerializer):
+    class Meta:
+        model = Statement
+        fields = [
+            'month',
+            'opening_balance',
+            'purchase_count',
+            'purchase_amount',
+            'top_ups',
+            'adjustments',
+            'closing_balance',
+        ]
+        read_only_fields = fields
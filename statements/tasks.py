@@ -0,0 +1,12 @@
+from datetime import timedelta
+
+from tasks.queue import task
+
+from .generate import generate_month, last_closed_month
+
+
+@task(every=timedelta(hours=1))
+def generate_statements() -> None:
+    """Generate statements once a month is over, it is a no-op afterwards"""
+    # Forking a process pool from a worker thread isn't safe
+    generate_month(last_closed_month(), workers=1)
@@ -0,0 +1,146 @@
+from datetime import date, datetime
+from decimal import Decimal
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase
+
+from purchases.models import BeverageType, Purchase
+from users.models import BalanceChange
+from users.tests import token_auth
+
+from .generate import generate_month, last_closed_month
+from .models import Statement
+
+
+def aware(*args) -> datetime:
+    return timezone.make_aware(datetime(*args))
+
+
+class GenerateStatementsTest(TestCase):
+    user: User
+    beverage_type: BeverageType
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.user = User.objects.create_user(
+            username='erni', password='1234', date_joined=aware(2021, 5, 20)
+        )
+        cls.beverage_type = BeverageType.objects.create(name='coffee', price='2.20')
+        BalanceChange.objects.create(
+            profile=cls.user.profile,
+            amount='10.00',
+            kind=BalanceChange.TOP_UP,
+            date=aware(2021, 5, 20),
+        )
+        for day in (aware(2021, 5, 31, 23, 59), aware(2021, 6, 1), aware(2021, 6, 30)):
+            Purchase.objects.create(
+                beverage_type=cls.beverage_type, user=cls.user, date=day
+            )
+        BalanceChange.objects.create(
+            profile=cls.user.profile,
+            amount='5.00',
+            kind=BalanceChange.TOP_UP,
+            date=aware(2021, 6, 15),
+        )
+        BalanceChange.objects.create(
+            profile=cls.user.profile,
+            amount='-1.00',
+            kind=BalanceChange.ADJUSTMENT,
+            date=aware(2021, 6, 16),
+        )
+
+    def test_generate(self) -> None:
+        self.assertEqual(generate_month(date(2021, 6, 1), workers=1), 1)
+
+        statement = Statement.objects.get(profile=self.user.profile)
+        self.assertEqual(statement.month, date(2021, 6, 1))
+        self.assertEqual(statement.opening_balance, Decimal('7.80'))
+        self.assertEqual(statement.purchase_count, 2)
+        self.assertEqual(statement.purchase_amount, Decimal('4.40'))
+        self.assertEqual(statement.top_ups, Decimal('5.00'))
+        self.assertEqual(statement.adjustments, Decimal('-1.00'))
+        self.assertEqual(statement.closing_balance, Decimal('7.40'))
+
+    def test_opening_balance_is_previous_closing_balance(self) -> None:
+        generate_month(date(2021, 5, 1), workers=1)
+        generate_month(date(2021, 6, 1), workers=1)
+
+        may, june = Statement.objects.order_by('month')
+        self.assertEqual(may.closing_balance, Decimal('7.80'))
+        self.assertEqual(june.opening_balance, may.closing_balance)
+
+    def test_statements_are_generated_once(self) -> None:
+        generate_month(date(2021, 6, 1), workers=1)
+
+        self.assertEqual(generate_month(date(2021, 6, 1), workers=1), 0)
+        self.assertEqual(Statement.objects.count(), 1)
+
+    def test_statements_are_immutable(self) -> None:
+        generate_month(date(2021, 6, 1), workers=1)
+        statement = Statement.objects.get()
+
+        statement.closing_balance = 0
+        with self.assertRaises(ValueError):
+            statement.save()
+
+    def test_no_statements_before_joining(self) -> None:
+        self.assertEqual(generate_month(date(2021, 4, 1), workers=1), 0)
+
+    def test_unfinished_months_are_rejected(self) -> None:
+        with self.assertRaises(ValueError):
+            generate_month(timezone.localdate(), workers=1)
+
+    def test_command(self) -> None:
+        out = StringIO()
+        call_command(
+            'generate_statements', '--month=2021-06', '--workers=1', stdout=out
+        )
+        call_command('generate_statements', '--workers=1', stdout=out)
+
+        self.assertEqual(
+            set(Statement.objects.values_list('month', flat=True)),
+            {date(2021, 6, 1), last_closed_month()},
+        )
+        self.assertIn('Generated 1 statements', out.getvalue())
+
+
+class StatementsEndpointTest(APITestCase):
+    user: User
+    other: User
+    user_token: str
+    other_token: str
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.user = User.objects.create_user(
+            username='erni', password='1234', date_joined=aware(2021, 5, 1)
+        )
+        cls.other = User.objects.create_user(username='ducky', password='1234')
+        cls.user_token = Token.objects.get(user=cls.user).key
+        cls.other_token = Token.objects.get(user=cls.other).key
+        generate_month(date(2021, 5, 1), workers=1)
+        generate_month(date(2021, 6, 1), workers=1)
+
+    def test_statements(self) -> None:
+        with token_auth(self, self.user_token):
+            response = self.client.get(
+                f'/api/profiles/{self.user.profile.id}/statements/'
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                [statement['month'] for statement in response.data],
+                ['2021-06-01', '2021-05-01'],
+            )
+
+    def test_only_owner_can_see_statements(self) -> None:
+        with token_auth(self, self.other_token):
+            response = self.client.get(
+                f'/api/profiles/{self.user.profile.id}/statements/'
+            )
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
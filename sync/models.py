@@ -0,0 +1,37 @@
+from typing import Iterable
+
+from django.contrib.auth.models import User
+from django.db.models import BigIntegerField, CharField, DateTimeField, Model, signals
+from django.dispatch import receiver
+
+from purchases.models import BeverageType, Purchase
+from users.models import Profile
+
+
+class Tombstone(Model):
+    """Marks a deleted object for clients syncing through `SyncViewSet`"""
+
+    model = CharField(max_length=100)
+    object_id = BigIntegerField()
+    deleted_at = DateTimeField(auto_now_add=True, db_index=True)
+
+
+def bury(model: type, ids: Iterable[int]) -> None:
+    """Create tombstones for the deleted objects `ids` of `model`"""
+    Tombstone.objects.bulk_create(
+        (Tombstone(model=model._meta.label_lower, object_id=id) for id in ids),
+        batch_size=1000,
+    )
+
+
+@receiver(signals.post_delete, sender=BeverageType)
+@receiver(signals.post_delete, sender=Profile)
+def create_tombstone(sender, instance: Model, **kwargs) -> None:
+    Tombstone.objects.create(model=sender._meta.label_lower, object_id=instance.pk)
+
+
+# Deleted users bury their purchases in bulk, direct deletes go through
+# `purchases.deletion`
+@receiver(signals.pre_delete, sender=User)
+def bury_purchases(sender, instance: User, **kwargs) -> None:
+    bury(Purchase, Purchase.objects.filter(user=instance).values_list('id', flat=True))
@@ -0,0 +1,41 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from datetime import datetime
+from typing import Dict, Tuple
+
+from django.utils.dateparse import parse_datetime
+from rest_framework.fields import Field, IntegerField
+from rest_framework.serializers import Serializer
+
+Position = Tuple[datetime, int]
+
+
+class CursorField(Field):
+    """Opaque cursor holding the last synced `(updated_at, id)` of each stream"""
+
+    default_error_messages = {'invalid': 'Invalid cursor.'}
+
+    def to_internal_value(self, data: str) -> Dict[str, Position]:
+        try:
+            positions = json.loads(urlsafe_b64decode(data.encode()))
+            cursor = {}
+            for stream, (date, pk) in positions.items():
+                date = parse_datetime(date)
+                if date is None or not isinstance(pk, int):
+                    self.fail('invalid')
+                cursor[stream] = (date, pk)
+        except (BinasciiError, ValueError, TypeError, AttributeError):
+            self.fail('invalid')
+        return cursor
+
+    def to_representation(self, cursor: Dict[str, Position]) -> str:
+        positions = {
+            stream: (date.isoformat(), pk) for stream, (date, pk) in cursor.items()
+        }
+        return urlsafe_b64encode(json.dumps(positions).encode()).decode()
+
+
+class SyncQuerySerializer(Serializer):
+    cursor = CursorField(required=False)
+    limit = IntegerField(min_value=1, max_value=1000, default=500)
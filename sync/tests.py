@@ -0,0 +1,139 @@
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework import status
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APITestCase
+
+from purchases.deletion import delete_purchase
+from purchases.models import BeverageType, Purchase
+from users.tests import token_auth
+
+from .models import Tombstone
+
+
+@override_settings(SYNC_SETTLE_SECONDS=0)
+class SyncTest(APITestCase):
+    api_uri = '/api/sync/'
+    user: User
+    user_token: str
+    beverage_type: BeverageType
+    purchase: Purchase
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.user = User.objects.create_user(username='erni', password='1234')
+        cls.user_token = Token.objects.get(user=cls.user).key
+        cls.beverage_type = BeverageType.objects.create(name='coffee', price='2.20')
+        cls.purchase = Purchase.objects.create(
+            beverage_type=cls.beverage_type, user=cls.user
+        )
+
+    def test_requires_authentication(self) -> None:
+        response = self.client.get(self.api_uri)
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_full_sync_without_cursor(self) -> None:
+        with token_auth(self, self.user_token):
+            response = self.client.get(self.api_uri)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            self.assertEqual(
+                [b['id'] for b in response.data['beverage_types']],
+                [self.beverage_type.id],
+            )
+            self.assertEqual(
+                [p['id'] for p in response.data['profiles']], [self.user.profile.id]
+            )
+            self.assertEqual(
+                [p['id'] for p in response.data['purchases']], [self.purchase.id]
+            )
+            self.assertFalse(response.data['has_more'])
+
+    def test_only_changes_since_cursor(self) -> None:
+        with token_auth(self, self.user_token):
+            cursor = self.client.get(self.api_uri).data['cursor']
+
+            response = self.client.get(self.api_uri, {'cursor': cursor})
+            self.assertEqual(response.data['purchases'], [])
+            self.assertEqual(response.data['beverage_types'], [])
+
+            self.beverage_type.price = '2.40'
+            self.beverage_type.save()
+            purchase = Purchase.objects.create(
+                beverage_type=self.beverage_type, user=self.user
+            )
+
+            response = self.client.get(self.api_uri, {'cursor': cursor})
+            self.assertEqual(response.data['beverage_types'][0]['price'], '2.40')
+            self.assertEqual(
+                [p['id'] for p in response.data['purchases']], [purchase.id]
+            )
+            self.assertEqual(response.data['profiles'], [])
+
+    def test_deletions_are_synced(self) -> None:
+        with token_auth(self, self.user_token):
+            cursor = self.client.get(self.api_uri).data['cursor']
+            purchase_id = self.purchase.id
+            self.purchase.refresh_from_db()
+            delete_purchase(self.purchase)
+
+            response = self.client.get(self.api_uri, {'cursor': cursor})
+            self.assertEqual(response.data['deleted']['purchases'], [purchase_id])
+            self.assertEqual(response.data['deleted']['beverage_types'], [])
+
+    def test_cascades_create_tombstones_in_bulk(self) -> None:
+        user = User.objects.create_user(username='bernd', password='1234')
+        purchases = Purchase.objects.bulk_create(
+            Purchase(beverage_type=self.beverage_type, user=user, amount=1)
+            for _ in range(20)
+        )
+
+        with CaptureQueriesContext(connection) as queries:
+            user.delete()
+        inserts = [
+            query
+            for query in queries
+            if query['sql'].startswith('INSERT INTO "sync_tombstone"')
+        ]
+        # One for the profile, one for all purchases
+        self.assertEqual(len(inserts), 2)
+        self.assertEqual(
+            set(
+                Tombstone.objects.filter(model='purchases.purchase').values_list(
+                    'object_id', flat=True
+                )
+            ),
+            {purchase.id for purchase in purchases},
+        )
+
+    def test_pagination(self) -> None:
+        purchase = Purchase.objects.create(
+            beverage_type=self.beverage_type, user=self.user
+        )
+
+        with token_auth(self, self.user_token):
+            response = self.client.get(self.api_uri, {'limit': 1})
+            self.assertTrue(response.data['has_more'])
+            self.assertEqual(
+                [p['id'] for p in response.data['purchases']], [self.purchase.id]
+            )
+
+            response = self.client.get(
+                self.api_uri, {'limit': 1, 'cursor': response.data['cursor']}
+            )
+            self.assertEqual(
+                [p['id'] for p in response.data['purchases']], [purchase.id]
+            )
+
+    def test_invalid_cursor(self) -> None:
+        with token_auth(self, self.user_token):
+            response = self.client.get(self.api_uri, {'cursor': 'not-a-cursor'})
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    @override_settings(SYNC_SETTLE_SECONDS=60)
+    def test_recent_changes_are_held_back(self) -> None:
+        with token_auth(self, self.user_token):
+            response = self.client.get(self.api_uri)
+            self.assertEqual(response.data['purchases'], [])
@@ -0,0 +1,97 @@
+from datetime import timedelta
+from typing import Dict, List, Tuple
+
+from django.conf import settings
+from django.db.models import Q, QuerySet
+from django.utils import timezone
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.viewsets import GenericViewSet
+
+from purchases.models import BeverageType, Purchase
+from purchases.serializers import BeverageTypeSerializer, PurchaseSerializer
+from users.models import Profile
+from users.serializers import ProfileSerializer
+
+from .models import Tombstone
+from .serializers import CursorField, Position, SyncQuerySerializer
+
+
+def _after(queryset: QuerySet, field: str, position: Position) -> QuerySet:
+    date, pk = position
+    return queryset.filter(
+        Q(**{f'{field}__gt': date}) | Q(**{field: date, 'pk__gt': pk})
+    )
+
+
+class SyncViewSet(GenericViewSet):
+    """Changes to beverage types, profiles and purchases since a cursor
+
+    Without a cursor everything is returned. Objects are returned oldest change
+    first, `limit` per stream; while `has_more` is true the next page is fetched
+    with the returned cursor. Changes younger than `settings.SYNC_SETTLE_SECONDS`
+    are held back so transactions committing out of order aren't skipped.
+    """
+
+    permission_classes = [IsAuthenticated]
+    serializer_class = SyncQuerySerializer
+
+    streams = (
+        ('beverage_types', BeverageType, BeverageTypeSerializer),
+        ('profiles', Profile, ProfileSerializer),
+        ('purchases', Purchase, PurchaseSerializer),
+    )
+
+    def get_serializer_context(self):
+        """Set request to none to return relative urls for relationships"""
+        return {'request': None, 'format': self.format_kwarg, 'view': self}
+
+    def list(self, request: Request) -> Response:
+        query = self.get_serializer(data=request.query_params)
+        query.is_valid(raise_exception=True)
+        cursor: Dict[str, Position] = query.validated_data.get('cursor', {})
+        limit: int = query.validated_data['limit']
+        horizon = timezone.now() - timedelta(seconds=settings.SYNC_SETTLE_SECONDS)
+
+        data, has_more = {}, False
+        for stream, model, serializer_class in self.streams:
+            objects, stream_has_more = self._page(
+                model.objects.filter(updated_at__lte=horizon),
+                'updated_at',
+                cursor.get(stream),
+                limit,
+            )
+            has_more |= stream_has_more
+            if objects:
+                cursor[stream] = (objects[-1].updated_at, objects[-1].pk)
+            data[stream] = serializer_class(
+                objects, many=True, context=self.get_serializer_context()
+            ).data
+
+        tombstones, stream_has_more = self._page(
+            Tombstone.objects.filter(deleted_at__lte=horizon),
+            'deleted_at',
+            cursor.get('deleted'),
+            limit,
+        )
+        has_more |= stream_has_more
+        if tombstones:
+            cursor['deleted'] = (tombstones[-1].deleted_at, tombstones[-1].pk)
+        labels = {model._meta.label_lower: stream for stream, model, _ in self.streams}
+        data['deleted'] = {stream: [] for stream, _, _ in self.streams}
+        for tombstone in tombstones:
+            data['deleted'][labels[tombstone.model]].append(tombstone.object_id)
+
+        data['cursor'] = CursorField().to_representation(cursor)
+        data['has_more'] = has_more
+        return Response(data)
+
+    @staticmethod
+    def _page(
+        queryset: QuerySet, field: str, position: Position, limit: int
+    ) -> Tuple[List, bool]:
+        if position is not None:
+            queryset = _after(queryset, field, position)
+        objects = list(queryset.order_by(field, 'pk')[: limit + 1])
+        return objects[:limit], len(objects) > limit
@@ -0,0 +1,78 @@
+import logging
+from threading import Event, Thread
+from time import sleep
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from tasks.queue import ensure_periodic, run_next, run_pending
+
+logger = logging.getLogger(__name__)
+
+# Longest wait in seconds before retrying after an error, e.g. the database being
+# down
+MAX_BACKOFF = 60
+
+
+class Command(BaseCommand):
+    help = 'Run queued tasks'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=1,
+            help='Tasks to run at once, each in its own thread and connection',
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=1,
+            help='Seconds to wait for new tasks once none are due',
+        )
+        parser.add_argument(
+            '--once', action='store_true', help='Exit once no tasks are due'
+        )
+
+    def handle(self, *args, concurrency: int, interval: float, once: bool, **options):
+        ensure_periodic()
+        if once:
+            ran = run_pending()
+            self.stdout.write(f'Ran {ran} tasks')
+            return
+
+        stopped = Event()
+        threads = [
+            Thread(target=self.work, args=(interval, stopped), daemon=True)
+            for _ in range(concurrency)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                sleep(interval)
+                # Requeue periodic tasks that failed for good
+                ensure_periodic()
+        finally:
+            stopped.set()
+            for thread in threads:
+                thread.join()
+
+    def work(self, interval: float, stopped: Event) -> None:
+        backoff = interval
+        try:
+            while not stopped.is_set():
+                try:
+                    ran = run_next()
+                except Exception:
+                    # Reconnect once the wait is over, waiting longer each time
+                    logger.exception('Claiming or finishing a task failed')
+                    connection.close()
+                    stopped.wait(backoff)
+                    backoff = min(max(backoff * 2, 1), MAX_BACKOFF)
+                    continue
+                backoff = interval
+                if not ran:
+                    stopped.wait(interval)
+        finally:
+            connection.close()
@@ -0,0 +1,46 @@
+from django.db.models import (
+    CharField,
+    DateTimeField,
+    Index,
+    JSONField,
+    Model,
+    PositiveSmallIntegerField,
+    Q,
+    TextField,
+    UniqueConstraint,
+)
+from django.utils import timezone
+
+
+class Task(Model):
+    """Call of a registered task function, see `tasks.queue`
+
+    Tasks are deleted once they succeeded, failed tasks are kept for inspection.
+    """
+
+    QUEUED = 'queued'
+    FAILED = 'failed'
+    STATUSES = [(QUEUED, 'Queued'), (FAILED, 'Failed')]
+
+    name = CharField(max_length=200)
+    args = JSONField(default=list)
+    kwargs = JSONField(default=dict)
+    # At most one queued task per key, enqueueing another one is a no-op
+    key = CharField(max_length=200, null=True, blank=True)
+    status = CharField(max_length=10, choices=STATUSES, default=QUEUED)
+    run_at = DateTimeField(default=timezone.now)
+    attempts = PositiveSmallIntegerField(default=0)
+    last_error = TextField(blank=True, default='')
+    created_at = DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            Index(fields=['run_at'], condition=Q(status='queued'), name='task_due_idx'),
+        ]
+        constraints = [
+            UniqueConstraint(
+                fields=['key'],
+                condition=Q(status='queued'),
+                name='unique_queued_task_key',
+            )
+        ]
@@ -0,0 +1,177 @@
+"""Database backed task queue
+
+Functions in the `tasks` module of an app are registered with the `task`
+decorator and queued with `delay` or `schedule`:
+
+    @task(max_attempts=5)
+    def send_reminder(user_id: int) -> None:
+        ...
+
+    send_reminder.delay(user.id)
+    send_reminder.schedule(timezone.now() + timedelta(hours=1), user.id)
+
+Arguments have to be JSON serializable. Tasks queued within a transaction only
+become visible to workers once it commits.
+
+Workers, started with `manage.py run_tasks`, claim due tasks with
+`SELECT ... FOR UPDATE SKIP LOCKED` and run them inside the claiming transaction,
+so a crashed worker's task is simply picked up by another one. Failed tasks are
+retried with exponential backoff until `max_attempts` is reached. Tasks declared
+with `every` are periodic, workers keep one of them queued.
+"""
+import logging
+import traceback
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Optional
+
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+registry: Dict[str, 'TaskFunction'] = {}
+
+
+class TaskFunction:
+    def __init__(
+        self,
+        func: Callable,
+        name: str,
+        max_attempts: int,
+        retry_delay: timedelta,
+        every: Optional[timedelta],
+    ) -> None:
+        self.func = func
+        self.name = name
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.every = every
+
+    def __call__(self, *args, **kwargs):
+        """Run the task in the current process"""
+        return self.func(*args, **kwargs)
+
+    def delay(self, *args, **kwargs) -> Task:
+        """Queue the task to run as soon as a worker is free"""
+        return enqueue(self.name, args, kwargs)
+
+    def schedule(self, run_at: datetime, *args, **kwargs) -> Task:
+        """Queue the task to run at `run_at`"""
+        return enqueue(self.name, args, kwargs, run_at=run_at)
+
+
+def task(
+    func: Optional[Callable] = None,
+    *,
+    name: Optional[str] = None,
+    max_attempts: int = 3,
+    retry_delay: timedelta = timedelta(seconds=10),
+    every: Optional[timedelta] = None,
+):
+    """Register `func` as a task, named `<module>.<function>` by default
+
+    Failed attempts are retried after `retry_delay`, doubling with every attempt.
+    Periodic tasks run `every` interval and take no arguments.
+    """
+
+    def register(func: Callable) -> TaskFunction:
+        definition = TaskFunction(
+            func,
+            name or f'{func.__module__}.{func.__qualname__}',
+            max_attempts,
+            retry_delay,
+            every,
+        )
+        registry[definition.name] = definition
+        return definition
+
+    return register(func) if func is not None else register
+
+
+def enqueue(
+    name: str,
+    args=(),
+    kwargs: Optional[dict] = None,
+    run_at: Optional[datetime] = None,
+    key: Optional[str] = None,
+) -> Task:
+    """Queue a call of the task registered as `name`
+
+    If a task with the same `key` is already queued, it is returned instead.
+    """
+    queued = Task(
+        name=name,
+        args=list(args),
+        kwargs=kwargs or {},
+        run_at=run_at or timezone.now(),
+        key=key,
+    )
+    if key is None:
+        queued.save()
+        return queued
+
+    Task.objects.bulk_create([queued], ignore_conflicts=True)
+    return Task.objects.get(key=key, status=Task.QUEUED)
+
+
+def ensure_periodic() -> None:
+    """Queue every periodic task that isn't queued yet"""
+    for definition in registry.values():
+        if definition.every is not None:
+            enqueue(definition.name, key=definition.name)
+
+
+def run_next() -> bool:
+    """Claim and run the next due task, return whether there was one"""
+    with transaction.atomic():
+        claimed = (
+            Task.objects.select_for_update(skip_locked=True)
+            .filter(status=Task.QUEUED, run_at__lte=timezone.now())
+            .order_by('run_at')
+            .first()
+        )
+        if claimed is None:
+            return False
+
+        definition = registry.get(claimed.name)
+        try:
+            if definition is None:
+                raise LookupError(f'Task {claimed.name} is not registered')
+            # Only the task's own changes are rolled back if it fails
+            with transaction.atomic():
+                definition.func(*claimed.args, **claimed.kwargs)
+        except Exception:
+            logger.exception('Task %s (%s) failed', claimed.name, claimed.pk)
+            _retry_or_fail(claimed, definition)
+            return True
+
+        claimed.delete()
+        if definition.every is not None:
+            enqueue(
+                definition.name,
+                run_at=max(claimed.run_at + definition.every, timezone.now()),
+                key=definition.name,
+            )
+    return True
+
+
+def _retry_or_fail(claimed: Task, definition: Optional[TaskFunction]) -> None:
+    claimed.attempts += 1
+    claimed.last_error = traceback.format_exc()
+    if definition is not None and claimed.attempts < definition.max_attempts:
+        claimed.run_at = timezone.now() + definition.retry_delay * 2 ** (
+            claimed.attempts - 1
+        )
+    else:
+        claimed.status = Task.FAILED
+    claimed.save(update_fields=['attempts', 'last_error', 'run_at', 'status'])
+
+
+def run_pending() -> int:
+    """Run due tasks until there are none left, return how many ran"""
+    ran = 0
+    while run_next():
+        ran += 1
+    return ran
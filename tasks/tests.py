@@ -0,0 +1,162 @@
+from datetime import timedelta
+from io import StringIO
+from threading import Event, Thread
+from typing import List
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from purchases.models import BeverageType
+
+from .management.commands.run_tasks import Command
+from .models import Task
+from .queue import enqueue, ensure_periodic, run_next, run_pending, task
+
+calls: List[int] = []
+
+
+@task
+def record(value: int) -> None:
+    calls.append(value)
+
+
+@task(max_attempts=2, retry_delay=timedelta(minutes=1))
+def fail() -> None:
+    BeverageType.objects.create(name='rolled back', price=1)
+    raise RuntimeError('failed')
+
+
+@task(every=timedelta(hours=1))
+def periodic() -> None:
+    calls.append(0)
+
+
+class TaskQueueTest(TestCase):
+    def setUp(self) -> None:
+        calls.clear()
+
+    def test_delay(self) -> None:
+        record.delay(1)
+        record.delay(2)
+
+        self.assertEqual(run_pending(), 2)
+        self.assertEqual(calls, [1, 2])
+        self.assertFalse(Task.objects.exists())
+
+    def test_schedule(self) -> None:
+        queued = record.schedule(timezone.now() + timedelta(minutes=5), 1)
+
+        self.assertEqual(run_pending(), 0)
+        Task.objects.filter(pk=queued.pk).update(run_at=timezone.now())
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(calls, [1])
+
+    def test_retries(self) -> None:
+        queued = fail.delay()
+
+        with self.assertLogs('tasks.queue', 'ERROR'):
+            self.assertTrue(run_next())
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Task.QUEUED)
+        self.assertEqual(queued.attempts, 1)
+        self.assertIn('RuntimeError', queued.last_error)
+        self.assertGreater(queued.run_at, timezone.now())
+        self.assertFalse(BeverageType.objects.exists())
+
+        Task.objects.filter(pk=queued.pk).update(run_at=timezone.now())
+        with self.assertLogs('tasks.queue', 'ERROR'):
+            self.assertTrue(run_next())
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Task.FAILED)
+        self.assertEqual(run_pending(), 0)
+
+    def test_unregistered_tasks_fail(self) -> None:
+        queued = enqueue('tasks.tests.missing')
+
+        with self.assertLogs('tasks.queue', 'ERROR'):
+            run_pending()
+        queued.refresh_from_db()
+        self.assertEqual(queued.status, Task.FAILED)
+
+    def test_key_deduplicates(self) -> None:
+        first = enqueue(record.name, [1], key='record')
+        second = enqueue(record.name, [2], key='record')
+
+        self.assertEqual(first.pk, second.pk)
+        run_pending()
+        self.assertEqual(calls, [1])
+
+    def test_periodic(self) -> None:
+        ensure_periodic()
+        ensure_periodic()
+
+        self.assertEqual(Task.objects.filter(name=periodic.name).count(), 1)
+        run_pending()
+        self.assertEqual(calls, [0])
+        queued = Task.objects.get(name=periodic.name)
+        self.assertGreater(queued.run_at, timezone.now() + timedelta(minutes=59))
+
+    def test_command(self) -> None:
+        record.delay(1)
+        out = StringIO()
+
+        call_command('run_tasks', '--once', stdout=out)
+
+        self.assertEqual(calls[0], 1)
+        self.assertIn('Ran', out.getvalue())
+
+    def test_workers_survive_errors(self) -> None:
+        stopped = Event()
+        results = iter([OperationalError('server closed the connection'), True])
+
+        def run_next() -> bool:
+            result = next(results, None)
+            if isinstance(result, Exception):
+                raise result
+            if result is None:
+                stopped.set()
+            return bool(result)
+
+        # The worker closes its connection, run it on one of its own
+        thread = Thread(target=Command().work, args=(0, stopped))
+        with patch('tasks.management.commands.run_tasks.run_next', run_next):
+            with self.assertLogs('tasks.management.commands.run_tasks', 'ERROR'):
+                thread.start()
+                thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertIsNone(next(results, None))
+
+
+class SkipLockedTest(TransactionTestCase):
+    def test_claimed_tasks_are_skipped(self) -> None:
+        claimed, release = Event(), Event()
+
+        @task(name='tasks.tests.block')
+        def block() -> None:
+            claimed.set()
+            release.wait(5)
+
+        def work() -> None:
+            try:
+                run_next()
+            finally:
+                connection.close()
+
+        block.delay()
+        record.delay(1)
+        calls.clear()
+        thread = Thread(target=work)
+        thread.start()
+        try:
+            self.assertTrue(claimed.wait(5))
+            # The blocking task is locked by the other worker
+            self.assertTrue(run_next())
+            self.assertFalse(run_next())
+            self.assertEqual(calls, [1])
+        finally:
+            release.set()
+            thread.join()
+        self.assertFalse(Task.objects.exists())
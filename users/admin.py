@@ -1 +1,52 @@
-# Register your models here.
+from django.contrib import admin
+from django.db.models import QuerySet
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import format_html
+
+from kaffee_kasse.admin import LargeTableAdmin
+
+from .models import Profile
+
+
+@admin.register(Profile)
+class ProfileAdmin(LargeTableAdmin):
+    list_display = ('id', 'user', 'balance', 'is_freeloader', 'purchases')
+    list_select_related = ('user',)
+    # Exact matches use the unique index on usernames
+    search_fields = ('user__username__exact',)
+    # Balances are only changed through `users.balance`, which records them
+    readonly_fields = ('user', 'balance', 'balance_shards')
+    actions = ('mark_freeloaders', 'unmark_freeloaders')
+
+    def has_add_permission(self, request) -> bool:
+        # Profiles are created and deleted with their users
+        return False
+
+    def has_delete_permission(self, request, obj=None) -> bool:
+        return False
+
+    def save_model(self, request, obj: Profile, form, change: bool) -> None:
+        # Never write back a balance loaded before purchases changed it
+        obj.save(update_fields=['is_freeloader', 'bio', 'updated_at'])
+
+    @admin.display(description='Purchases')
+    def purchases(self, profile: Profile) -> str:
+        url = reverse('admin:purchases_purchase_changelist')
+        return format_html(
+            '<a href="{}?user__exact={}">Purchases</a>', url, profile.user_id
+        )
+
+    def _set_freeloader(self, request, queryset: QuerySet, is_freeloader: bool) -> None:
+        updated = queryset.update(
+            is_freeloader=is_freeloader, updated_at=timezone.now()
+        )
+        self.message_user(request, f'Updated {updated} profiles')
+
+    @admin.action(description='Mark selected profiles as freeloaders')
+    def mark_freeloaders(self, request, queryset: QuerySet) -> None:
+        self._set_freeloader(request, queryset, True)
+
+    @admin.action(description='Unmark selected profiles as freeloaders')
+    def unmark_freeloaders(self, request, queryset: QuerySet) -> None:
+        self._set_freeloader(request, queryset, False)
@@ -0,0 +1,269 @@
+"""Atomic `Profile.balance` mutations
+
+Every change is a single conditional UPDATE, so concurrent purchases stay correct
+without reading the profile first or locking it. Nothing else should write
+`Profile.balance`.
+
+Purchases on one profile still serialize on its row lock. Profiles shared by many
+users, like a guest account, can be sharded with `set_balance_shards`: their
+purchases are then charged to one of `Profile.balance_shards` randomly picked
+`BalanceCell`s, and their balance is `Profile.total_balance`.
+
+Every change other than a purchase is recorded in the `BalanceChange` ledger,
+purchases record their amount in `Purchase.amount`.
+"""
+from datetime import datetime
+from decimal import Decimal
+from random import randrange
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, F, Value, When
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from .models import BalanceCell, BalanceChange, Profile
+
+
+class CreditLimitExceeded(APIException):
+    status_code = status.HTTP_402_PAYMENT_REQUIRED
+    default_detail = 'Balance is too low, the credit limit would be exceeded.'
+    default_code = 'credit_limit_exceeded'
+
+
+def _table(model) -> str:
+    return connection.ops.quote_name(model._meta.db_table)
+
+
+def charge(user_id: int, amount: Decimal) -> Optional[Decimal]:
+    """Debit `amount` from the profile of `user_id` unless it is a freeloader
+
+    Returns the new balance, `None` for freeloaders. Raises `CreditLimitExceeded`
+    if the balance would drop below `-settings.CREDIT_LIMIT`.
+    """
+    credit_limit = settings.CREDIT_LIMIT
+    sql = (
+        f'UPDATE {_table(Profile)} SET balance = balance - %s, updated_at = %s '
+        'WHERE user_id = %s AND NOT is_freeloader AND balance_shards = 0'
+    )
+    params = [amount, timezone.now(), user_id]
+    if credit_limit is not None:
+        sql += ' AND balance - %s >= %s'
+        params += [amount, -credit_limit]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql + ' RETURNING balance', params)
+        row = cursor.fetchone()
+    if row is not None:
+        return row[0]
+
+    # Only reached for freeloaders, sharded profiles and exceeded limits
+    profile = Profile.objects.filter(user_id=user_id).first()
+    if profile is None:
+        raise Profile.DoesNotExist()
+    if profile.is_freeloader:
+        return None
+    if not profile.balance_shards:
+        raise CreditLimitExceeded()
+    if not _charge_cell(profile, amount):
+        # The cells were replaced by `set_balance_shards` meanwhile
+        return charge(user_id, amount)
+    return profile.total_balance
+
+
+@transaction.atomic
+def _charge_cell(profile: Profile, amount: Decimal) -> bool:
+    """Debit `amount` from a random balance cell of a sharded profile, `False` if
+    the cell no longer exists
+
+    The credit limit is checked against the total balance. Under concurrent
+    purchases on other cells it can be overdrawn by a few purchases.
+
+    `Profile.updated_at` is bumped for syncing clients unless a concurrent
+    transaction holding the profile lock bumps it already, waiting for it would
+    serialize purchases again.
+    """
+    sql = (
+        f'UPDATE {_table(BalanceCell)} SET balance = balance - %s '
+        'WHERE profile_id = %s AND shard = %s'
+    )
+    params = [amount, profile.id, randrange(profile.balance_shards)]
+    if settings.CREDIT_LIMIT is not None:
+        sql += (
+            f' AND (SELECT balance FROM {_table(Profile)} WHERE id = %s)'
+            f' + (SELECT SUM(balance) FROM {_table(BalanceCell)} WHERE profile_id = %s)'
+            ' - %s >= %s'
+        )
+        params += [profile.id, profile.id, amount, -settings.CREDIT_LIMIT]
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        if not cursor.rowcount:
+            if not has_credit(profile.user_id, amount):
+                raise CreditLimitExceeded()
+            return False
+        cursor.execute(
+            f'UPDATE {_table(Profile)} SET updated_at = %s WHERE id = ('
+            f'SELECT id FROM {_table(Profile)} WHERE id = %s FOR UPDATE SKIP LOCKED)',
+            [timezone.now(), profile.id],
+        )
+    return True
+
+
+def debit_totals(totals: Dict[int, Decimal]) -> None:
+    """Debit per user totals from the profiles of non freeloaders, ignoring the
+    credit limit
+    """
+    now = timezone.now()
+    # Same lock order in every transaction to avoid deadlocks
+    for user_id in sorted(totals):
+        Profile.objects.filter(user_id=user_id, is_freeloader=False).update(
+            balance=F('balance') - totals[user_id], updated_at=now
+        )
+
+
+@transaction.atomic
+def credit(profile_id: int, amount: Decimal) -> Decimal:
+    """Add `amount` to `Profile.balance` as a top up, return the new
+    `Profile.balance`
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {_table(Profile)} SET balance = balance + %s, updated_at = %s '
+            'WHERE id = %s RETURNING balance',
+            [amount, timezone.now(), profile_id],
+        )
+        row = cursor.fetchone()
+    if row is None:
+        raise Profile.DoesNotExist()
+    BalanceChange.objects.create(
+        profile_id=profile_id, amount=amount, kind=BalanceChange.TOP_UP
+    )
+    return row[0]
+
+
+@transaction.atomic
+def credit_many(amounts: Dict[int, Decimal]) -> List[Profile]:
+    """Add amounts to the balances of several profiles, keyed by profile id, as top
+    ups in a single UPDATE and return the updated profiles
+
+    Raises `Profile.DoesNotExist` without changing any balance if a profile is
+    missing.
+    """
+    updated = Profile.objects.filter(id__in=amounts).update(
+        balance=F('balance')
+        + Case(
+            *(When(id=pk, then=Value(amount)) for pk, amount in amounts.items()),
+            output_field=Profile._meta.get_field('balance'),
+        ),
+        updated_at=timezone.now(),
+    )
+    profiles = list(Profile.objects.filter(id__in=amounts).order_by('id'))
+    if updated != len(amounts):
+        missing = set(amounts) - {profile.id for profile in profiles}
+        raise Profile.DoesNotExist(
+            f'Profiles {", ".join(map(str, sorted(missing)))} do not exist.'
+        )
+    BalanceChange.objects.bulk_create(
+        BalanceChange(profile_id=pk, amount=amount, kind=BalanceChange.TOP_UP)
+        for pk, amount in amounts.items()
+    )
+    return profiles
+
+
+@transaction.atomic
+def refund(user_id: int, amount: Decimal, date: datetime) -> None:
+    """Add `amount` charged for a purchase on `date` back to the balance of the
+    profile of `user_id`, before the purchase is deleted
+
+    The purchase is recorded as a charge on its date, so the ledger stays whole
+    without it, and the refund as of now.
+    """
+    if not amount:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {_table(Profile)} SET balance = balance + %s, updated_at = %s '
+            'WHERE user_id = %s RETURNING id',
+            [amount, timezone.now(), user_id],
+        )
+        row = cursor.fetchone()
+    if row is None:
+        raise Profile.DoesNotExist()
+    BalanceChange.objects.bulk_create(
+        [
+            BalanceChange(
+                profile_id=row[0],
+                amount=-amount,
+                kind=BalanceChange.PURCHASE,
+                date=date,
+            ),
+            BalanceChange(profile_id=row[0], amount=amount, kind=BalanceChange.REFUND),
+        ]
+    )
+
+
+def record_adjustment(profile_id: int, amount: Decimal) -> None:
+    """Record `amount` the balance of a profile changed by without a ledger entry
+    as an adjustment, the balance is left as is
+    """
+    BalanceChange.objects.create(
+        profile_id=profile_id, amount=amount, kind=BalanceChange.ADJUSTMENT
+    )
+
+
+@transaction.atomic
+def set_balance(profile_id: int, balance: Decimal) -> None:
+    """Overwrite the total balance of a profile, recording the difference as an
+    adjustment
+    """
+    profile = Profile.objects.select_for_update().get(id=profile_id)
+    cells = BalanceCell.objects.select_for_update().filter(profile_id=profile_id)
+    previous = profile.balance + sum(cell.balance for cell in cells)
+    if balance != previous:
+        BalanceChange.objects.create(
+            profile_id=profile_id,
+            amount=balance - previous,
+            kind=BalanceChange.ADJUSTMENT,
+        )
+    cells.update(balance=0)
+    Profile.objects.filter(id=profile_id).update(
+        balance=balance, updated_at=timezone.now()
+    )
+
+
+@transaction.atomic
+def set_balance_shards(profile_id: int, shards: int) -> None:
+    """Spread purchases of a profile over `shards` balance cells, 0 to stop
+    sharding
+    """
+    Profile.objects.select_for_update().get(id=profile_id)
+    cells = BalanceCell.objects.filter(profile_id=profile_id)
+    # Cell debits don't lock the profile, wait for running ones before folding
+    locked = list(cells.select_for_update().order_by('shard'))
+    folded = sum(cell.balance for cell in locked)
+    cells.delete()
+    BalanceCell.objects.bulk_create(
+        BalanceCell(profile_id=profile_id, shard=shard) for shard in range(shards)
+    )
+    Profile.objects.filter(id=profile_id).update(
+        balance=F('balance') + folded,
+        balance_shards=shards,
+        updated_at=timezone.now(),
+    )
+
+
+def has_credit(user_id: int, amount: Decimal, pending: Decimal = Decimal(0)) -> bool:
+    """Whether `amount` can be charged on top of `pending` charges without
+    exceeding `settings.CREDIT_LIMIT`, without changing the balance
+    """
+    if settings.CREDIT_LIMIT is None:
+        return True
+    profile = Profile.objects.filter(user_id=user_id).first()
+    return (
+        profile is None
+        or profile.is_freeloader
+        or profile.total_balance - pending - amount >= -settings.CREDIT_LIMIT
+    )
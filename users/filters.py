@@ -0,0 +1,36 @@
+from django.contrib.auth.models import User
+from django.db.models import Count
+
+from kaffee_kasse.filters import (
+    BooleanFilter,
+    FilterSet,
+    IntegerFilter,
+    OrderingFilter,
+    TextFilter,
+)
+
+from .models import Profile
+
+
+class UserFilterSet(FilterSet):
+    model = User
+    # There is one user per coffee drinker, scanning them is cheap
+    check_indexes = False
+
+    id = IntegerFilter()
+    is_staff = BooleanFilter()
+    username = TextFilter()
+    order = OrderingFilter(
+        ['username', 'date_joined'], annotations={'purchases': Count('purchase')}
+    )
+
+
+class ProfileFilterSet(FilterSet):
+    model = Profile
+    # One profile per user, scanning them is cheap
+    check_indexes = False
+
+    id = IntegerFilter()
+    user = IntegerFilter()
+    is_freeloader = BooleanFilter()
+    bio = TextFilter()
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from users.reconcile import fix_discrepancy, reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare every balance with the one expected from top ups, adjustments and '
+        'purchase amounts'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, help='Processes to use, defaults to the CPU count'
+        )
+        parser.add_argument(
+            '--fix', action='store_true', help='Record the discrepancies found as adjustments'
+        )
+
+    def handle(self, *args, workers: int, fix: bool, **options):
+        discrepancies = reconcile(workers)
+        for discrepancy in discrepancies:
+            self.stdout.write(
+                f'Profile {discrepancy.profile_id} (user {discrepancy.user_id}): '
+                f'balance {discrepancy.balance}, expected {discrepancy.expected}, '
+                f'off by {discrepancy.difference}'
+            )
+            if fix:
+                fix_discrepancy(discrepancy)
+
+        self.stdout.write(
+            f'{"Fixed" if fix else "Found"} {len(discrepancies)} discrepancies'
+        )
@@ -0,0 +1,52 @@
+# Generated by Django 3.2 on 2026-10-19 03:54
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='balance_shards',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='BalanceCell',
+            fields=[
+                (
+                    'id',
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('shard', models.PositiveSmallIntegerField()),
+                (
+                    'balance',
+                    models.DecimalField(decimal_places=2, default=0, max_digits=15),
+                ),
+                (
+                    'profile',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='balance_cells',
+                        to='users.profile',
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='balancecell',
+            constraint=models.UniqueConstraint(
+                fields=('profile', 'shard'), name='unique_shard'
+            ),
+        ),
+    ]
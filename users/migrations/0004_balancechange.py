@@ -0,0 +1,97 @@
+# Generated by Django 3.2 on 2026-10-19 04:02
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def open_ledger(apps, schema_editor):
+    """Record the current balances as opening entries, dated when the user joined
+
+    Purchases are part of the ledger through `Purchase.amount`, so their amounts
+    are added back.
+    """
+    Profile = apps.get_model('users', 'Profile')
+    BalanceChange = apps.get_model('users', 'BalanceChange')
+    Purchase = apps.get_model('purchases', 'Purchase')
+    db = schema_editor.connection.alias
+
+    spent = dict(
+        Purchase.objects.using(db)
+        .values('user')
+        .annotate(total=Sum('amount'))
+        .values_list('user', 'total')
+    )
+    profiles = (
+        Profile.objects.using(db)
+        .annotate(cells=Sum('balance_cells__balance'))
+        .values_list('id', 'user_id', 'user__date_joined', 'balance', 'cells')
+    )
+    BalanceChange.objects.using(db).bulk_create(
+        (
+            BalanceChange(
+                profile_id=profile_id,
+                amount=balance + (cells or 0) + spent.get(user_id, 0),
+                kind='opening',
+                date=date_joined,
+            )
+            for profile_id, user_id, date_joined, balance, cells in profiles
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_balance_shards'),
+        ('purchases', '0006_purchase_amount_not_null'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceChange',
+            fields=[
+                (
+                    'id',
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name='ID',
+                    ),
+                ),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=15)),
+                (
+                    'kind',
+                    models.CharField(
+                        choices=[
+                            ('top_up', 'Top up'),
+                            ('adjustment', 'Adjustment'),
+                            ('opening', 'Opening balance'),
+                        ],
+                        max_length=10,
+                    ),
+                ),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+                (
+                    'profile',
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name='balance_changes',
+                        to='users.profile',
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='balancechange',
+            index=models.Index(
+                fields=['profile', 'date'],
+                include=('kind', 'amount'),
+                name='balancechange_profile_date_idx',
+            ),
+        ),
+        migrations.RunPython(open_ledger, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 3.2 on 2026-10-19 05:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_balancechange'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='balancechange',
+            name='kind',
+            field=models.CharField(
+                choices=[
+                    ('top_up', 'Top up'),
+                    ('adjustment', 'Adjustment'),
+                    ('opening', 'Opening balance'),
+                    ('purchase', 'Deleted purchase'),
+                    ('refund', 'Refund'),
+                ],
+                max_length=10,
+            ),
+        ),
+    ]
@@ -1,22 +1,99 @@
+from decimal import Decimal
+
 from django.contrib.auth.models import User
 from django.db.models import (
     CASCADE,
     BooleanField,
+    CharField,
+    DateTimeField,
     DecimalField,
+    ForeignKey,
+    Index,
     Model,
     OneToOneField,
+    PositiveSmallIntegerField,
+    Sum,
     TextField,
+    UniqueConstraint,
 )
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
+from django.utils import timezone
 from rest_framework.authtoken.models import Token
 
+from kaffee_kasse.caching import invalidate
+
 
 class Profile(Model):
     user = OneToOneField(User, on_delete=CASCADE)
     is_freeloader = BooleanField(default=False)
     balance = DecimalField(max_digits=15, decimal_places=2, default=0)
     bio = TextField(default='')
+    updated_at = DateTimeField(auto_now=True, db_index=True)
+    # Number of `BalanceCell`s purchases are spread over, see `users.balance`
+    balance_shards = PositiveSmallIntegerField(default=0)
+
+    @property
+    def total_balance(self) -> Decimal:
+        """`balance` including the balance cells of sharded profiles"""
+        if not self.balance_shards:
+            return self.balance
+        cells = self.balance_cells.aggregate(total=Sum('balance'))['total']
+        return self.balance + (cells or 0)
+
+
+class BalanceCell(Model):
+    """Part of the balance of a sharded profile, which is `Profile.balance` plus
+    the balance of all its cells
+    """
+
+    profile = ForeignKey(Profile, CASCADE, related_name='balance_cells')
+    shard = PositiveSmallIntegerField()
+    balance = DecimalField(max_digits=15, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            UniqueConstraint(fields=['profile', 'shard'], name='unique_shard')
+        ]
+
+
+class BalanceChange(Model):
+    """Ledger of every balance change except purchases, which are charged
+    `Purchase.amount`
+
+    The total balance of a profile is the sum of its changes minus the amounts of
+    its purchases.
+    """
+
+    TOP_UP = 'top_up'
+    ADJUSTMENT = 'adjustment'
+    # Balance before the ledger was introduced
+    OPENING = 'opening'
+    # Deleted purchases stay in the ledger as a charge on their date, their refund
+    # is recorded when they are deleted
+    PURCHASE = 'purchase'
+    REFUND = 'refund'
+    KINDS = [
+        (TOP_UP, 'Top up'),
+        (ADJUSTMENT, 'Adjustment'),
+        (OPENING, 'Opening balance'),
+        (PURCHASE, 'Deleted purchase'),
+        (REFUND, 'Refund'),
+    ]
+
+    profile = ForeignKey(Profile, CASCADE, related_name='balance_changes')
+    amount = DecimalField(max_digits=15, decimal_places=2)
+    kind = CharField(max_length=10, choices=KINDS)
+    date = DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            Index(
+                fields=['profile', 'date'],
+                include=['kind', 'amount'],
+                name='balancechange_profile_date_idx',
+            ),
+        ]
 
 
 @receiver(post_save, sender=User)
@@ -37,4 +114,11 @@ def create_user_profile(
 
 @receiver(post_save, sender=User)
 def save_user_profile(sender, instance: User, **kwargs) -> None:
-    instance.profile.save()
+    # Balances are only changed through `users.balance`, never write back a stale one
+    instance.profile.save(update_fields=['is_freeloader', 'bio', 'updated_at'])
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_user(sender, instance: User, **kwargs) -> None:
+    invalidate(f'user:{instance.pk}')
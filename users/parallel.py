@@ -0,0 +1,51 @@
+"""Set based jobs spread over processes by ranges of user ids"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, List, Optional, Tuple, TypeVar
+
+from django.db import connections
+from django.db.models import Max, Min
+
+from .models import Profile
+
+T = TypeVar('T')
+
+
+def user_ranges(chunks: int) -> List[Tuple[int, int]]:
+    """Split the user ids of all profiles into `chunks` inclusive ranges"""
+    bounds = Profile.objects.aggregate(first=Min('user_id'), last=Max('user_id'))
+    if bounds['first'] is None:
+        return []
+    first, last = bounds['first'], bounds['last']
+    size = max(1, -(-(last - first + 1) // chunks))
+    return [
+        (start, min(start + size - 1, last)) for start in range(first, last + 1, size)
+    ]
+
+
+def map_user_ranges(
+    func: Callable[[int, int], T], workers: Optional[int] = None
+) -> List[T]:
+    """Call `func(first_user, last_user)` for ranges covering the user ids of all
+    profiles in `workers` processes, defaulting to the CPU count, and return the
+    results
+
+    `func` has to be picklable, e.g. a module level function or a `partial` of one.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    # Several ranges per worker, in case users are unevenly distributed
+    ranges = user_ranges(workers * 4)
+    if not ranges:
+        return []
+    firsts, lasts = zip(*ranges)
+    # Spawned workers would have to set up Django again, run in this process where
+    # processes can't be forked, e.g. on Windows
+    if workers == 1 or 'fork' not in multiprocessing.get_all_start_methods():
+        return list(map(func, firsts, lasts))
+
+    # Forked workers open their own connections, they must not share ours
+    connections.close_all()
+    with ProcessPoolExecutor(
+        workers, mp_context=multiprocessing.get_context('fork')
+    ) as executor:
+        return list(executor.map(func, firsts, lasts))
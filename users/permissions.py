@@ -14,7 +14,7 @@ class IsUserOwnerOrStaff(BasePermission):
 
 
 class IsProfileOwnerOrStaff(BasePermission):
-    staff_only_fields = ('is_freeloader', 'balance')
+    staff_only_fields = ('is_freeloader', 'balance', 'balance_shards')
 
     def has_permission(self, request: Request, view) -> bool:
         return request.user and request.user.is_authenticated
@@ -0,0 +1,95 @@
+"""Balance reconciliation
+
+The expected total balance of a profile is the sum of its `BalanceChange`s minus
+the amounts its purchases were charged. `find_discrepancies` compares it with the
+actual balance for every profile, one range of user ids per query, spread over a
+process pool by `reconcile`.
+"""
+from dataclasses import dataclass
+from decimal import Decimal
+from typing import List, Optional
+
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from purchases.models import Purchase
+
+from .balance import record_adjustment
+from .models import BalanceCell, BalanceChange, Profile
+from .parallel import map_user_ranges
+
+
+@dataclass
+class Discrepancy:
+    profile_id: int
+    user_id: int
+    balance: Decimal
+    expected: Decimal
+
+    @property
+    def difference(self) -> Decimal:
+        return self.balance - self.expected
+
+
+def _total(queryset, key: str, outer_key: str, field: str) -> Coalesce:
+    """Sum of `field` over the rows of `queryset` whose `key` is the profile's
+    `outer_key`
+    """
+    return Coalesce(
+        Subquery(
+            queryset.filter(**{key: OuterRef(outer_key)})
+            .order_by()
+            .values(key)
+            .annotate(total=Sum(field))
+            .values('total')
+        ),
+        Value(0),
+        output_field=Profile._meta.get_field('balance'),
+    )
+
+
+def find_discrepancies(first_user: int, last_user: int) -> List[Discrepancy]:
+    """Profiles of users with ids from `first_user` to `last_user` whose balance
+    isn't the expected one
+    """
+    # A single statement reads from one snapshot, purchases committed while it
+    # runs can't show up as discrepancies
+    profiles = (
+        Profile.objects.filter(user_id__gte=first_user, user_id__lte=last_user)
+        .alias(
+            cells=_total(BalanceCell.objects, 'profile_id', 'id', 'balance'),
+            changes=_total(BalanceChange.objects, 'profile_id', 'id', 'amount'),
+            spent=_total(Purchase.objects, 'user_id', 'user_id', 'amount'),
+        )
+        .annotate(
+            actual=F('balance') + F('cells'),
+            expected=F('changes') - F('spent'),
+        )
+        .exclude(actual=F('expected'))
+        .order_by('id')
+    )
+    return [
+        Discrepancy(profile_id, user_id, actual, expected)
+        for profile_id, user_id, actual, expected in profiles.values_list(
+            'id', 'user_id', 'actual', 'expected'
+        )
+    ]
+
+
+def fix_discrepancy(discrepancy: Discrepancy) -> None:
+    """Record the difference found as an adjustment in the ledger
+
+    The balance is what was actually charged and credited, it is kept. Statements
+    show the adjustment, purchases charged since the discrepancy was found don't
+    change the difference.
+    """
+    record_adjustment(discrepancy.profile_id, discrepancy.difference)
+
+
+def reconcile(workers: Optional[int] = None) -> List[Discrepancy]:
+    """Discrepancies of all profiles, found in `workers` processes"""
+    return [
+        discrepancy
+        for discrepancies in map_user_ranges(find_discrepancies, workers)
+        for discrepancy in discrepancies
+    ]
@@ -1,11 +1,13 @@
 from django.contrib.auth.models import User
-from rest_framework.fields import DecimalField
+from django.db import transaction
+from rest_framework.fields import DecimalField, IntegerField
 from rest_framework.serializers import (
     HyperlinkedModelSerializer,
     ModelSerializer,
     Serializer,
 )
 
+from .balance import set_balance, set_balance_shards
 from .models import Profile
 
 
@@ -35,9 +37,58 @@ class UserSerializer(HyperlinkedModelSerializer):
 class ProfileSerializer(ModelSerializer):
     class Meta:
         model = Profile
-        fields = ['id', 'is_freeloader', 'balance', 'bio']
+        fields = ['id', 'is_freeloader', 'balance', 'balance_shards', 'bio']
         read_only_fields = ['id']
+        extra_kwargs = {'balance_shards': {'max_value': 64}}
+
+    def to_representation(self, instance: Profile):
+        """Include the balance cells of sharded profiles in `balance`"""
+        data = super().to_representation(instance)
+        if instance.balance_shards:
+            data['balance'] = self.fields['balance'].to_representation(
+                instance.total_balance
+            )
+        return data
+
+    def update(self, instance: Profile, validated_data) -> Profile:
+        """Change balances through `users.balance` and only save changed fields"""
+        balance = validated_data.pop('balance', None)
+        balance_shards = validated_data.pop('balance_shards', None)
+
+        with transaction.atomic():
+            if validated_data:
+                for attr, value in validated_data.items():
+                    setattr(instance, attr, value)
+                instance.save(update_fields=[*validated_data, 'updated_at'])
+            if balance_shards is not None and balance_shards != instance.balance_shards:
+                set_balance_shards(instance.id, balance_shards)
+            if balance is not None:
+                set_balance(instance.id, balance)
+
+        if balance is not None or balance_shards is not None:
+            instance.refresh_from_db()
+        return instance
+
+
+class SignupProfileSerializer(ProfileSerializer):
+    """Profile fields anyone can set on signup, the others are staff only"""
+
+    class Meta(ProfileSerializer.Meta):
+        read_only_fields = ['id', 'is_freeloader', 'balance', 'balance_shards']
 
 
 class BalanceAddSerializer(Serializer):
     balance = DecimalField(max_digits=15, decimal_places=2)
+
+
+class BulkBalanceAddSerializer(Serializer):
+    profile = IntegerField()
+    amount = DecimalField(max_digits=15, decimal_places=2)
+
+
+class ProfileBalanceSerializer(Serializer):
+    class Meta:
+        read_only_fields = ['profile', 'balance']
+
+    profile = IntegerField(source='id')
+    balance = DecimalField(max_digits=15, decimal_places=2, source='total_balance')
@@ -1,12 +1,37 @@
+import threading
+import time
 from contextlib import contextmanager
 from decimal import Decimal
+from io import StringIO
 from typing import Iterator
+from unittest import skipUnless
+from unittest.mock import ANY
 
+import msgpack
+import psycopg2
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APITestCase
 
+from purchases.deletion import delete_purchase
+from purchases.models import BeverageType, Purchase
+
+from .balance import (
+    CreditLimitExceeded,
+    charge,
+    credit,
+    credit_many,
+    set_balance,
+    set_balance_shards,
+)
+from .models import BalanceCell, BalanceChange, Profile
+from .reconcile import fix_discrepancy, reconcile
+
 
 @contextmanager
 def token_auth(test: APITestCase, token: str) -> Iterator[None]:
@@ -82,6 +107,29 @@ class UsersTest(APITestCase):
 
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
 
+    def test_cant_set_staff_only_profile_fields_on_signup(self) -> None:
+        response = self.client.post(
+            f'{self.api_uri}/',
+            {
+                'username': 'bert',
+                'password': self.password,
+                'profile': {
+                    'bio': 'hi there',
+                    'balance': '100.00',
+                    'balance_shards': 64,
+                    'is_freeloader': True,
+                },
+            },
+            format='json',
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        profile = Profile.objects.get(user__username='bert')
+        self.assertEqual(profile.bio, 'hi there')
+        self.assertEqual(profile.balance, 0)
+        self.assertEqual(profile.balance_shards, 0)
+        self.assertFalse(profile.is_freeloader)
+
     def test_users_can_list_and_retrieve_all_users(self) -> None:
         with token_auth(self, self.user1_token):
             response = self.client.get(f'{self.api_uri}/')
@@ -162,6 +210,17 @@ class UsersTest(APITestCase):
             response = self.client.get(f'{self.api_uri}/?is_staff=has-to-be-0-or-1')
             self.assertEqual(response.status_code, status.HTTP_200_OK)
 
+    def test_id_list_query(self) -> None:
+        with token_auth(self, self.user1_token):
+            response = self.client.get(
+                f'{self.api_uri}/?id={self.user1.id},{self.user2.id}'
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            self.assertEqual(
+                {user['id'] for user in response.data}, {self.user1.id, self.user2.id}
+            )
+
     def test_username_query(self) -> None:
         with token_auth(self, self.user1_token):
             response = self.client.get(f'{self.api_uri}/?username=er')
@@ -195,11 +254,11 @@ class ProfilesTest(APITestCase):
 
     @property
     def profile1_uri(self) -> str:
-        return f'{self.api_uri}/{self.user1.id}/'
+        return f'{self.api_uri}/{self.user1.profile.id}/'
 
     @property
     def profile2_uri(self) -> str:
-        return f'{self.api_uri}/{self.user2.id}/'
+        return f'{self.api_uri}/{self.user2.profile.id}/'
 
     def test_no_one_can_create_or_destroy_profiles(self) -> None:
         with token_auth(self, self.staff_token):
@@ -272,7 +331,7 @@ class ProfilesTest(APITestCase):
     def test_users_cant_access_add_balance(self) -> None:
         with token_auth(self, self.user1_token):
             response = self.client.patch(
-                f'{self.api_uri}/{self.user1.id}/add-balance/',
+                f'{self.api_uri}/{self.user1.profile.id}/add-balance/',
                 {'balance': '12.34'},
                 format='json',
             )
@@ -281,7 +340,7 @@ class ProfilesTest(APITestCase):
     def test_staff_can_access_add_balance(self) -> None:
         with token_auth(self, self.staff_token):
             response = self.client.patch(
-                f'{self.api_uri}/{self.user1.id}/add-balance/',
+                f'{self.api_uri}/{self.user1.profile.id}/add-balance/',
                 {'balance': '12.34'},
                 format='json',
             )
@@ -293,7 +352,7 @@ class ProfilesTest(APITestCase):
             previous_balance = self.user1.profile.balance
 
             response = self.client.patch(
-                f'{self.api_uri}/{self.user1.id}/add-balance/',
+                f'{self.api_uri}/{self.user1.profile.id}/add-balance/',
                 {'balance': '12.34'},
                 format='json',
             )
@@ -303,6 +362,104 @@ class ProfilesTest(APITestCase):
             new_balance = self.user1.profile.balance
             self.assertEqual(new_balance, previous_balance + Decimal('12.34'))
 
+    def test_add_balance_msgpack(self) -> None:
+        with token_auth(self, self.staff_token):
+            self.user1.refresh_from_db()
+            previous_balance = self.user1.profile.balance
+
+            response = self.client.patch(
+                f'{self.api_uri}/{self.user1.profile.id}/add-balance/',
+                {'balance': '12.34'},
+                format='msgpack',
+                HTTP_ACCEPT='application/msgpack',
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['Content-Type'], 'application/msgpack')
+
+            data = msgpack.unpackb(response.content)
+            self.assertEqual(
+                Decimal(data['balance']), previous_balance + Decimal('12.34')
+            )
+
+    def test_bulk_add_balance(self) -> None:
+        with token_auth(self, self.staff_token):
+            self.user1.profile.refresh_from_db()
+            self.user2.profile.refresh_from_db()
+            balance1 = self.user1.profile.balance
+            balance2 = self.user2.profile.balance
+
+            response = self.client.post(
+                f'{self.api_uri}/bulk-add-balance/',
+                [
+                    {'profile': self.user1.profile.id, 'amount': '10.00'},
+                    {'profile': self.user2.profile.id, 'amount': '5.50'},
+                    {'profile': self.user1.profile.id, 'amount': '2.00'},
+                ],
+                format='json',
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(
+                response.data,
+                [
+                    {
+                        'profile': self.user1.profile.id,
+                        'balance': str(balance1 + Decimal('12.00')),
+                    },
+                    {
+                        'profile': self.user2.profile.id,
+                        'balance': str(balance2 + Decimal('5.50')),
+                    },
+                ],
+            )
+
+    def test_bulk_add_balance_is_all_or_nothing(self) -> None:
+        with token_auth(self, self.staff_token):
+            self.user1.profile.refresh_from_db()
+            balance = self.user1.profile.balance
+
+            response = self.client.post(
+                f'{self.api_uri}/bulk-add-balance/',
+                [
+                    {'profile': self.user1.profile.id, 'amount': '10.00'},
+                    {'profile': 999999, 'amount': '5.50'},
+                ],
+                format='json',
+            )
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+            self.user1.profile.refresh_from_db()
+            self.assertEqual(self.user1.profile.balance, balance)
+
+    def test_users_cant_access_bulk_add_balance(self) -> None:
+        with token_auth(self, self.user1_token):
+            response = self.client.post(
+                f'{self.api_uri}/bulk-add-balance/',
+                [{'profile': self.user1.profile.id, 'amount': '10.00'}],
+                format='json',
+            )
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_users_cant_shard_balance(self) -> None:
+        with token_auth(self, self.user1_token):
+            response = self.client.patch(
+                self.profile1_uri, {'balance_shards': 4}, format='json'
+            )
+            self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_staff_can_shard_balance(self) -> None:
+        with token_auth(self, self.staff_token):
+            response = self.client.patch(
+                self.profile1_uri,
+                {'balance_shards': 4, 'balance': '10.00'},
+                format='json',
+            )
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response.data['balance_shards'], 4)
+
+            charge(self.user1.id, Decimal('2.20'))
+            response = self.client.get(self.profile1_uri)
+            self.assertEqual(response.data['balance'], '7.80')
+
     def test_is_freeloader_query(self) -> None:
         with token_auth(self, self.user1_token):
             response = self.client.get(f'{self.api_uri}/?is_freeloader=1')
@@ -331,3 +488,300 @@ class ProfilesTest(APITestCase):
 
             for user in response.data:
                 self.assertIn('hi', user['bio'].lower())
+
+
+class BalanceTest(TestCase):
+    user: User
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.user = User.objects.create_user(username='erni', password='1234')
+
+    def test_charge(self) -> None:
+        self.assertEqual(charge(self.user.id, Decimal('2.20')), Decimal('-2.20'))
+        self.assertEqual(charge(self.user.id, Decimal('1.10')), Decimal('-3.30'))
+
+    def test_freeloaders_arent_charged(self) -> None:
+        Profile.objects.filter(user=self.user).update(is_freeloader=True)
+
+        self.assertIsNone(charge(self.user.id, Decimal('2.20')))
+        self.user.profile.refresh_from_db()
+        self.assertEqual(self.user.profile.balance, 0)
+
+    def test_charges_profile_of_user(self) -> None:
+        # Profile and user ids differ after recreating the profile
+        Profile.objects.filter(user=self.user).delete()
+        profile = Profile.objects.create(user=self.user)
+        self.assertNotEqual(profile.id, self.user.id)
+
+        charge(self.user.id, Decimal('2.20'))
+        profile.refresh_from_db()
+        self.assertEqual(profile.balance, Decimal('-2.20'))
+
+    @override_settings(CREDIT_LIMIT=Decimal('5.00'))
+    def test_credit_limit(self) -> None:
+        self.assertEqual(charge(self.user.id, Decimal('2.50')), Decimal('-2.50'))
+        self.assertEqual(charge(self.user.id, Decimal('2.50')), Decimal('-5.00'))
+        with self.assertRaises(CreditLimitExceeded):
+            charge(self.user.id, Decimal('0.01'))
+
+        self.user.profile.refresh_from_db()
+        self.assertEqual(self.user.profile.balance, Decimal('-5.00'))
+
+    @override_settings(CREDIT_LIMIT=Decimal('0'))
+    def test_credit_limit_doesnt_apply_to_freeloaders(self) -> None:
+        Profile.objects.filter(user=self.user).update(is_freeloader=True)
+
+        self.assertIsNone(charge(self.user.id, Decimal('2.20')))
+
+    def test_credit_doesnt_lose_updates(self) -> None:
+        stale_profile = Profile.objects.get(user=self.user)
+        charge(self.user.id, Decimal('2.20'))
+
+        self.assertEqual(credit(stale_profile.id, Decimal('10')), Decimal('7.80'))
+
+    def test_sharded_balance(self) -> None:
+        profile = self.user.profile
+        set_balance_shards(profile.id, 4)
+        self.assertEqual(BalanceCell.objects.filter(profile=profile).count(), 4)
+
+        for _ in range(3):
+            charge(self.user.id, Decimal('2.20'))
+        credit(profile.id, Decimal('1.00'))
+
+        profile.refresh_from_db()
+        self.assertEqual(profile.balance, Decimal('1.00'))
+        self.assertEqual(profile.total_balance, Decimal('-5.60'))
+
+        set_balance_shards(profile.id, 0)
+        profile.refresh_from_db()
+        self.assertEqual(profile.balance, Decimal('-5.60'))
+        self.assertFalse(BalanceCell.objects.filter(profile=profile).exists())
+
+    def test_sharded_charges_bump_updated_at(self) -> None:
+        profile = self.user.profile
+        set_balance_shards(profile.id, 2)
+        profile.refresh_from_db()
+
+        charge(self.user.id, Decimal('2.20'))
+        self.assertGreater(
+            Profile.objects.get(id=profile.id).updated_at, profile.updated_at
+        )
+
+    @override_settings(CREDIT_LIMIT=Decimal('3.00'))
+    def test_sharded_credit_limit(self) -> None:
+        set_balance_shards(self.user.profile.id, 2)
+
+        self.assertEqual(charge(self.user.id, Decimal('2.00')), Decimal('-2.00'))
+        with self.assertRaises(CreditLimitExceeded):
+            charge(self.user.id, Decimal('2.00'))
+
+    def test_set_balance_resets_cells(self) -> None:
+        profile = self.user.profile
+        set_balance_shards(profile.id, 2)
+        charge(self.user.id, Decimal('2.20'))
+
+        set_balance(profile.id, Decimal('5.00'))
+        profile.refresh_from_db()
+        self.assertEqual(profile.total_balance, Decimal('5.00'))
+
+    def test_ledger(self) -> None:
+        profile = self.user.profile
+        set_balance_shards(profile.id, 2)
+        charge(self.user.id, Decimal('2.20'))
+        credit(profile.id, Decimal('10.00'))
+        credit_many({profile.id: Decimal('1.00')})
+        set_balance(profile.id, Decimal('5.00'))
+
+        self.assertEqual(
+            list(profile.balance_changes.order_by('id').values_list('kind', 'amount')),
+            [
+                (BalanceChange.TOP_UP, Decimal('10.00')),
+                (BalanceChange.TOP_UP, Decimal('1.00')),
+                (BalanceChange.ADJUSTMENT, Decimal('-3.80')),
+            ],
+        )
+
+
+@skipUnless(connection.vendor == 'postgresql', 'needs row locks')
+class ShardingRaceTest(TransactionTestCase):
+    def test_unsharding_waits_for_cell_debits(self) -> None:
+        user = User.objects.create_user(username='erni', password='1234')
+        set_balance_shards(user.profile.id, 1)
+
+        # A cell debit in progress on another connection
+        debit = psycopg2.connect(**connection.get_connection_params())
+        self.addCleanup(debit.close)
+        with debit.cursor() as cursor:
+            cursor.execute(
+                'UPDATE users_balancecell SET balance = balance - 2 '
+                'WHERE profile_id = %s',
+                [user.profile.id],
+            )
+
+        def unshard() -> None:
+            try:
+                set_balance_shards(user.profile.id, 0)
+            finally:
+                connections.close_all()
+
+        thread = threading.Thread(target=unshard)
+        thread.start()
+        with debit.cursor() as cursor:
+            for _ in range(100):
+                cursor.execute('SELECT count(*) FROM pg_locks WHERE NOT granted')
+                if cursor.fetchone()[0]:
+                    break
+                time.sleep(0.05)
+        debit.commit()
+        thread.join()
+
+        user.profile.refresh_from_db()
+        self.assertEqual(user.profile.balance, Decimal('-2'))
+        self.assertFalse(BalanceCell.objects.exists())
+
+    def test_cell_debits_retry_on_replaced_cells(self) -> None:
+        user = User.objects.create_user(username='erni', password='1234')
+        set_balance_shards(user.profile.id, 1)
+
+        # Cells being replaced by `set_balance_shards` on another connection
+        reshard = psycopg2.connect(**connection.get_connection_params())
+        self.addCleanup(reshard.close)
+        with reshard.cursor() as cursor:
+            cursor.execute(
+                'UPDATE users_profile SET balance_shards = 2 WHERE id = %s',
+                [user.profile.id],
+            )
+            cursor.execute(
+                'DELETE FROM users_balancecell WHERE profile_id = %s',
+                [user.profile.id],
+            )
+            cursor.execute(
+                'INSERT INTO users_balancecell (profile_id, shard, balance) '
+                'VALUES (%s, 0, 0), (%s, 1, 0)',
+                [user.profile.id, user.profile.id],
+            )
+
+        errors = []
+
+        def purchase() -> None:
+            try:
+                charge(user.id, Decimal('2'))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connections.close_all()
+
+        thread = threading.Thread(target=purchase)
+        thread.start()
+        with reshard.cursor() as cursor:
+            for _ in range(100):
+                cursor.execute('SELECT count(*) FROM pg_locks WHERE NOT granted')
+                if cursor.fetchone()[0]:
+                    break
+                time.sleep(0.05)
+        reshard.commit()
+        thread.join()
+
+        self.assertEqual(errors, [])
+        user.profile.refresh_from_db()
+        self.assertEqual(user.profile.total_balance, Decimal('-2'))
+
+
+class ReconcileTest(TestCase):
+    user: User
+    beverage_type: BeverageType
+
+    @classmethod
+    def setUpTestData(cls) -> None:
+        cls.user = User.objects.create_user(username='erni', password='1234')
+        cls.beverage_type = BeverageType.objects.create(name='coffee', price='2.20')
+
+    def purchase(self) -> None:
+        charge(self.user.id, self.beverage_type.price)
+        Purchase.objects.create(
+            user=self.user,
+            beverage_type=self.beverage_type,
+            amount=self.beverage_type.price,
+        )
+
+    def test_consistent_balances(self) -> None:
+        set_balance_shards(self.user.profile.id, 2)
+        credit(self.user.profile.id, Decimal('10.00'))
+        self.purchase()
+        self.purchase()
+        set_balance(self.user.profile.id, Decimal('3.00'))
+
+        self.assertEqual(reconcile(workers=1), [])
+
+    def test_fix(self) -> None:
+        credit(self.user.profile.id, Decimal('10.00'))
+        self.purchase()
+        Profile.objects.filter(id=self.user.profile.id).update(balance=100)
+
+        discrepancies = reconcile(workers=1)
+        self.assertEqual(len(discrepancies), 1)
+        self.assertEqual(discrepancies[0].difference, Decimal('92.20'))
+
+        self.purchase()
+        fix_discrepancy(discrepancies[0])
+        self.user.profile.refresh_from_db()
+        self.assertEqual(self.user.profile.balance, Decimal('97.80'))
+        self.assertEqual(
+            BalanceChange.objects.get(kind=BalanceChange.ADJUSTMENT).amount,
+            Decimal('92.20'),
+        )
+        self.assertEqual(reconcile(workers=1), [])
+
+    def test_deleted_purchases_are_refunded(self) -> None:
+        credit(self.user.profile.id, Decimal('10.00'))
+        self.purchase()
+        purchase = Purchase.objects.get()
+
+        delete_purchase(purchase)
+
+        self.user.profile.refresh_from_db()
+        self.assertEqual(self.user.profile.balance, Decimal('10.00'))
+        self.assertEqual(reconcile(workers=1), [])
+        self.assertEqual(
+            list(
+                BalanceChange.objects.exclude(kind=BalanceChange.TOP_UP)
+                .order_by('id')
+                .values_list('kind', 'amount', 'date')
+            ),
+            [
+                (BalanceChange.PURCHASE, Decimal('-2.20'), purchase.date),
+                (BalanceChange.REFUND, Decimal('2.20'), ANY),
+            ],
+        )
+
+    def test_command(self) -> None:
+        Profile.objects.filter(id=self.user.profile.id).update(balance=1)
+        out = StringIO()
+
+        call_command('reconcile_balances', '--workers=1', '--fix', stdout=out)
+
+        self.assertIn('Fixed 1 discrepancies', out.getvalue())
+        self.assertEqual(reconcile(workers=1), [])
+
+
+class ProfileAdminTest(TestCase):
+    def test_freeloader_actions_run_one_update(self) -> None:
+        staff = User.objects.create_superuser(username='staff', password='1234')
+        users = [
+            User.objects.create_user(username=f'user{i}', password='1234')
+            for i in range(3)
+        ]
+        self.client.force_login(staff)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.post(
+                '/admin/users/profile/',
+                {
+                    'action': 'mark_freeloaders',
+                    '_selected_action': [user.profile.id for user in users],
+                },
+            )
+        updates = [query for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(Profile.objects.filter(is_freeloader=True).count(), 3)
@@ -1,9 +1,13 @@
-from typing import List, Type
+from collections import defaultdict
+from decimal import Decimal
+from typing import Dict, List, Type
 
 from django.contrib.auth.models import User
-from django.db.models import Count, QuerySet
+from django.db.models import QuerySet
 from rest_framework import status
+from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.decorators import action
+from rest_framework.exceptions import ValidationError
 from rest_framework.mixins import ListModelMixin, RetrieveModelMixin, UpdateModelMixin
 from rest_framework.permissions import BasePermission, IsAdminUser, IsAuthenticated
 from rest_framework.request import Request
@@ -11,18 +15,30 @@ from rest_framework.response import Response
 from rest_framework.serializers import BaseSerializer
 from rest_framework.viewsets import GenericViewSet, ModelViewSet
 
+from kaffee_kasse.caching import cached
+from kaffee_kasse.throttling import AuthIPThrottle
+from statements.models import Statement
+from statements.serializers import StatementSerializer
+
+from .balance import credit, credit_many
+from .filters import ProfileFilterSet, UserFilterSet
 from .models import Profile
 from .permissions import IsProfileOwnerOrStaff, IsUserOwnerOrStaff
-from .serializers import BalanceAddSerializer, ProfileSerializer, UserSerializer
+from .serializers import (
+    BalanceAddSerializer,
+    BulkBalanceAddSerializer,
+    ProfileBalanceSerializer,
+    ProfileSerializer,
+    SignupProfileSerializer,
+    UserSerializer,
+)
 
 
 class UserViewSet(ModelViewSet):
-    queryset = User.objects.all()
+    # The serializer links every user's profile
+    queryset = User.objects.select_related('profile')
     serializer_class = UserSerializer
 
-    _default_orders = ('username', '-username', 'date_joined', '-date_joined')
-    _custom_orders = ('purchases', '-purchases')
-
     def get_permissions(self) -> List[BasePermission]:
         """Allow creation to anyone, updating, partially updating and
         destroying only to staff and the current user
@@ -35,48 +51,30 @@ class UserViewSet(ModelViewSet):
         return [permission() for permission in permission_classes]
 
     def get_queryset(self) -> QuerySet:
-        """Support `User.is_staff`, `User.username` and non default order queries"""
-        queryset = super().get_queryset()
-        qp = self.request.query_params
-        is_staff, username, order = (
-            qp.get('is_staff', None),
-            qp.get('username'),
-            qp.get('order'),
+        """Support `User.id`, `User.is_staff`, `User.username` and non default order
+        queries, see `UserFilterSet`
+        """
+        return UserFilterSet(self.request.query_params).filter_queryset(
+            super().get_queryset()
         )
 
-        if is_staff is not None:
-            try:
-                is_staff = bool(int(is_staff))
-                queryset = queryset.filter(is_staff=is_staff)
-            except ValueError:
-                pass
-        if username is not None:
-            queryset = queryset.filter(username__icontains=username)
-        if order in self._default_orders:
-            queryset = queryset.order_by(order)
-        if order in self._custom_orders:
-            if order == 'purchases':
-                queryset = queryset.annotate(purchases=Count('purchase')).order_by(
-                    'purchases', 'pk'
-                )
-            elif order == '-purchases':
-                queryset = queryset.annotate(purchases=Count('purchase')).order_by(
-                    '-purchases', 'pk'
-                )
-        return queryset
-
     def get_serializer_context(self):
         """Set request to none to return relative urls for relationships"""
         return {'request': None, 'format': self.format_kwarg, 'view': self}
 
     def create(self, request: Request) -> Response:
-        """Allow setting `Profile` fields on `User` creation"""
+        """Allow setting `Profile` fields on `User` creation, staff only fields
+        only by staff
+        """
         user_serializer = self.get_serializer(data=request.data)
         user_serializer.is_valid(raise_exception=True)
         user: User = user_serializer.save()
 
         if 'profile' in request.data:
-            profile_serializer = ProfileSerializer(
+            serializer_class = (
+                ProfileSerializer if request.user.is_staff else SignupProfileSerializer
+            )
+            profile_serializer = serializer_class(
                 user.profile, data=request.data['profile'], partial=True
             )
             profile_serializer.is_valid(raise_exception=True)
@@ -90,9 +88,15 @@ class UserViewSet(ModelViewSet):
 
     @action(detail=False)
     def me(self, request: Request) -> Response:
-        """Current user endpoint"""
-        serializer = self.get_serializer(request.user)
-        return Response(serializer.data)
+        """Current user endpoint, cached until the user changes"""
+        user = request.user
+        return Response(
+            cached(
+                [f'user:{user.pk}'],
+                f'me:{user.pk}',
+                lambda: self.get_serializer(user).data,
+            )
+        )
 
 
 # Not inheriting CreateModelMixin and DeleteModelMixin to disallow creation
@@ -103,13 +107,13 @@ class ProfileViewSet(
     queryset = Profile.objects.all()
 
     def get_permissions(self) -> List[BasePermission]:
-        """Allow `add_balance` only to staff, updating to staff and the current
-        user
+        """Allow `add_balance` and `bulk_add_balance` only to staff, updating and
+        viewing statements to staff and the current user
         """
         permission_classes = [IsAuthenticated]
-        if self.action in ('add_balance',):
+        if self.action in ('add_balance', 'bulk_add_balance'):
             permission_classes += [IsAdminUser]
-        elif self.action in ('update', 'partial_update'):
+        elif self.action in ('update', 'partial_update', 'statements'):
             permission_classes += [IsProfileOwnerOrStaff]
         return [permission() for permission in permission_classes]
 
@@ -117,24 +121,18 @@ class ProfileViewSet(
         """Change serializer class for custom actions"""
         if self.action == 'add_balance':
             return BalanceAddSerializer
+        elif self.action == 'bulk_add_balance':
+            return BulkBalanceAddSerializer
         else:
             return ProfileSerializer
 
     def get_queryset(self) -> QuerySet:
-        """Support `Profile.is_freeloader` and `Profile.bio` queries"""
-        queryset = super().get_queryset()
-        qp = self.request.query_params
-        is_freeloader, bio = qp.get('is_freeloader', None), qp.get('bio')
-
-        if is_freeloader is not None:
-            try:
-                is_freeloader = bool(int(is_freeloader))
-                queryset = queryset.filter(is_freeloader=is_freeloader)
-            except ValueError:
-                pass
-        if bio is not None:
-            queryset = queryset.filter(bio__icontains=bio)
-        return queryset
+        """Support `Profile.id`, `Profile.user`, `Profile.is_freeloader` and
+        `Profile.bio` queries, see `ProfileFilterSet`
+        """
+        return ProfileFilterSet(self.request.query_params).filter_queryset(
+            super().get_queryset()
+        )
 
     @action(detail=True, methods=['patch'], url_path='add-balance')
     def add_balance(self, request: Request, pk: str = None):
@@ -143,7 +141,38 @@ class ProfileViewSet(
         serializer.is_valid(raise_exception=True)
 
         profile = self.get_object()
-        profile.balance += serializer.validated_data['balance']
-        profile.save()
+        profile.balance = credit(profile.id, serializer.validated_data['balance'])
 
         return Response(ProfileSerializer(profile).data)
+
+    @action(detail=False, methods=['post'], url_path='bulk-add-balance')
+    def bulk_add_balance(self, request: Request):
+        """Helper action for adding to `Profile.balance` of several profiles at
+        once, in a single UPDATE
+        """
+        serializer = self.get_serializer_class()(
+            data=request.data, many=True, allow_empty=False
+        )
+        serializer.is_valid(raise_exception=True)
+
+        amounts: Dict[int, Decimal] = defaultdict(Decimal)
+        for top_up in serializer.validated_data:
+            amounts[top_up['profile']] += top_up['amount']
+        try:
+            profiles = credit_many(amounts)
+        except Profile.DoesNotExist as e:
+            raise ValidationError({'profile': str(e)})
+
+        return Response(ProfileBalanceSerializer(profiles, many=True).data)
+
+    @action(detail=True, methods=['get'])
+    def statements(self, request: Request, pk: str = None):
+        """Action for the monthly statements of a profile, newest first"""
+        profile = self.get_object()
+        statements = Statement.objects.filter(profile=profile).order_by('-month')
+        return Response(StatementSerializer(statements, many=True).data)
+
+
+class ObtainAuthTokenView(ObtainAuthToken):
+    # Every attempt hashes the password, which is expensive on purpose
+    throttle_classes = [AuthIPThrottle]